@@ -23,11 +23,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import argparse
 import os
+import time
 
 from catdagger import logger
-from catdagger.tiled_tesselator import tag_regions
+from catdagger import counters
+from catdagger.tiled_tesselator import tag_regions, tag_stokes_regions, tag_time_slices
+from catdagger.fits_tools import FitsStokesTypes
 from catdagger.lsm_tools import tag_lsm
-from catdagger.fits_tools import blank_components
+from catdagger.mosaic import tag_mosaic
+from catdagger.preview import tag_preview
+from catdagger.fits_tools import blank_components, parse_memory_size, get_fitted_beam, check_compression
+from catdagger.exclusion_zones import SkyCircularExclusionZone, read_ds9_exclusion_zones
+from catdagger.roi import PixelBoxROI, SkyCircleROI
 import numpy as np
 import logging
 logging.getLogger("matplotlib").disabled=True
@@ -45,6 +52,50 @@ def exclusion_zone(val):
         raise argparse.ArgumentTypeError("Exclusion zone must be a tripple like (int, int, float)")
     return (cx, cy, exclrad)
 
+def sky_exclusion_zone(val):
+    valtup = val.split(",") if isinstance(val, str) else tuple(val) if isinstance(val, list) else []
+
+    if len(valtup) != 3:
+        raise argparse.ArgumentTypeError("Sky exclusion zone must be a tripple like (ra, dec, radius)")
+    try:
+        ra = float(valtup[0]); dec = float(valtup[1]); exclrad = float(valtup[2])
+    except:
+        raise argparse.ArgumentTypeError("Sky exclusion zone must be a tripple like (float, float, float)")
+    return SkyCircularExclusionZone(ra, dec, exclrad)
+
+def roi_box(val):
+    valtup = val.split(",") if isinstance(val, str) else tuple(val) if isinstance(val, list) else []
+    if len(valtup) != 4:
+        raise argparse.ArgumentTypeError("Region of interest box must be a quadruple like (xmin, ymin, xmax, ymax)")
+    try:
+        return PixelBoxROI(*[int(v) for v in valtup])
+    except ValueError:
+        raise argparse.ArgumentTypeError("Region of interest box must be a quadruple like (int, int, int, int) "
+                                         "with xmax > xmin and ymax > ymin")
+
+def roi_sky(val):
+    valtup = val.split(",") if isinstance(val, str) else tuple(val) if isinstance(val, list) else []
+    if len(valtup) != 3:
+        raise argparse.ArgumentTypeError("Sky region of interest must be a tripple like (ra, dec, radius)")
+    try:
+        return SkyCircleROI(*[float(v) for v in valtup])
+    except ValueError:
+        raise argparse.ArgumentTypeError("Sky region of interest must be a tripple like (float, float, float)")
+
+def memory_size(val):
+    try:
+        return parse_memory_size(val)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Memory size must be a number of MiB or a size like 512M, 16G")
+
+def stokes_list(val):
+    vallist = val.split(",") if isinstance(val,str) else val if isinstance(val, list) else []
+    if len(vallist) == 0:
+        raise argparse.ArgumentTypeError("Stokes list cannot be empty")
+    if not all([v in FitsStokesTypes for v in vallist]):
+        raise argparse.ArgumentTypeError("Stokes must be one of {0:s}".format(",".join(sorted(FitsStokesTypes.keys()))))
+    return vallist
+
 def file_list(val):
     vallist = val.split(",") if isinstance(val,str) else val if isinstance(val, list) else []
     if len(vallist) == 0:
@@ -53,15 +104,54 @@ def file_list(val):
         raise argparse.ArgumentTypeError("One or more files specified as input cannot be located")
     return vallist
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser("CATDagger - an automatic differential gain tagger (C) SARAO, Benjamin Hugo 2019")
     parser.add_argument("noise_map",
                         type=file_list,
-                        help="Residual / noise FITS map to use for estimating local RMS")
+                        help="Residual / noise FITS map to use for estimating local RMS. "
+                             "Comma-separated list of time slot residuals with --stack-time-slots "
+                             "or of pointing residuals with --mosaic")
     parser.add_argument("--stokes",
                         type=str,
                         default="I",
                         help="Stokes to consider when computing global noise estimates. Ideally this should be 'V', if available")
+    parser.add_argument("--analyse-stokes",
+                        type=stokes_list,
+                        default=None,
+                        help="Comma-separated list of Stokes (e.g. I,Q,U,V) to tag regions on from a single read of the "
+                             "cube. Regions per Stokes are written to the DS9 regions file with a Stokes suffix "
+                             "(e.g. dE.V.reg). The regions used for tagging are flagged on the noise of --stokes and "
+                             "culled on the skewness and flux ratio of --culling-stokes. Not supported with --max-memory")
+    parser.add_argument("--stack-time-slots",
+                        action="store_true",
+                        help="Treat the noise maps as residuals of successive time slots on one grid. The residuals "
+                             "are streamed through one at a time and regions are formed from tiles exceeding "
+                             "the cutoff in at least --min-slots-exceeded of the slots. Skewness and flux ratio "
+                             "culling does not apply in this mode")
+    parser.add_argument("--mosaic",
+                        action="store_true",
+                        help="Treat the noise maps as residuals of the pointings of a mosaic. Tiles are flagged "
+                             "and merged per pointing (one pointing per worker process with --processes), "
+                             "projected onto a common sky frame and merged across pointings. The merged regions "
+                             "are culled once, each on the pointings it was merged from resampled onto that "
+                             "frame, before the catalog is tagged once. Regions and cluster leads are written in "
+                             "fk5 sky coordinates")
+    parser.add_argument("--min-slots-exceeded",
+                        type=int,
+                        default=None,
+                        help="Minimum number of time slots a tile must exceed the cutoff in to be tagged "
+                             "with --stack-time-slots. Defaults to half of the slots")
+    parser.add_argument("--time-slot-heat-map",
+                        type=str,
+                        default=None,
+                        help="FITS filename to write the fraction of time slots every tile exceeded the cutoff "
+                             "in to, with the mean tile deviation in its DEVIATION extension "
+                             "(--stack-time-slots only)")
+    parser.add_argument("--culling-stokes",
+                        type=str,
+                        default="I",
+                        help="Stokes to use for skewness and positive to negative flux culling of regions "
+                             "with --analyse-stokes")
     parser.add_argument("--min-tiles-region",
                         type=int,
                         default=3,
@@ -78,6 +168,12 @@ def main():
                         type=str,
                         default="dE.tags.reg",
                         help="SAODS9 regions filename to contain tagged cluster leads as circles")
+    parser.add_argument("--label-image",
+                        type=str,
+                        default=None,
+                        help="FITS filename to write an integer label image of the tagged regions to "
+                             "(0 outside regions, 1 + region index inside), with a table of the regions "
+                             "in its REGIONS extension")
     parser.add_argument("-s",
                         "--sigma",
                         type=float,
@@ -106,6 +202,17 @@ def main():
                         nargs="+",
                         help="Add manual exclusion zone to which no dE tags shall be added. "
                              "Expects a tripple of centre X, Y pixel and radius.")
+    parser.add_argument("--add-custom-sky-exclusion-zone",
+                        type=sky_exclusion_zone,
+                        default=None,
+                        nargs="+",
+                        help="Add manual exclusion zone to which no dE tags shall be added. "
+                             "Expects a tripple of centre RA, DEC and radius in degrees.")
+    parser.add_argument("--exclusion-zones-ds9-reg-file",
+                        type=file_list,
+                        default=None,
+                        help="SAODS9 regions file(s) with circles and polygons (image, physical or "
+                             "fk5 / icrs / galactic coordinates) to which no dE tags shall be added")
     parser.add_argument("--max-region-right-skewness",
                         type=float,
                         default=2,
@@ -123,6 +230,33 @@ def main():
                              "Expects list of model FITS files. "
                              "This option is useful for hybrid DFT-CLEAN component modelling as only"
                              "extended / faint clean components contributes to model.")
+    parser.add_argument("--per-channel-psf-fit",
+                        action="store_true",
+                        help="Fit the clean beam to the main lobe of every channel of the PSF image and blank "
+                             "each model channel with its own beam. The channel averaged PSF is fitted "
+                             "if the PSF header lacks BMAJ, BMIN and BPA")
+    parser.add_argument("--compress-model-images",
+                        type=str,
+                        default=None,
+                        choices=["RICE_1", "GZIP_1", "GZIP_2", "HCOMPRESS_1", "PLIO_1"],
+                        help="Write blanked model images as tile-compressed FITS using this algorithm. "
+                             "Note that floating point data is quantised (lossy) when compressed. Tile-compressed "
+                             "model images are always written back with their own compression settings. "
+                             "Older versions of astropy (e.g. 2.x) cannot compress cubes of more than 3 axes")
+    parser.add_argument("--model-image-backup",
+                        type=str,
+                        default="full",
+                        choices=["full", "delta", "none"],
+                        help="Backup of model images before blanking: 'full' copies every model to "
+                             "<model>.orig.fits, 'delta' only stores the original values of blanked pixels "
+                             "in a compressed <model>.delta.npz sidecar, which can be written back with "
+                             "dagger-restore")
+    parser.add_argument("--blank-fft",
+                        action="store_true",
+                        help="Build the model blanking mask of all tagged components in a single FFT "
+                             "convolution with the fitted beam instead of convolving each component "
+                             "separately. Faster for dense catalogs, but the mask may grow slightly "
+                             "where footprints of neighbouring components overlap")
     parser.add_argument("--only-dEs-in-lsm",
                         action="store_true",
                         help="Only store dE tagged sources in lsm. This option is useful for hybrid "
@@ -140,41 +274,280 @@ def main():
                              "in the residual. This can be used to effectively control detection sensitivity "
                              "to uncleaned extended emission, but should be set to 0 if residuals other than "
                              "stokes Q,U or V are used")
-    args = parser.parse_args()
-    import time
-    tic = int(time.time())
-    exclusion_zones = [exclz for exclz in args.add_custom_exclusion_zone] \
-        if args.add_custom_exclusion_zone is not None else []
-    tagged_regions = tag_regions(args.noise_map[0],
-                                 regionsfn = args.ds9_reg_file,
-                                 sigma = args.sigma,
-                                 block_size = args.tile_size,
-                                 hdu_id = 0,
-                                 use_stokes = args.stokes,
-                                 global_stat_percentile = args.global_rms_percentile,
-                                 min_blocks_in_region = args.min_tiles_region,
-                                 min_distance_from_centre = args.min_distance_from_tracking_centre,
-                                 exclusion_zones=exclusion_zones,
-                                 max_right_skewness=args.max_region_right_skewness,
-                                 max_abs_skewness=args.max_region_abs_skewness,
-                                 max_positive_to_negative_flux=args.max_positive_to_negative_flux)
-    if args.input_lsm is not None:
-        sources = tag_lsm(args.input_lsm[0],
-                          args.noise_map[0],
-                          tagged_regions,
-                          hdu_id=0,
-                          regionsfn = args.ds9_tag_reg_file,
-                          taggedlsm_fn=args.input_lsm[0] + ".de_tagged.lsm.html",
-                          de_tag=args.de_tag_name,
-                          store_only_dEs=args.only_dEs_in_lsm)
-        if args.remove_tagged_dE_components_from_model_images is not None:
+    parser.add_argument("--roi-box",
+                        type=roi_box,
+                        default=None,
+                        help="Only read and tag the whole tiles covering this pixel box (xmin,ymin,xmax,ymax; "
+                             "0-based, x along columns). The global noise percentile is estimated from a "
+                             "sample of tiles over the full image. Regions keep full image pixel coordinates")
+    parser.add_argument("--roi-sky",
+                        type=roi_sky,
+                        default=None,
+                        help="Only read and tag the whole tiles covering this sky circle (ra,dec,radius in "
+                             "degrees), e.g. the primary beam. See --roi-box")
+    parser.add_argument("--preview",
+                        type=int,
+                        default=None,
+                        metavar="FACTOR",
+                        help="Quick look: only read every FACTOR'th row and column of the noise map and tag "
+                             "from tile statistics of these samples. Reports the confidence of every region. "
+                             "FACTOR must divide the tile size. Not supported with --analyse-stokes, "
+                             "--stack-time-slots, --mosaic, --state-file or regions of interest")
+    parser.add_argument("--beam-matched-filter",
+                        action="store_true",
+                        help="Convolve the band averaged noise map with the fitted restoring beam of --psf-image "
+                             "before computing tile statistics, separably if the beam is nearly circular. "
+                             "Not supported with --max-memory, regions of interest, --preview, --mosaic, "
+                             "--analyse-stokes or --stack-time-slots")
+    parser.add_argument("--max-memory",
+                        type=memory_size,
+                        default=None,
+                        help="Memory budget (e.g. 4G, 512M; bare numbers in MiB). If set, the noise map "
+                             "is processed out-of-core in row bands of whole tiles and only pixels within "
+                             "flagged regions are read back for culling. Default is to load the whole "
+                             "band averaged image")
+    parser.add_argument("--threads",
+                        type=int,
+                        default=1,
+                        help="Number of threads to use for channel averaging, tile statistics and FFTs. "
+                             "Results are identical to a single threaded run")
+    parser.add_argument("--processes",
+                        type=int,
+                        default=1,
+                        help="Number of worker processes to use for region culling and per channel PSF fitting. "
+                             "Results are identical to a single process run")
+    parser.add_argument("--state-file",
+                        type=str,
+                        default=None,
+                        help="Save the tile flags, merged regions with their culling decisions and the catalog "
+                             "members of every region to this file, and retag incrementally against it if it "
+                             "exists: regions whose tiles did not change are carried over without merging, "
+                             "culling or catalog searches. Not supported with --analyse-stokes, "
+                             "--stack-time-slots or --mosaic")
+    parser.add_argument("--state-tolerance",
+                        type=float,
+                        default=0.05,
+                        help="Relative change in the deviation of a flagged tile from the global noise beyond "
+                             "which the tile counts as changed against --state-file")
+    parser.add_argument("--counters",
+                        action="store_true",
+                        help="Count hot path events (tiles, separating axis tests, merge iterations, pixels read "
+                             "by region filters, world to pixel conversions, catalog sources, blanking window "
+                             "sizes and convolutions) and log them at the end of the run. Events in worker "
+                             "processes (--processes) are not counted")
+    parser.add_argument("--profile-stage",
+                        type=str,
+                        default=None,
+                        choices=["tag_regions", "tag_lsm", "blank_components"],
+                        help="Run this stage under cProfile and dump the statistics to "
+                             "<--profile-prefix>.<stage>.pstats")
+    parser.add_argument("--profile-prefix",
+                        type=str,
+                        default="catdagger",
+                        help="Path prefix of the cProfile statistics written with --profile-stage")
+    parser.add_argument("--single-precision",
+                        action="store_true",
+                        help="Hold the band averaged image and model cubes in native float32. Channel "
+                             "sums and tile statistics are still accumulated in float64")
+    return parser
+
+def run(args):
+    """ 
+        Runs the tagging pipeline for parsed arguments
+        Returns a summary of the tagged regions and timings of the stages 
+    """
+    tic = time.time()
+    timings = {}
+    if args.counters:
+        counters.enable()
+    try:
+        exclusion_zones = [exclz for exclz in args.add_custom_exclusion_zone] \
+            if args.add_custom_exclusion_zone is not None else []
+        if args.add_custom_sky_exclusion_zone is not None:
+            exclusion_zones += args.add_custom_sky_exclusion_zone
+        if args.exclusion_zones_ds9_reg_file is not None:
+            for regfn in args.exclusion_zones_ds9_reg_file:
+                exclusion_zones += read_ds9_exclusion_zones(regfn)
+        if args.state_file is not None and (args.stack_time_slots or args.mosaic or args.analyse_stokes is not None):
+            raise ValueError("--state-file is not supported with --analyse-stokes, --stack-time-slots or --mosaic")
+        if args.roi_box is not None and args.roi_sky is not None:
+            raise ValueError("Only one of --roi-box and --roi-sky may be given")
+        roi = args.roi_box if args.roi_box is not None else args.roi_sky
+        if roi is not None and (args.stack_time_slots or args.analyse_stokes is not None):
+            raise ValueError("Regions of interest are not supported with --analyse-stokes or --stack-time-slots")
+        if args.preview is not None and (args.stack_time_slots or args.mosaic or args.analyse_stokes is not None or
+                                         args.state_file is not None or roi is not None):
+            raise ValueError("--preview is not supported with --analyse-stokes, --stack-time-slots, --mosaic, "
+                             "--state-file or regions of interest")
+        if args.compress_model_images is not None and \
+           args.remove_tagged_dE_components_from_model_images is not None:
             for mod in args.remove_tagged_dE_components_from_model_images:
-                blank_components(mod,
-                                 args.noise_map[0],
-                                 args.psf_image[0],
-                                 sources,
-                                 hdu_id=0,
-                                 use_stokes=args.stokes)
+                check_compression(mod, 0, args.compress_model_images)
+        preview_confidence = None
+        matched_beam = None
+        if args.beam_matched_filter:
+            if args.psf_image is None:
+                raise ValueError("--beam-matched-filter requires --psf-image")
+            if args.preview is not None or args.stack_time_slots or args.mosaic or args.analyse_stokes is not None:
+                raise ValueError("--beam-matched-filter is not supported with --preview, --analyse-stokes, "
+                                 "--mosaic or --stack-time-slots")
+            matched_beam = get_fitted_beam(args.psf_image[0], 0, nprocs=args.processes, use_stokes=args.stokes)
+        with counters.profiled("tag_regions", args.profile_stage, args.profile_prefix):
+            if args.stack_time_slots:
+                tagged_regions = tag_time_slices(args.noise_map,
+                                                 regionsfn = args.ds9_reg_file,
+                                                 heatmapfn = args.time_slot_heat_map,
+                                                 sigma = args.sigma,
+                                                 block_size = args.tile_size,
+                                                 hdu_id = 0,
+                                                 use_stokes = args.stokes,
+                                                 global_stat_percentile = args.global_rms_percentile,
+                                                 min_blocks_in_region = args.min_tiles_region,
+                                                 min_distance_from_centre = args.min_distance_from_tracking_centre,
+                                                 exclusion_zones=exclusion_zones,
+                                                 min_slots=args.min_slots_exceeded,
+                                                 max_memory=args.max_memory,
+                                                 nthreads=args.threads,
+                                                 single_precision=args.single_precision,
+                                                 labelfn=args.label_image)
+            elif args.mosaic:
+                if args.label_image is not None:
+                    raise ValueError("--label-image cannot be combined with --mosaic")
+                tagged_regions, mosaic_frame = tag_mosaic(args.noise_map,
+                                                          regionsfn = args.ds9_reg_file,
+                                                          nprocs=args.processes,
+                                                          sigma = args.sigma,
+                                                          block_size = args.tile_size,
+                                                          hdu_id = 0,
+                                                          use_stokes = args.stokes,
+                                                          global_stat_percentile = args.global_rms_percentile,
+                                                          min_blocks_in_region = args.min_tiles_region,
+                                                          min_distance_from_centre = args.min_distance_from_tracking_centre,
+                                                          exclusion_zones=exclusion_zones,
+                                                          max_right_skewness=args.max_region_right_skewness,
+                                                          max_abs_skewness=args.max_region_abs_skewness,
+                                                          max_positive_to_negative_flux=args.max_positive_to_negative_flux,
+                                                          max_memory=args.max_memory,
+                                                          nthreads=args.threads,
+                                                          single_precision=args.single_precision,
+                                                          roi=roi)
+            elif args.analyse_stokes is not None:
+                if args.max_memory is not None:
+                    raise ValueError("--analyse-stokes cannot be combined with --max-memory")
+                _, tagged_regions = tag_stokes_regions(args.noise_map[0],
+                                                       regionsfn = args.ds9_reg_file,
+                                                       sigma = args.sigma,
+                                                       block_size = args.tile_size,
+                                                       hdu_id = 0,
+                                                       use_stokes = args.analyse_stokes,
+                                                       noise_stokes = args.stokes,
+                                                       culling_stokes = args.culling_stokes,
+                                                       global_stat_percentile = args.global_rms_percentile,
+                                                       min_blocks_in_region = args.min_tiles_region,
+                                                       min_distance_from_centre = args.min_distance_from_tracking_centre,
+                                                       exclusion_zones=exclusion_zones,
+                                                       max_right_skewness=args.max_region_right_skewness,
+                                                       max_abs_skewness=args.max_region_abs_skewness,
+                                                       max_positive_to_negative_flux=args.max_positive_to_negative_flux,
+                                                       nthreads=args.threads,
+                                                       single_precision=args.single_precision,
+                                                       labelfn=args.label_image,
+                                                       nprocs=args.processes)
+            elif args.preview is not None:
+                tagged_regions, preview_confidence = tag_preview(args.noise_map[0],
+                                                                 decimation=args.preview,
+                                                                 regionsfn = args.ds9_reg_file,
+                                                                 sigma = args.sigma,
+                                                                 block_size = args.tile_size,
+                                                                 hdu_id = 0,
+                                                                 use_stokes = args.stokes,
+                                                                 global_stat_percentile = args.global_rms_percentile,
+                                                                 min_blocks_in_region = args.min_tiles_region,
+                                                                 min_distance_from_centre = args.min_distance_from_tracking_centre,
+                                                                 exclusion_zones=exclusion_zones,
+                                                                 max_right_skewness=args.max_region_right_skewness,
+                                                                 max_abs_skewness=args.max_region_abs_skewness,
+                                                                 max_positive_to_negative_flux=args.max_positive_to_negative_flux,
+                                                                 nthreads=args.threads,
+                                                                 single_precision=args.single_precision,
+                                                                 labelfn=args.label_image,
+                                                                 nprocs=args.processes)
+            else:
+                tagged_regions = tag_regions(args.noise_map[0],
+                                             regionsfn = args.ds9_reg_file,
+                                             sigma = args.sigma,
+                                             block_size = args.tile_size,
+                                             hdu_id = 0,
+                                             use_stokes = args.stokes,
+                                             global_stat_percentile = args.global_rms_percentile,
+                                             min_blocks_in_region = args.min_tiles_region,
+                                             min_distance_from_centre = args.min_distance_from_tracking_centre,
+                                             exclusion_zones=exclusion_zones,
+                                             max_right_skewness=args.max_region_right_skewness,
+                                             max_abs_skewness=args.max_region_abs_skewness,
+                                             max_positive_to_negative_flux=args.max_positive_to_negative_flux,
+                                             max_memory=args.max_memory,
+                                             nthreads=args.threads,
+                                             single_precision=args.single_precision,
+                                             labelfn=args.label_image,
+                                             nprocs=args.processes,
+                                             statefn=args.state_file,
+                                             state_tolerance=args.state_tolerance,
+                                             roi=roi,
+                                             matched_beam=matched_beam)
+        timings["tag_regions"] = time.time() - tic
+        ntagged_sources = None
+        if args.input_lsm is not None:
+            with counters.profiled("tag_lsm", args.profile_stage, args.profile_prefix):
+                sources = tag_lsm(args.input_lsm[0],
+                                  args.noise_map[0],
+                                  tagged_regions,
+                                  hdu_id=0,
+                                  regionsfn = args.ds9_tag_reg_file,
+                                  taggedlsm_fn=args.input_lsm[0] + ".de_tagged.lsm.html",
+                                  de_tag=args.de_tag_name,
+                                  store_only_dEs=args.only_dEs_in_lsm,
+                                  w=mosaic_frame if args.mosaic else None,
+                                  statefn=args.state_file)
+            ntagged_sources = len(filter(lambda s: args.de_tag_name in s.getTagNames(), sources))
+            timings["tag_lsm"] = time.time() - tic - sum(timings.values())
+            if args.remove_tagged_dE_components_from_model_images is not None:
+                with counters.profiled("blank_components", args.profile_stage, args.profile_prefix):
+                    for mod in args.remove_tagged_dE_components_from_model_images:
+                        blank_components(mod,
+                                         args.noise_map[0],
+                                         args.psf_image[0],
+                                         sources,
+                                         hdu_id=0,
+                                         use_stokes=args.stokes,
+                                         bulk=args.blank_fft,
+                                         nthreads=args.threads,
+                                         single_precision=args.single_precision,
+                                         compression_type=args.compress_model_images,
+                                         per_channel_beams=args.per_channel_psf_fit,
+                                         nprocs=args.processes,
+                                         backup=None if args.model_image_backup == "none" else args.model_image_backup)
+                timings["blank_components"] = time.time() - tic - sum(timings.values())
+        toc = time.time()
+        hot_path_counters = counters.snapshot()
+        if args.counters:
+            counters.report()
+        return {"regions": [{"name": reg.name,
+                             "sigma": float(reg.area_sigma),
+                             "corners": reg.corners.tolist()} for reg in tagged_regions],
+                "ntagged_sources": ntagged_sources,
+                "timings": timings,
+                "counters": hot_path_counters,
+                "preview": preview_confidence,
+                "elapsed": toc - tic}
+    finally:
+        # never leave counters on for the next job of a long lived server
+        counters.disable()
+
+def main():
+    args = build_parser().parse_args()
+    tic = int(time.time())
+    run(args)
     toc = int(time.time())
     print>>log, "CATDagger ran successfully in {0:.0f}:{1:02.0f} minutes".format((toc - tic) // 60,
                                                                                  (toc - tic) % 60)
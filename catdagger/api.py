@@ -0,0 +1,181 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    In-memory library entry point
+
+    Runs region tagging, source tagging and model blanking on NumPy arrays
+    and astropy WCS objects without touching disk, unless output filenames
+    are given
+"""
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCSSUB_CELESTIAL, WCSSUB_SPECTRAL
+from catdagger import logger
+from catdagger.tiled_tesselator import tag_image_regions, write_regions_file
+from catdagger.lsm_tools import source_table, tag_source_table, tag_sources
+from catdagger.fits_tools import blank_source_table
+from catdagger.parallel import thread_map, row_chunks
+log = logger.getLogger("api")
+
+def band_average(image, nthreads=1):
+    """
+        Averages a (nchan, ny, nx) cube over channels, summing in float64 like
+        the FITS reader so that results match the command line. 2D images are
+        returned as is (no copy)
+    """
+    image = np.asarray(image)
+    if image.ndim == 2:
+        return image
+    if image.ndim != 3:
+        raise ValueError("Image must be 2D (ny, nx) or 3D (nchan, ny, nx)")
+    band_dtype = image.dtype.newbyteorder("=") if image.dtype.kind == "f" else np.float64
+    return np.concatenate(thread_map(lambda rows: np.mean(image[:, rows[0]:rows[1], :], axis=0,
+                                                          dtype=np.float64).astype(band_dtype),
+                                     row_chunks(image.shape[1], nthreads),
+                                     nthreads),
+                          axis=0)
+
+def _as_source_table(sources):
+    """
+        Accepts a Tigger model, a list of Tigger sources or a table (dict or
+        structured array) with ra, dec (degrees), flux and optionally ex, ey, pa (radians)
+    """
+    if hasattr(sources, "sources"):
+        sources = sources.sources
+    if isinstance(sources, list):
+        return source_table(sources), sources
+    nsrc = len(sources["ra"])
+    names = sources.dtype.names if hasattr(sources, "dtype") else sources.keys()
+    table = {}
+    for k in ["ra", "dec", "flux", "ex", "ey", "pa"]:
+        table[k] = np.asarray(sources[k], dtype=np.float64) if k in names else np.zeros(nsrc)
+    return table, None
+
+def region_table(tagged_regions):
+    """ Structured array summarising tagged regions """
+    tab = np.zeros(len(tagged_regions), dtype=[("name", object),
+                                               ("sigma", np.float64),
+                                               ("area", np.float64),
+                                               ("centre_x", np.float64),
+                                               ("centre_y", np.float64),
+                                               ("corners", object)])
+    for i, reg in enumerate(tagged_regions):
+        tab[i] = (reg.name, reg.area_sigma, reg.area, reg.centre[0], reg.centre[1], reg.corners)
+    return tab
+
+def tag_image(image,
+              w,
+              sources=None,
+              model_images=[],
+              beam=None,
+              regionsfn=None,
+              labelfn=None,
+              tag_regionsfn=None,
+              taggedlsm_fn=None,
+              model_fns=None,
+              de_tag="dE",
+              sigma=2.3,
+              block_size=80,
+              global_stat_percentile=30.0,
+              min_blocks_in_region=3,
+              min_distance_from_centre=0,
+              exclusion_zones=[],
+              max_right_skewness=np.inf,
+              max_abs_skewness=np.inf,
+              max_positive_to_negative_flux=np.inf,
+              nthreads=1,
+              nprocs=1):
+    """
+        Tags regions and sources given a residual in memory
+
+        image: 2D (ny, nx) band averaged residual or 3D (nchan, ny, nx) residual cube
+        w: astropy WCS of the image (only the celestial axes are used)
+        sources: optional Tigger model / list of Tigger sources or table with
+                 ra, dec (degrees), flux and optionally ex, ey, pa (radians) columns.
+                 Tigger sources are tagged in place
+        model_images: (nchan, ny, nx) model arrays to blank in place within beam
+                      (BMIN, BMAJ, BPA in degrees) of the tagged sources
+        regionsfn, tag_regionsfn, taggedlsm_fn: optional DS9 region / LSM outputs
+        labelfn: optional FITS label image output of the tagged regions
+        model_fns: optional FITS filenames to write the blanked models to. Requires w
+                   to have a spectral axis, which is written along with the celestial axes
+
+        Returns a dictionary with the region objects ("regions"), a structured
+        region table ("region_table"), per region source indices ("members"),
+        cluster lead indices ("leads"), all tagged source indices ("tagged") and
+        per model the integrated flux blanked per tagged source ("blanked_flux")
+    """
+    if model_fns is not None and w.wcs.spec < 0:
+        raise ValueError("Writing model FITS files requires a WCS with a spectral axis")
+    band_avg = band_average(image, nthreads=nthreads)
+    tagged_regions = tag_image_regions(band_avg,
+                                       w,
+                                       regionsfn=regionsfn,
+                                       sigma=sigma,
+                                       block_size=block_size,
+                                       global_stat_percentile=global_stat_percentile,
+                                       min_blocks_in_region=min_blocks_in_region,
+                                       min_distance_from_centre=min_distance_from_centre,
+                                       exclusion_zones=exclusion_zones,
+                                       max_right_skewness=max_right_skewness,
+                                       max_abs_skewness=max_abs_skewness,
+                                       max_positive_to_negative_flux=max_positive_to_negative_flux,
+                                       nthreads=nthreads,
+                                       labelfn=labelfn,
+                                       nprocs=nprocs)
+    result = {"regions": tagged_regions,
+              "region_table": region_table(tagged_regions),
+              "members": [],
+              "leads": [],
+              "tagged": np.zeros(0, dtype=np.int64),
+              "blanked_flux": []}
+    if sources is None:
+        return result
+    table, tigger_sources = _as_source_table(sources)
+    if tigger_sources is not None:
+        members, leads = tag_sources(tigger_sources, w, tagged_regions,
+                                     regionsfn=tag_regionsfn, de_tag=de_tag)
+        if taggedlsm_fn is not None:
+            if not hasattr(sources, "save"):
+                raise ValueError("taggedlsm_fn can only be written for Tigger models")
+            print>>log, "Writing tagged LSM to {0:s}".format(taggedlsm_fn)
+            sources.save(taggedlsm_fn)
+    else:
+        members, leads, _, _ = tag_source_table(table, w, tagged_regions)
+    tagged = np.unique(np.concatenate(members)) if len(members) > 0 else np.zeros(0, dtype=np.int64)
+    result["members"] = members
+    result["leads"] = leads
+    result["tagged"] = tagged
+    if len(model_images) > 0 and beam is None:
+        raise ValueError("Fitted beam (BMIN, BMAJ, BPA) must be given to blank model images")
+    if model_fns is not None:
+        # (nchan, ny, nx) models are written with exactly the axes (RA, DEC, FREQ)
+        model_header = w.sub([WCSSUB_CELESTIAL, WCSSUB_SPECTRAL]).to_header()
+    for imod, mod in enumerate(model_images):
+        mod = mod if mod.ndim == 3 else mod[None, :, :]
+        result["blanked_flux"].append(blank_source_table(mod, w, beam, table, indices=tagged))
+        if model_fns is not None:
+            print>>log, "Saving model FITS to disk: {0:s}".format(model_fns[imod])
+            fits.PrimaryHDU(mod, header=model_header).writeto(model_fns[imod], overwrite=True)
+    return result
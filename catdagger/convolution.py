@@ -0,0 +1,134 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import numpy as np
+import scipy.ndimage as ndimage
+from astropy.wcs.utils import proj_plane_pixel_scales
+from catdagger import logger
+from catdagger import counters
+from catdagger.gauss2 import twodgaussian
+from catdagger.psf_fitting import FWHM_PER_SIGMA
+from catdagger.parallel import thread_map, row_chunks
+log = logger.getLogger("convolution")
+
+# scipy.fft (scipy >= 1.4) supports multithreaded transforms,
+# otherwise fall back to the single threaded numpy transforms
+try:
+    import scipy.fft as _fft
+    _HAS_WORKERS = True
+except ImportError:
+    import numpy.fft as _fft
+    _HAS_WORKERS = False
+
+try:
+    from scipy.fftpack import next_fast_len
+except ImportError:
+    next_fast_len = lambda n: n
+
+def _rfft2(a, shape, nthreads):
+    if _HAS_WORKERS:
+        return _fft.rfft2(a, shape, workers=nthreads)
+    return _fft.rfft2(a, shape)
+
+def _irfft2(a, shape, nthreads):
+    if _HAS_WORKERS:
+        return _fft.irfft2(a, shape, workers=nthreads)
+    return _fft.irfft2(a, shape)
+
+def fft_convolve(image, kernel, nthreads=1):
+    """
+        Linear (zero padded) convolution of a 2D image with a 2D kernel using
+        real FFTs. The result has the shape of the image, with the kernel
+        centred on index shape // 2 as with scipy.signal.convolve mode="same"
+    """
+    counters.count("fft_convolutions")
+    shape = [next_fast_len(image.shape[i] + kernel.shape[i] - 1) for i in range(2)]
+    conv = _irfft2(_rfft2(image, shape, nthreads) * _rfft2(kernel, shape, nthreads),
+                   shape, nthreads)
+    offx = (kernel.shape[0] - 1) // 2
+    offy = (kernel.shape[1] - 1) // 2
+    return conv[offx:offx + image.shape[0], offy:offy + image.shape[1]]
+
+def separable_convolve(image, kernel, nthreads=1):
+    """
+        Linear (zero padded) convolution of a 2D image with the outer product
+        of an odd length 1D kernel with itself, as two 1D passes over the
+        rows and columns, each split over nthreads threads. Same centering
+        as fft_convolve
+    """
+    counters.count("separable_convolutions")
+    rows = np.empty(image.shape, dtype=np.float64)
+    conv = np.empty(image.shape, dtype=np.float64)
+    def __rows(chunk):
+        lo, hi = chunk
+        ndimage.convolve1d(image[lo:hi, :], kernel, axis=1, output=rows[lo:hi, :], mode="constant")
+    def __cols(chunk):
+        lo, hi = chunk
+        ndimage.convolve1d(rows[:, lo:hi], kernel, axis=0, output=conv[:, lo:hi], mode="constant")
+    thread_map(__rows, row_chunks(image.shape[0], nthreads), nthreads)
+    thread_map(__cols, row_chunks(image.shape[1], nthreads), nthreads)
+    return conv
+
+def beam_kernel(bmin, bmaj, bpa, w, circularity=0.9):
+    """
+        Unit sum kernel of the fitted beam (BMIN, BMAJ, BPA in degrees as
+        returned by fits_tools.get_fitted_beam) on the pixel grid of w, 
+        truncated at 4 sigma. If BMIN / BMAJ >= circularity the beam is 
+        approximated by a circular gaussian of the same area and the 1D 
+        kernel of its separable form is returned instead.
+        Returns the kernel and whether it is separable
+    """
+    cdelt = float(np.max(np.abs(proj_plane_pixel_scales(w.celestial))))
+    smaj = bmaj / cdelt / FWHM_PER_SIGMA
+    smin = bmin / cdelt / FWHM_PER_SIGMA
+    half = int(np.ceil(4.0 * smaj))
+    offsets = np.arange(-half, half + 1)
+    if bmin >= circularity * bmaj:
+        kernel = np.exp(-0.5 * offsets**2 / (smaj * smin))
+        return kernel / np.sum(kernel), True
+    # inverse of psf_fitting.beam_from_fit: the major axis lies along the
+    # gaussian's first (row) axis rotated by rota
+    east = 1.0 if w.celestial.wcs.cdelt[0] < 0 else -1.0
+    x, y = np.meshgrid(offsets, offsets, indexing="ij")
+    kernel = twodgaussian([1.0, 0, 0, smaj, smin, east * bpa], circle=0, rotate=1, vheight=0)(x, y)
+    return kernel / np.sum(kernel), False
+
+def beam_filter(image, w, beam, nthreads=1, circularity=0.9):
+    """
+        Convolves a 2D image with its fitted beam (BMIN, BMAJ, BPA in degrees),
+        separably if the beam is nearly circular (see beam_kernel) otherwise
+        with nthreads multithreaded real FFTs. Blanked (NaN) pixels are 
+        zeroed for the convolution and remain blanked
+    """
+    tic = time.time()
+    kernel, separable = beam_kernel(beam[0], beam[1], beam[2], w, circularity)
+    blanked = np.isnan(image)
+    filled = np.where(blanked, 0.0, image)
+    conv = separable_convolve(filled, kernel, nthreads) if separable else \
+           fft_convolve(filled, kernel, nthreads)
+    conv[blanked] = np.nan
+    print>>log, "Convolved the band averaged image with the {0:.2f}x{1:.2f} arcsec beam ({2:s} {3:d} px " \
+                "kernel) in {4:.2f} s".format(beam[1] * 3600.0, beam[0] * 3600.0,
+                                              "separable" if separable else "FFT", kernel.shape[0],
+                                              time.time() - tic)
+    return conv.astype(image.dtype)
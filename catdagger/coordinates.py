@@ -0,0 +1,85 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import collections
+import numpy as np
+from catdagger import logger
+from catdagger import counters
+log = logger.getLogger("coordinates")
+
+# pixel positions of the most recently converted catalogs, keyed on WCS,
+# origin and catalog digest, least recently used first
+_pixel_cache = collections.OrderedDict()
+PIXEL_CACHE_SIZE = 16
+
+def has_distortion(w):
+    """ True if the WCS carries SIP or lookup table distortions """
+    return any([getattr(w, attr, None) is not None
+                for attr in ["sip", "cpdis1", "cpdis2", "det2im1", "det2im2"]])
+
+def _wcs_key(w):
+    c = w.celestial
+    return (tuple(c.wcs.ctype), tuple(c.wcs.crval), tuple(c.wcs.crpix),
+            tuple(c.wcs.cdelt), tuple(c.wcs.get_pc().ravel()),
+            id(w) if has_distortion(w) else None)
+
+def same_grid(w1, w2):
+    """ True if the celestial axes of two WCSs describe the same pixel grid """
+    c1 = w1.celestial.wcs
+    c2 = w2.celestial.wcs
+    return tuple(c1.ctype) == tuple(c2.ctype) and \
+           all([np.allclose(a, b) for a, b in [(c1.crval, c2.crval),
+                                                (c1.crpix, c2.crpix),
+                                                (c1.cdelt, c2.cdelt),
+                                                (c1.get_pc(), c2.get_pc())]])
+
+def world2pix(w, ra, dec, origin=1):
+    """
+        Converts catalog positions ra, dec (degrees) to pixels on the celestial
+        axes of w in one batched call, using the iterative all_world2pix
+        solver only if the WCS has distortion terms. The pixel positions of
+        the PIXEL_CACHE_SIZE catalogs converted last are cached per grid, so
+        later stages converting the same catalog on the same grid only pay
+        for digesting its positions
+        Returns arrays x, y
+    """
+    ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+    dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+    digest = hashlib.sha1(np.ascontiguousarray(ra).tobytes())
+    digest.update(np.ascontiguousarray(dec).tobytes())
+    key = (_wcs_key(w), origin, ra.shape, digest.hexdigest())
+    if key in _pixel_cache:
+        x, y = _pixel_cache.pop(key)
+    else:
+        c = w.celestial
+        counters.count("all_world2pix_calls" if has_distortion(c) else "wcs_world2pix_calls")
+        counters.count("world2pix_positions", ra.size)
+        radec = np.column_stack([ra.ravel(), dec.ravel()])
+        pix = c.all_world2pix(radec, origin) if has_distortion(c) else \
+              c.wcs_world2pix(radec, origin)
+        x = pix[:, 0].copy()
+        y = pix[:, 1].copy()
+    _pixel_cache[key] = (x, y)
+    while len(_pixel_cache) > PIXEL_CACHE_SIZE:
+        _pixel_cache.popitem(last=False)
+    return x.copy(), y.copy()
@@ -0,0 +1,101 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import cProfile
+import threading
+from catdagger import logger
+log = logger.getLogger("counters")
+
+# opt-in hot path counters: name -> [number of events, sum, max] of the
+# observed values. Disabled (None) by default so that instrumented code only
+# pays for a global lookup. Counters are per process, events in worker
+# processes are not collected
+_counters = None
+_lock = threading.Lock()
+
+def enable():
+    """ Starts (or restarts) collecting counters """
+    global _counters
+    _counters = {}
+
+def disable():
+    global _counters
+    _counters = None
+
+def enabled():
+    return _counters is not None
+
+def count(name, n=1):
+    """ Adds n to counter name """
+    observe(name, n)
+
+def observe(name, value):
+    """ Records one event of size value (e.g. a window size) under name """
+    if _counters is None:
+        return
+    with _lock:
+        c = _counters.setdefault(name, [0, 0, value])
+        c[0] += 1
+        c[1] += value
+        c[2] = max(c[2], value)
+
+def snapshot():
+    """ Returns {name: {"events", "total", "max"}} of the counters collected """
+    if _counters is None:
+        return {}
+    with _lock:
+        return {k: {"events": c[0], "total": c[1], "max": c[2]} for k, c in _counters.items()}
+
+def report():
+    """ Logs the counters collected """
+    counters = snapshot()
+    if len(counters) == 0:
+        return
+    print>>log, "Hot path counters (events, total, max):"
+    for k in sorted(counters.keys()):
+        print>>log, "\t - {0:s}: {1:d}, {2:s}, {3:s}".format(k, counters[k]["events"],
+                                                           str(counters[k]["total"]),
+                                                           str(counters[k]["max"]))
+
+class profiled(object):
+    """
+        Context manager running the body of a stage under cProfile if the 
+        stage is the one chosen for profiling, dumping the statistics to 
+        <prefix>.<stage>.pstats
+    """
+    def __init__(self, stage, profile_stage=None, prefix="catdagger"):
+        self._stage = stage
+        self._profiler = cProfile.Profile() if stage == profile_stage else None
+        self._fn = "{0:s}.{1:s}.pstats".format(prefix, stage)
+
+    def __enter__(self):
+        if self._profiler is not None:
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self._fn)
+            print>>log, "Writing profile of stage {0:s} to {1:s}".format(self._stage, self._fn)
+        return False
@@ -0,0 +1,189 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import numpy as np
+from astropy import units
+from astropy.coordinates import Angle, SkyCoord
+from astropy.wcs.utils import proj_plane_pixel_scales
+from catdagger import logger
+from catdagger.coordinates import world2pix
+log = logger.getLogger("exclusion_zones")
+
+class CircularExclusionZone():
+    """ Circle of radius (px) around pixel (cx, cy) """
+    def __init__(self, cx, cy, radius):
+        self._cx = float(cx)
+        self._cy = float(cy)
+        self._radius = float(radius)
+
+    def __str__(self):
+        return "circle ({0:.2f}, {1:.2f}, {2:.2f} px)".format(self._cx, self._cy, self._radius)
+
+    def to_pixel(self, w):
+        return self
+
+    def contains(self, x, y):
+        """ vectorized test of pixel positions x, y against the zone """
+        return (x - self._cx)**2 + (y - self._cy)**2 < self._radius**2
+
+class PolygonExclusionZone():
+    """ Polygon with pixel vertices [[x0, y0], [x1, y1], ...] """
+    def __init__(self, vertices):
+        self._vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        if self._vertices.shape[0] < 3:
+            raise ValueError("Polygon exclusion zone needs at least 3 vertices")
+
+    def __str__(self):
+        return "polygon with {0:d} vertices".format(self._vertices.shape[0])
+
+    def to_pixel(self, w):
+        return self
+
+    def contains(self, x, y):
+        """ vectorized even-odd ray casting test of pixel positions x, y """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        inside = np.zeros(np.broadcast(x, y).shape, dtype=np.bool)
+        vx = self._vertices[:, 0]
+        vy = self._vertices[:, 1]
+        for i in range(self._vertices.shape[0]):
+            j = i - 1
+            crosses = (vy[i] > y) != (vy[j] > y)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                xint = (vx[j] - vx[i]) * (y - vy[i]) / (vy[j] - vy[i]) + vx[i]
+                inside ^= np.logical_and(crosses, x < xint)
+        return inside
+
+class SkyCircularExclusionZone():
+    """ Circle of radius (deg) around sky position (ra, dec) in degrees """
+    def __init__(self, ra, dec, radius):
+        self._ra = float(ra)
+        self._dec = float(dec)
+        self._radius = float(radius)
+
+    def __str__(self):
+        return "sky circle ({0:.4f}, {1:.4f}, {2:.4f} deg)".format(self._ra, self._dec, self._radius)
+
+    def to_pixel(self, w):
+        x, y = world2pix(w, self._ra, self._dec, 0)
+        scale = np.max(np.abs(proj_plane_pixel_scales(w.celestial)))
+        return CircularExclusionZone(x[0], y[0], self._radius / scale)
+
+class SkyPolygonExclusionZone():
+    """ Polygon with sky vertices [[ra0, dec0], [ra1, dec1], ...] in degrees """
+    def __init__(self, vertices):
+        self._vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+
+    def __str__(self):
+        return "sky polygon with {0:d} vertices".format(self._vertices.shape[0])
+
+    def to_pixel(self, w):
+        return PolygonExclusionZone(np.column_stack(world2pix(w, self._vertices[:, 0], self._vertices[:, 1], 0)))
+
+def as_exclusion_zone(zone):
+    """ Accepts zone objects and legacy (cx, cy, radius) pixel tripples """
+    if hasattr(zone, "to_pixel"):
+        return zone
+    cx, cy, exclrad = zone
+    return CircularExclusionZone(cx, cy, exclrad)
+
+_DS9_PIXEL_SYSTEMS = ["image", "physical"]
+_DS9_SKY_SYSTEMS = {"fk5": "fk5", "j2000": "fk5", "icrs": "icrs", "fk4": "fk4", "b1950": "fk4", "galactic": "galactic"}
+
+def _ds9_sky_angle(val, is_lon):
+    if ":" in val or "h" in val:
+        return Angle(val, unit=units.hourangle if is_lon else units.deg).deg
+    return Angle(val.rstrip("d"), unit=units.deg).deg
+
+def _ds9_sky_size(val):
+    if val.endswith("\""):
+        return float(val[:-1]) / 3600.0
+    if val.endswith("'"):
+        return float(val[:-1]) / 60.0
+    return float(val.rstrip("d"))
+
+def _ds9_to_fk5_deg(lon, lat, frame):
+    if frame == "fk5":
+        return lon, lat
+    c = SkyCoord(lon, lat, unit="deg", frame=frame).fk5
+    return c.ra.deg, c.dec.deg
+
+def read_ds9_exclusion_zones(fn):
+    """
+        Reads circle and polygon shapes from a SAODS9 region file
+
+        Image / physical coordinates are taken as 1-based DS9 pixels,
+        fk5, icrs, fk4 and galactic coordinates are converted to fk5 degrees
+    """
+    zones = []
+    coordsys = "physical"
+    with open(fn) as f:
+        for line in f:
+            for stmt in line.split("#")[0].split(";"):
+                stmt = stmt.strip().lstrip("+-")
+                if stmt == "" or stmt.startswith("global"):
+                    continue
+                if stmt.lower() in _DS9_PIXEL_SYSTEMS or stmt.lower() in _DS9_SKY_SYSTEMS:
+                    coordsys = stmt.lower()
+                    continue
+                m = re.match(r"^(circle|polygon)\s*\((.*)\)", stmt, re.IGNORECASE)
+                if m is None:
+                    print>>log, "\t - Ignoring unsupported DS9 region '{0:s}' in {1:s}".format(stmt, fn)
+                    continue
+                shape = m.group(1).lower()
+                vals = [v.strip() for v in m.group(2).split(",")]
+                if coordsys in _DS9_PIXEL_SYSTEMS:
+                    vals = map(float, vals)
+                    if shape == "circle":
+                        zones.append(CircularExclusionZone(vals[0] - 1, vals[1] - 1, vals[2]))
+                    else:
+                        zones.append(PolygonExclusionZone(np.array(vals).reshape(-1, 2) - 1))
+                else:
+                    frame = _DS9_SKY_SYSTEMS[coordsys]
+                    if shape == "circle":
+                        ra, dec = _ds9_to_fk5_deg(_ds9_sky_angle(vals[0], frame != "galactic"),
+                                                   _ds9_sky_angle(vals[1], False),
+                                                   frame)
+                        zones.append(SkyCircularExclusionZone(ra, dec, _ds9_sky_size(vals[2])))
+                    else:
+                        verts = [_ds9_to_fk5_deg(_ds9_sky_angle(lon, frame != "galactic"),
+                                                  _ds9_sky_angle(lat, False),
+                                                  frame)
+                                 for lon, lat in zip(vals[0::2], vals[1::2])]
+                        zones.append(SkyPolygonExclusionZone(verts))
+    print>>log, "Read {0:d} exclusion zones from DS9 regions file {1:s}".format(len(zones), fn)
+    return zones
+
+def rasterise_exclusion_zones(exclusion_zones, bin_lower, bin_upper, w):
+    """
+        Rasterises exclusion zones onto the tile grid
+
+        A tile is excluded if its centre falls within any of the zones
+        Returns boolean mask of shape (ntiles_y, ntiles_x)
+    """
+    centres = 0.5 * (bin_lower + bin_upper)
+    tx, ty = np.meshgrid(centres, centres)
+    mask = np.zeros(tx.shape, dtype=np.bool)
+    for zone in exclusion_zones:
+        mask |= as_exclusion_zone(zone).to_pixel(w).contains(tx, ty)
+    return mask
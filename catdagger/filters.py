@@ -20,6 +20,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
 import numpy as np
 import scipy.stats as sstats
 import scipy.signal as ssig
@@ -28,7 +29,15 @@ from astropy import wcs
 from catdagger import logger
 log = logger.getLogger("filters")
 
+# Relative evaluation cost of a filter (its cost attribute) orders the filter
+# chain: geometric tests come before tests reading region pixels
+COST_GEOMETRIC = 0
+COST_PIXELS = 1
+COST_MOMENTS = 2
+
 class arealess():
+    cost = COST_GEOMETRIC
+
     def __init__(self, min_area=0):
         self._min_area = min_area
 
@@ -39,13 +48,16 @@ class arealess():
         return False
 
 class skewness_more():
+    cost = COST_MOMENTS
+
     def __init__(self, max_skewness=0, absskew=False):
         """ Absolute skewness """
         self._mskew = max_skewness
         self._abs = absskew
+        self.name = "abs_skewness_more" if absskew else "right_skewness_more"
 
     def __call__(self, reg):
-        skew = sstats.skew(np.array(reg.regional_data).flatten())
+        skew = sstats.skew(np.array(reg.regional_data, dtype=np.float64).flatten())
         modskew = np.abs(np.log10(np.abs(skew)))
         if not self._abs: modskew *= np.sign(skew)
         if modskew > self._mskew:
@@ -56,6 +68,8 @@ class skewness_more():
         return False
 
 class pos2neg_more():
+    cost = COST_PIXELS
+
     def __init__(self, max_positive_to_negative=1.5):
         """ Absolute skewness """
         self._maxrat = max_positive_to_negative
@@ -70,27 +84,76 @@ class pos2neg_more():
         return False
 
 
-class notin():
-    def __init__(self, discard_list):
-        self._dl = set(discard_list)
+# extra filters applied by the tiled tesselator in addition to its own
+_registered_filters = []
 
-    def __call__(self, reg):
-        return reg not in self._dl
+def register_filter(filt):
+    """
+        Registers a region filter to be applied when culling tagged regions.
+        A filter is a picklable callable returning True for regions to discard,
+        optionally with a cost attribute (default COST_MOMENTS) and a name
+    """
+    if not callable(filt):
+        raise TypeError("Region filters must be callable")
+    _registered_filters.append(filt)
+    return filt
+
+def unregister_filter(filt):
+    _registered_filters.remove(filt)
+
+def registered_filters():
+    return list(_registered_filters)
 
-class within_radius_from():
-    """ centre within radius of (x, y) px"""
-    def __init__(self, min_radius=0, cx=0, cy=0):
-        self._min_radius = min_radius
-        self._x = cx
-        self._y = cy
+def filter_name(filt):
+    return getattr(filt, "name", filt.__class__.__name__)
+
+class filter_chain():
+    """
+        Evaluates regions once through a chain of filters ordered by cost
+        (stable for equal costs), stopping at the first filter that fires. 
+        Records the filter rejecting each region and the number of regions
+        evaluated by and time spent in every filter
+    """
+    def __init__(self, filters):
+        self._filters = sorted(filters, key=lambda f: getattr(f, "cost", COST_MOMENTS))
+        self.rejected_by = {}
+        self.evaluated = [0] * len(self._filters)
+        self.elapsed = [0.0] * len(self._filters)
+
+    @property
+    def filters(self):
+        return self._filters
+
+    def evaluate(self, reg):
+        """ 
+            Returns the index of the first filter discarding reg (-1 if none)
+            and the time spent in each filter evaluated. Does not record
+        """
+        elapsed = []
+        for ifilt, filt in enumerate(self._filters):
+            tic = time.time()
+            discard = filt(reg)
+            elapsed.append(time.time() - tic)
+            if discard:
+                return ifilt, elapsed
+        return -1, elapsed
+
+    def record(self, reg, ifilt, elapsed):
+        for i, dt in enumerate(elapsed):
+            self.evaluated[i] += 1
+            self.elapsed[i] += dt
+        if ifilt >= 0:
+            self.rejected_by[reg.name] = filter_name(self._filters[ifilt])
 
     def __call__(self, reg):
-        if np.sum((reg.centre - np.array([self._x, self._y]))**2) < self._min_radius**2:
-            print>>log, "\t - Discarding region {0:s} because of its " \
-                        "radial proximity to exclusion zone " \
-                        "({1:.2f}, {2:.2f}, {3:.2f})".format(reg.name,
-                                                            self._x,
-                                                            self._y,
-                                                            self._min_radius)
-            return True
-        return False
\ No newline at end of file
+        ifilt, elapsed = self.evaluate(reg)
+        self.record(reg, ifilt, elapsed)
+        return ifilt >= 0
+
+    def report(self):
+        """ Logs the number of regions evaluated, rejected and the time spent per filter """
+        for i, filt in enumerate(self._filters):
+            name = filter_name(filt)
+            print>>log, "\t - Filter {0:s} evaluated {1:d} regions in {2:.3f} s, rejected {3:d}".format(
+                name, self.evaluated[i], self.elapsed[i], 
+                sum([1 for v in self.rejected_by.values() if v == name]))
@@ -20,12 +20,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import os
 import numpy as np
 from astropy.io import fits
 from astropy import wcs
+from astropy.wcs.utils import proj_plane_pixel_scales
 import scipy.signal as ssig
 from catdagger.gauss2 import twodgaussian
 from catdagger import logger
+from catdagger import counters
+from catdagger import kernels
+from catdagger.parallel import thread_map, row_chunks
+from catdagger.coordinates import world2pix
+from catdagger.convolution import fft_convolve
 log = logger.getLogger("FITS_tools")
 
 '''
@@ -50,12 +58,89 @@ FitsStokesTypes = {
     "YX": -8  #YX cross linear
 }
 
-def getcrpix(fn, hdu_id, use_stokes="I"):
-    stokes_cube = fn
-    with fits.open(stokes_cube) as img:
-        cube = img[hdu_id].data
-        hdr = img[hdu_id].header
-        w = wcs.WCS(hdr)
+_header_cache = {}
+
+def image_hdu(img, hdu_id=0):
+    """
+        Image HDU hdu_id of an open HDU list. Tile-compressed images stored
+        behind an empty primary HDU resolve to their CompImageHDU
+    """
+    hdu = img[hdu_id]
+    if hdu.header.get("NAXIS", 0) == 0 and len(img) > hdu_id + 1 and \
+       isinstance(img[hdu_id + 1], fits.CompImageHDU):
+        return img[hdu_id + 1]
+    return hdu
+
+def image_data(img, hdu_id=0, section=False):
+    """
+        Sliceable data of an image HDU that stays valid once the HDU list is
+        closed (unless section is set). Uncompressed images are memory mapped
+        (or read through sections). Tile-compressed images are decompressed
+        whole, or read through sections, which only decompress the tiles a 
+        slice overlaps, where astropy supports these (>= 5.3)
+    """
+    hdu = image_hdu(img, hdu_id)
+    if not isinstance(hdu, fits.CompImageHDU):
+        return hdu.section if section else hdu.data
+    if hdu.header["NAXIS"] > 3 and not nd_compression_supported():
+        raise ValueError("Tile-compressed images of more than 3 axes cannot be decompressed by this "
+                         "version of astropy")
+    if section:
+        if hasattr(hdu, "section"):
+            return hdu.section
+        print>>log, "WARNING: Sections of compressed images are not supported by this version " \
+                    "of astropy. Decompressing the full image"
+    return hdu.data
+
+_nd_compression = None
+
+def nd_compression_supported():
+    """
+        True if the installed astropy can tile-compress images of more than 
+        3 axes, such as FREQ, STOKES cubes (astropy 2.x cannot). Probed once
+        on a tiny in-memory image
+    """
+    global _nd_compression
+    if _nd_compression is None:
+        try:
+            fits.HDUList([fits.PrimaryHDU(),
+                          fits.CompImageHDU(np.zeros((1, 1, 2, 2), dtype=np.float32))]).writeto(io.BytesIO())
+            _nd_compression = True
+        except RuntimeError:
+            _nd_compression = False
+    return _nd_compression
+
+def check_compression(fn, hdu_id=0, compression_type=None):
+    """ Raises a ValueError if image fn cannot be written tile-compressed with compression_type """
+    if compression_type is None:
+        return
+    hdr, _ = read_header(fn, hdu_id)
+    if hdr["NAXIS"] > 3 and not nd_compression_supported():
+        raise ValueError("Cannot compress {0:s} with {1:s}: tile compression of images of more than 3 "
+                         "axes is not supported by this version of astropy".format(fn, compression_type))
+
+def read_header(fn, hdu_id=0):
+    """
+        Header and WCS of an HDU, cached on path and modification time so
+        that resident processes do not reparse unchanged files
+    """
+    st = os.stat(fn)
+    key = (os.path.abspath(fn), hdu_id, st.st_mtime, st.st_size)
+    if key not in _header_cache:
+        if len(_header_cache) > 256:
+            _header_cache.clear()
+        with fits.open(fn) as img:
+            hdr = image_hdu(img, hdu_id).header
+        _header_cache[key] = (hdr, wcs.WCS(hdr))
+    return _header_cache[key]
+
+def stokes_axes(hdr, use_stokes="I"):
+    """
+        FITS axis numbers (keyed on CTYPE) of a cube with FREQ, STOKES and 
+        RA and DEC ---SIN axes, and the index of use_stokes along its Stokes
+        axis. use_stokes may be a list, in which case a list of indices is
+        returned
+    """
     types = {hdr["CTYPE{0:d}".format(ax + 1)]: (ax + 1) for ax in range(hdr["NAXIS"])}
     if set(types.keys()) != set(["FREQ", "STOKES", "RA---SIN", "DEC--SIN"]):
         raise TypeError("FITS must have FREQ, STOKES and RA and DEC ---SIN axes")
@@ -63,157 +148,558 @@ def getcrpix(fn, hdu_id, use_stokes="I"):
                             (hdr["NAXIS{0:d}".format(types["STOKES"])] + 1) * hdr["CDELT{0:d}".format(types["STOKES"])],
                             hdr["CDELT{0:d}".format(types["STOKES"])])
     reverse_stokes_map = {FitsStokesTypes[k]: k for k in FitsStokesTypes.keys()}
-    print>>log, "Stokes in the cube: {0:s}".format(",".join([reverse_stokes_map[s] for s in stokes_axis]))
-    sel_stokes = [reverse_stokes_map[s] for s in stokes_axis].index(use_stokes)
-    print>>log, "Stokes slice selected: {0:d} (Stokes {1:s})".format(sel_stokes, use_stokes)
-    sel_stokes = np.take(cube, sel_stokes, axis=(hdr["NAXIS"] - types["STOKES"]))
-    chan_axis = hdr["NAXIS"] - types["FREQ"] if types["FREQ"] > types["STOKES"] else hdr["NAXIS"] - types["FREQ"] - 1
-    return hdr["CRPIX{0:d}".format(types["RA---SIN"])], \
-           hdr["CRPIX{0:d}".format(types["DEC--SIN"])]
+    cube_stokes = [reverse_stokes_map[s] for s in stokes_axis]
+    print>>log, "Stokes in the cube: {0:s}".format(",".join(cube_stokes))
+    sel = use_stokes if isinstance(use_stokes, list) else [use_stokes]
+    missing = [st for st in sel if st not in cube_stokes]
+    if len(missing) > 0:
+        raise ValueError("Stokes {0:s} not in the cube".format(",".join(missing)))
+    sel_stokes = [cube_stokes.index(st) for st in sel]
+    if not isinstance(use_stokes, list):
+        print>>log, "Stokes slice selected: {0:d} (Stokes {1:s})".format(sel_stokes[0], use_stokes)
+        return types, sel_stokes[0]
+    print>>log, "Stokes slices selected: {0:s}".format(
+        ", ".join(["{0:d} (Stokes {1:s})".format(i, st) for i, st in zip(sel_stokes, use_stokes)]))
+    return types, sel_stokes
 
-def get_fitted_beam(fn, hdu_id):
+def get_fitted_beam(fn, hdu_id, per_channel=False, nprocs=1, use_stokes="I"):
+    """
+        Fitted clean beam (BMIN, BMAJ, BPA) in degrees of a PSF image. If the
+        header lacks the beam keywords, the main lobe of the channel averaged
+        PSF is fitted instead. If per_channel is set the main lobe of every 
+        channel is fitted (using nprocs processes) and a list of beams is 
+        returned
+    """
     print>>log, "Finding fitted CLEAN beam parameters in {0:s}".format(fn)
-    stokes_cube = fn
-    with fits.open(stokes_cube) as img:
-        hdr = img[hdu_id].header
-        w = wcs.WCS(hdr)
-    if not all([k in hdr for k in ["BPA", "BMAJ", "BMIN"]]):
-        raise KeyError("Fitted clean beam parameters is not in FITS file")
-    return hdr["BMIN"], hdr["BMAJ"], hdr["BPA"]
+    hdr, w = read_header(fn, hdu_id)
+    if not per_channel and all([k in hdr for k in ["BPA", "BMAJ", "BMIN"]]):
+        return hdr["BMIN"], hdr["BMAJ"], hdr["BPA"]
+    from catdagger.psf_fitting import fit_beams
+    if per_channel:
+        print>>log, "Fitting clean beams to the main lobe of every PSF channel"
+        w, hdr, planes = read_stokes_slice(fn, hdu_id, use_stokes, average_channels=False)
+        beams = fit_beams(planes, w, nprocs=nprocs)
+        for ch, (bmin, bmaj, bpa) in enumerate(beams):
+            print>>log, "\t - Channel {0:d}: {1:.2f}x{2:.2f} arcsec at {3:.1f} deg".format(
+                ch, bmaj * 3600.0, bmin * 3600.0, bpa)
+        return beams
+    print>>log, "Fitted clean beam parameters are not in the FITS header. Fitting the main lobe of the PSF"
+    w, hdr, plane = read_stokes_slice(fn, hdu_id, use_stokes, average_channels=True)
+    bmin, bmaj, bpa = fit_beams([plane], w)[0]
+    print>>log, "\t - Fitted {0:.2f}x{1:.2f} arcsec at {2:.1f} deg".format(bmaj * 3600.0, bmin * 3600.0, bpa)
+    return bmin, bmaj, bpa
 
 def read_stokes_slice(fn,
                       hdu_id = 0, 
                       use_stokes="I",
-                      average_channels=True):
+                      average_channels=True,
+                      nthreads=1,
+                      single_precision=False):
+    """
+        Reads the channel averaged plane (or the full channel cube if not 
+        average_channels) of a single Stokes parameter.
+
+        Channels are always summed in float64 and the averaged plane is 
+        returned in the (native) float type of the cube. In single precision
+        mode they are summed band by band of rows from the memory mapped 
+        cube into a small float64 accumulator, so the big-endian FITS data 
+        is byteswapped per band and never copied whole. The averaged plane,
+        or the selected cube (byteswapped once in place), is then returned
+        as native float32, identical to the plane of a float32 cube read 
+        without single precision
+    """
     stokes_cube = fn
+    hdr, w = read_header(stokes_cube, hdu_id)
     with fits.open(stokes_cube) as img:
-        cube = img[hdu_id].data
-        hdr = img[hdu_id].header
-        w = wcs.WCS(hdr)
-    types = {hdr["CTYPE{0:d}".format(ax + 1)]: (ax + 1) for ax in range(hdr["NAXIS"])}
-    if set(types.keys()) != set(["FREQ", "STOKES", "RA---SIN", "DEC--SIN"]):
-        raise TypeError("FITS must have FREQ, STOKES and RA and DEC ---SIN axes")
-    stokes_axis = np.arange(hdr["CRVAL{0:d}".format(types["STOKES"])] - hdr["CRPIX{0:d}".format(types["STOKES"])] * (hdr["CDELT{0:d}".format(types["STOKES"])] - 1),
-                            (hdr["NAXIS{0:d}".format(types["STOKES"])] + 1) * hdr["CDELT{0:d}".format(types["STOKES"])],
-                            hdr["CDELT{0:d}".format(types["STOKES"])])
-    reverse_stokes_map = {FitsStokesTypes[k]: k for k in FitsStokesTypes.keys()}
-    print>>log, "Stokes in the cube: {0:s}".format(",".join([reverse_stokes_map[s] for s in stokes_axis]))
-    sel_stokes = [reverse_stokes_map[s] for s in stokes_axis].index(use_stokes)
-    print>>log, "Stokes slice selected: {0:d} (Stokes {1:s})".format(sel_stokes, use_stokes)
-    sel_stokes = np.take(cube, sel_stokes, axis=(hdr["NAXIS"] - types["STOKES"]))
+        cube = image_data(img, hdu_id)
+    types, sel_stokes = stokes_axes(hdr, use_stokes)
     chan_axis = hdr["NAXIS"] - types["FREQ"] if types["FREQ"] > types["STOKES"] else hdr["NAXIS"] - types["FREQ"] - 1
     if average_channels:
         print>>log, "Collapsing axis: {0:d} (FREQ)".format(types["FREQ"])
-        band_avg = np.mean(sel_stokes, axis=chan_axis)
+        # channels are averaged per band of rows; each pixel is reduced in the same
+        # order irrespective of the number of bands, so results are bit-identical.
+        # Both modes sum in float64, so single precision only rounds the average
+        row_axis = min(hdr["NAXIS"] - types["RA---SIN"], hdr["NAXIS"] - types["DEC--SIN"])
+        band_dtype = cube.dtype.newbyteorder("=") if cube.dtype.kind == "f" else np.float64
+        def __collapse(rows):
+            indx = [slice(None)] * hdr["NAXIS"]
+            indx[row_axis] = slice(*rows)
+            return np.mean(np.take(cube[tuple(indx)], sel_stokes, axis=(hdr["NAXIS"] - types["STOKES"])),
+                           axis=chan_axis, dtype=np.float64).astype(band_dtype)
+        def __accumulate(rows):
+            indx = [slice(None)] * hdr["NAXIS"]
+            indx[row_axis] = slice(*rows)
+            indx[hdr["NAXIS"] - types["STOKES"]] = sel_stokes
+            acc = None
+            for c in range(hdr["NAXIS{0:d}".format(types["FREQ"])]):
+                indx[hdr["NAXIS"] - types["FREQ"]] = c
+                # the ufunc casts (and byteswaps) the channel band on the fly
+                if acc is None:
+                    acc = np.array(cube[tuple(indx)], dtype=np.float64)
+                else:
+                    acc += cube[tuple(indx)]
+            acc /= hdr["NAXIS{0:d}".format(types["FREQ"])]
+            return acc.astype(np.float32)
+        if single_precision:
+            # bound the transient float64 accumulators to bands of ~128 rows
+            chunks = row_chunks(cube.shape[row_axis], max(nthreads, (cube.shape[row_axis] + 127) // 128))
+        else:
+            chunks = row_chunks(cube.shape[row_axis], nthreads)
+        band_avg = np.concatenate(thread_map(__accumulate if single_precision else __collapse,
+                                             chunks,
+                                             nthreads),
+                                  axis=0)
         return w, hdr, band_avg 
     else:
+        # only the selected Stokes plane is read (or decompressed)
+        indx = [slice(None)] * hdr["NAXIS"]
+        indx[hdr["NAXIS"] - types["STOKES"]] = sel_stokes
+        sel_stokes = np.array(cube[tuple(indx)]) if isinstance(cube, np.ndarray) else cube[tuple(indx)]
+        if single_precision:
+            if sel_stokes.dtype.kind == "f" and sel_stokes.dtype.itemsize == 4:
+                if not sel_stokes.dtype.isnative:
+                    # the plane is a fresh copy: swap it to native order in place
+                    sel_stokes = sel_stokes.byteswap(True).view(sel_stokes.dtype.newbyteorder())
+            else:
+                sel_stokes = sel_stokes.astype(np.float32)
         return w, hdr, sel_stokes
 
+def read_stokes_planes(fn,
+                       hdu_id = 0,
+                       use_stokes=["I"],
+                       nthreads=1,
+                       single_precision=False):
+    """
+        Channel averaged planes of several Stokes parameters from a single
+        pass over the cube: every band of rows is read once and averaged for 
+        all requested Stokes parameters while resident. Planes are identical 
+        to those of read_stokes_slice.
+        Returns the WCS, header and a dictionary of planes keyed on Stokes
+    """
+    stokes_cube = fn
+    hdr, w = read_header(stokes_cube, hdu_id)
+    with fits.open(stokes_cube) as img:
+        cube = image_data(img, hdu_id)
+    types, sel_stokes = stokes_axes(hdr, use_stokes)
+    print>>log, "Collapsing axis: {0:d} (FREQ)".format(types["FREQ"])
+    nchan = hdr["NAXIS{0:d}".format(types["FREQ"])]
+    chan_axis = hdr["NAXIS"] - types["FREQ"] if types["FREQ"] > types["STOKES"] else hdr["NAXIS"] - types["FREQ"] - 1
+    row_axis = min(hdr["NAXIS"] - types["RA---SIN"], hdr["NAXIS"] - types["DEC--SIN"])
+    def __collapse(rows):
+        indx = [slice(None)] * hdr["NAXIS"]
+        indx[row_axis] = slice(*rows)
+        band = cube[tuple(indx)]
+        planes = []
+        for sel in sel_stokes:
+            stokes_band = np.take(band, sel, axis=(hdr["NAXIS"] - types["STOKES"]))
+            if single_precision:
+                acc = np.zeros(stokes_band.shape[:chan_axis] + stokes_band.shape[chan_axis + 1:], 
+                               dtype=np.float64)
+                for c in range(nchan):
+                    acc += np.take(stokes_band, c, axis=chan_axis)
+                acc /= nchan
+                planes.append(acc.astype(np.float32))
+            else:
+                planes.append(np.mean(stokes_band, axis=chan_axis))
+        return planes
+    # bands of ~128 rows keep all Stokes of a band resident while it is reduced
+    bands = thread_map(__collapse,
+                       row_chunks(cube.shape[row_axis], max(nthreads, (cube.shape[row_axis] + 127) // 128)),
+                       nthreads)
+    planes = {st: np.concatenate([b[ist] for b in bands], axis=0) for ist, st in enumerate(use_stokes)}
+    return w, hdr, planes
+
+def parse_memory_size(val):
+    """ Parses sizes like '512M', '16G' or '2.5T' to bytes. Bare numbers are taken as MiB """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    val = str(val).strip().upper().rstrip("B").rstrip("I")
+    if len(val) > 0 and val[-1] in units:
+        return int(float(val[:-1]) * units[val[-1]])
+    return int(float(val) * units["M"])
+
+def peak_rss():
+    """ Peak resident set size of this process in bytes """
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class StokesSliceReader():
+    """
+        Out-of-core access to the channel averaged plane of a single Stokes
+        parameter. Rows are read through section access channel by channel,
+        so only the requested portion of the cube is ever resident.
+        Supports 2D slicing, so it can stand in for the band averaged image
+        held by regions. Channels are always accumulated in float64, planes
+        are returned as float32 in single precision mode or for float32 
+        cubes (as read_stokes_slice does), float64 otherwise
+    """
+    def __init__(self, fn, hdu_id=0, use_stokes="I", single_precision=False):
+        self._fn = fn
+        self._single_precision = single_precision
+        self._hdu_id = hdu_id
+        hdr, w = read_header(fn, hdu_id)
+        self._hdr = hdr
+        self._wcs = w
+        types, sel_stokes = stokes_axes(hdr, use_stokes)
+        # numpy axes are in reverse order of the FITS axes
+        self._stokes_axis = hdr["NAXIS"] - types["STOKES"]
+        self._chan_axis = hdr["NAXIS"] - types["FREQ"]
+        self._row_axis, self._col_axis = sorted([hdr["NAXIS"] - types["RA---SIN"],
+                                                 hdr["NAXIS"] - types["DEC--SIN"]])
+        self._sel_stokes = sel_stokes
+        self._nchan = hdr["NAXIS{0:d}".format(types["FREQ"])]
+        self._shape = (hdr["NAXIS{0:d}".format(hdr["NAXIS"] - self._row_axis)],
+                       hdr["NAXIS{0:d}".format(hdr["NAXIS"] - self._col_axis)])
+        self._itemsize = np.abs(hdr["BITPIX"]) // 8
+        self._plane_dtype = np.float32 if single_precision or hdr["BITPIX"] == -32 else np.float64
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def nchan(self):
+        return self._nchan
+
+    @property
+    def wcs(self):
+        return self._wcs
+
+    @property
+    def header(self):
+        return self._hdr
+
+    def rows_within_budget(self, max_memory, multiple_of=1):
+        """
+            Number of rows (a multiple of multiple_of) that can be averaged at once
+            within the memory left from max_memory bytes
+        """
+        avail = max_memory - peak_rss()
+        # accumulator + channel read buffer (+ scaled copy) per row
+        row_bytes = self._shape[1] * (8 + 2 * self._itemsize + (4 if self._single_precision else 0))
+        nrows = int(0.5 * avail // row_bytes) // multiple_of * multiple_of
+        if nrows < multiple_of:
+            print>>log, "WARNING: Memory budget of {0:.1f} MiB too small to hold a single band of " \
+                        "tiles. Continuing with one row of tiles per band".format(max_memory / 1024.0**2)
+            nrows = multiple_of
+        return min(nrows, self._shape[0])
+
+    def _index(self, chan, rows, cols):
+        indx = [None] * 4
+        indx[self._stokes_axis] = self._sel_stokes
+        indx[self._chan_axis] = chan
+        indx[self._row_axis] = rows
+        indx[self._col_axis] = cols
+        return tuple(indx)
+
+    def read(self, rows=slice(None), cols=slice(None), nthreads=1):
+        """ 
+            Reads and channel averages the given rows and columns,
+            optionally splitting the rows over nthreads threads
+        """
+        rows = slice(*rows.indices(self._shape[0]))
+        cols = slice(*cols.indices(self._shape[1]))
+        acc = np.zeros((max(rows.stop - rows.start, 0),
+                        max(cols.stop - cols.start, 0)), dtype=np.float64)
+        def __accumulate(chunk):
+            lo, hi = chunk
+            with fits.open(self._fn, memmap=False) as img:
+                sec = image_data(img, self._hdu_id, section=True)
+                for c in range(self._nchan):
+                    acc[lo:hi, :] += sec[self._index(c, slice(rows.start + lo, rows.start + hi), cols)]
+        thread_map(__accumulate, row_chunks(acc.shape[0], nthreads), nthreads)
+        acc /= self._nchan
+        return acc.astype(self._plane_dtype, copy=False)
+
+    def read_windows(self, windows, nthreads=1):
+        """
+            Reads and channel averages a list of (rows, cols) slices, opening
+            the file once per thread. Returns a list of planes
+        """
+        def __read(chunk):
+            lo, hi = chunk
+            planes = []
+            with fits.open(self._fn, memmap=False) as img:
+                sec = image_data(img, self._hdu_id, section=True)
+                for rows, cols in windows[lo:hi]:
+                    acc = np.array(sec[self._index(0, rows, cols)], dtype=np.float64)
+                    for c in range(1, self._nchan):
+                        acc += sec[self._index(c, rows, cols)]
+                    acc /= self._nchan
+                    planes.append(acc.astype(self._plane_dtype, copy=False))
+            return planes
+        return sum(thread_map(__read, row_chunks(len(windows), nthreads), nthreads), [])
+
+    def read_decimated(self, factor, nthreads=1):
+        """
+            Reads and channel averages every factor'th row and column, so
+            only the strided rows are read through section access. Rows
+            are split over nthreads threads
+        """
+        nrows = (self._shape[0] + factor - 1) // factor
+        cols = slice(0, self._shape[1], factor)
+        acc = np.zeros((nrows, (self._shape[1] + factor - 1) // factor), dtype=np.float64)
+        def __accumulate(chunk):
+            lo, hi = chunk
+            with fits.open(self._fn, memmap=False) as img:
+                sec = image_data(img, self._hdu_id, section=True)
+                for c in range(self._nchan):
+                    acc[lo:hi, :] += sec[self._index(c, slice(lo * factor, hi * factor, factor), cols)]
+        thread_map(__accumulate, row_chunks(nrows, nthreads), nthreads)
+        acc /= self._nchan
+        return acc.astype(self._plane_dtype, copy=False)
+
+    def __getitem__(self, key):
+        rows, cols = key
+        return self.read(rows, cols)
+
+def delta_backup_filename(fn):
+    """ model.fits -> model.fits.delta.npz """
+    return fn + ".delta.npz"
+
+def write_delta_backup(fn, cube, stokes_slice_indx, cube_slice, hdu_id=0):
+    """
+        Stores the original values and flat cube indices of the pixels of the
+        Stokes slice that differ from cube_slice in a compressed sidecar. 
+        Pixels already held by an earlier backup keep their oldest values, so
+        restoring always returns the cube as it was before the first blanking
+    """
+    original = cube[stokes_slice_indx]
+    changed = np.logical_not(np.logical_or(original == cube_slice, 
+                                           np.logical_and(np.isnan(original), np.isnan(cube_slice))))
+    coords = list(np.nonzero(changed))
+    stokes_axis = [i for i, sl in enumerate(stokes_slice_indx) if not isinstance(sl, slice)][0]
+    coords.insert(stokes_axis, np.full(coords[0].shape, stokes_slice_indx[stokes_axis], dtype=coords[0].dtype))
+    indices = np.ravel_multi_index(coords, cube.shape)
+    values = original[changed]
+    backupfn = delta_backup_filename(fn)
+    if os.path.exists(backupfn):
+        with np.load(backupfn) as prev:
+            if tuple(prev["shape"]) != cube.shape or int(prev["hdu_id"]) != hdu_id:
+                raise ValueError("Existing delta backup {0:s} does not match {1:s}".format(backupfn, fn))
+            new = np.logical_not(np.in1d(indices, prev["indices"]))
+            indices = np.concatenate([prev["indices"], indices[new]])
+            values = np.concatenate([prev["values"], values[new]])
+    order = np.argsort(indices, kind="mergesort")
+    indices = indices[order].astype(np.uint32 if cube.size < 2**32 else np.int64)
+    with open(backupfn, "wb") as f:
+        np.savez_compressed(f,
+                            indices=indices,
+                            values=values[order],
+                            shape=np.array(cube.shape, dtype=np.int64),
+                            hdu_id=hdu_id)
+    print>>log, "Backed up {0:d} original pixel values of {1:s} to {2:s}".format(
+        indices.size, fn, backupfn)
+
+def restore_delta_backup(fn, hdu_id=None, remove=False):
+    """
+        Writes the original pixel values held in the delta backup of fn back
+        into fn (recompressing tile-compressed images with their own settings).
+        The backup is deleted afterwards if remove is set
+    """
+    backupfn = delta_backup_filename(fn)
+    with np.load(backupfn) as backup:
+        indices = backup["indices"]
+        values = backup["values"]
+        shape = tuple(backup["shape"])
+        hdu_id = int(backup["hdu_id"]) if hdu_id is None else hdu_id
+    with fits.open(fn) as img:
+        hdu = image_hdu(img, hdu_id)
+        cube = hdu.data
+        if cube.shape != shape:
+            raise ValueError("Delta backup {0:s} was made of a {1:s} cube, {2:s} is {3:s}".format(
+                backupfn, str(shape), fn, str(cube.shape)))
+        cube.flat[indices] = values
+        hdu.data = cube
+        print>>log, "Restoring {0:d} original pixel values of {1:s} from {2:s}".format(
+            indices.size, fn, backupfn)
+        img.writeto(fn, overwrite=True)
+    if remove:
+        os.unlink(backupfn)
+
 def save_stokes_slice(fn,
                       cube_slice,
                       hdu_id = 0, 
                       use_stokes="I",
-                      backup=True):
+                      backup=True,
+                      compression_type=None):
+    """
+        Writes the (nchan, ny, nx) cube of a single Stokes parameter back to
+        fn. Tile-compressed images are recompressed with their own settings,
+        uncompressed images are written as tile-compressed images if a 
+        compression_type (e.g. RICE_1, GZIP_1) is given.
+        backup may be "full" (or True) to copy fn to fn.orig.fits, "delta" to 
+        store only the original values of modified pixels (see 
+        write_delta_backup) or None / False
+    """
     stokes_cube = fn
+    backup = "full" if backup is True else backup
+    if backup not in ["full", "delta", None, False]:
+        raise ValueError("Unknown backup mode {0:s}".format(str(backup)))
+    # fail before anything is written
+    check_compression(stokes_cube, hdu_id, compression_type)
     with fits.open(stokes_cube) as img:
-        cube = img[hdu_id].data
-        hdr = img[hdu_id].header
+        cube = image_hdu(img, hdu_id).data
+        hdr = image_hdu(img, hdu_id).header
         w = wcs.WCS(hdr)
-        backup and img.writeto(stokes_cube + ".orig.fits", overwrite=True)
-    types = {hdr["CTYPE{0:d}".format(ax + 1)]: (ax + 1) for ax in range(hdr["NAXIS"])}
-    if set(types.keys()) != set(["FREQ", "STOKES", "RA---SIN", "DEC--SIN"]):
-        raise TypeError("FITS must have FREQ, STOKES and RA and DEC ---SIN axes")
-    stokes_axis = np.arange(hdr["CRVAL{0:d}".format(types["STOKES"])] - hdr["CRPIX{0:d}".format(types["STOKES"])] * (hdr["CDELT{0:d}".format(types["STOKES"])] - 1),
-                            (hdr["NAXIS{0:d}".format(types["STOKES"])] + 1) * hdr["CDELT{0:d}".format(types["STOKES"])],
-                            hdr["CDELT{0:d}".format(types["STOKES"])])
-    reverse_stokes_map = {FitsStokesTypes[k]: k for k in FitsStokesTypes.keys()}
-    print>>log, "Stokes in the cube: {0:s}".format(",".join([reverse_stokes_map[s] for s in stokes_axis]))
-    sel_stokes = [reverse_stokes_map[s] for s in stokes_axis].index(use_stokes)
-    print>>log, "Stokes slice selected: {0:d} (Stokes {1:s})".format(sel_stokes, use_stokes)
+        backup == "full" and img.writeto(stokes_cube + ".orig.fits", overwrite=True)
+    types, sel_stokes = stokes_axes(hdr, use_stokes)
     stokes_slice_indx = tuple([slice(None) if k != "STOKES" else sel_stokes for k in sorted(types.keys(), key=lambda k: types[k], reverse=True)])
+    if backup == "delta":
+        write_delta_backup(stokes_cube, cube, stokes_slice_indx, cube_slice, hdu_id)
     cube[stokes_slice_indx] = cube_slice
     chan_axis = hdr["NAXIS"] - types["FREQ"] if types["FREQ"] > types["STOKES"] else hdr["NAXIS"] - types["FREQ"] - 1
     print>>log, "Saving model FITS back to disk: {0:s}".format(stokes_cube)
     with fits.open(stokes_cube) as img:
-        img[hdu_id].data = cube
-        img.writeto(stokes_cube, overwrite=True)
+        hdu = image_hdu(img, hdu_id)
+        if isinstance(hdu, fits.CompImageHDU) or compression_type is None:
+            hdu.data = cube
+            img.writeto(stokes_cube, overwrite=True)
+        else:
+            print>>log, "Compressing model FITS with {0:s}".format(compression_type)
+            hdus = [h for h in img]
+            hdus[hdu_id] = fits.CompImageHDU(cube, header=hdr, compression_type=compression_type)
+            if hdu_id == 0:
+                hdus.insert(0, fits.PrimaryHDU())
+            fits.HDUList(hdus).writeto(stokes_cube, overwrite=True)
 
 
-def blank_components(fn, rmsmap, psf_image, list_src, hdu_id = 0, use_stokes="I"):
+def footprint_kernels(BMAJ, BMIN, BPA, emaj=0, emin=0, epa=0):
+    """
+        Unit peak beam (BMAJ, BMIN in px, BPA in deg) and source (point or 
+        gaussian: emaj, emin in px and epa in rad) windows used to build the 
+        blanking footprint. Both sit at index wnd_size // 2 along both axes
+    """
+    if emaj != 0 and emin != 0:
+        wnd_size = (2 * 10 * (max(emaj, BMAJ) + 1))
+    else:
+        wnd_size = (2 * 10 * BMAJ + 1)
+    offsets = np.arange(wnd_size) - wnd_size // 2
+    x, y = np.meshgrid(offsets, offsets)
+    wnd = twodgaussian([1.0, 0, 0, BMAJ, BMIN, BPA],
+                       circle=0, rotate=1, vheight=0)(x, y)
+    if emaj != 0 and emin != 0:
+        src = twodgaussian([1.0, 0, 0, emaj, emin, np.rad2deg(epa)],
+                           circle=0, rotate=1, vheight=0)(x, y)
+    else:
+        src = np.zeros_like(wnd)
+        src[wnd_size//2, wnd_size//2] = 1
+    return wnd, src
 
-    w, hdr, data = read_stokes_slice(fn, hdu_id, average_channels=False)
-    types = {hdr["CTYPE{0:d}".format(ax + 1)]: (ax + 1) for ax in range(hdr["NAXIS"])}
-    cdelt = float(max(np.abs(hdr["CDELT{0:d}".format(types["RA---SIN"])]), \
-                      np.abs(hdr["CDELT{0:d}".format(types["DEC--SIN"])])))
-    BMIN, BMAJ, BPA = get_fitted_beam(psf_image, hdu_id) 
-    BMAJ=int(BMAJ / cdelt) # in pixels
-    BMIN=int(BMIN / cdelt) # in pixels
-    print>>log, "Blanking the following positions with fitted resolution:"
-    for s in list_src:
-        ra = s.pos.ra
-        dec = s.pos.dec
-        ex = int(s.shape.ex / np.rad2deg(cdelt)) if s.shape is not None and \
-                        hasattr(s.shape, "typecode") and \
-                        s.shape.typecode == "Gau" \
-            else 0
-        ey = int(s.shape.ex / np.rad2deg(cdelt)) if s.shape is not None and \
-                        hasattr(s.shape, "typecode") and \
-                        s.shape.typecode == "Gau" \
-            else 0
-        epa = s.shape.pa if s.shape is not None and \
-                         hasattr(s.shape, "typecode") and \
-                         s.shape.typecode == "Gau" \
-            else 0
-        emaj = max(ex, ey)
-        emin = min(ex, ey)
-
-        # Build a mask of source convolved with resolution
-        if emaj != 0 and emin != 0:
-            wnd_size = (2 * 10 * (max(emaj, BMAJ) + 1))
+def source_footprint(BMAJ, BMIN, BPA, emaj=0, emin=0, epa=0):
+    """
+        Boolean footprint of a point (or gaussian: emaj, emin in px and epa in rad) 
+        source convolved with the fitted beam (BMAJ, BMIN in px, BPA in deg). 
+        The source sits at index wnd_size // 2 along both axes
+    """
+    wnd, src = footprint_kernels(BMAJ, BMIN, BPA, emaj, emin, epa)
+    counters.count("footprint_convolutions")
+    conv_wnd = ssig.convolve(src, wnd, mode="same")
+    return conv_wnd >= 0.5 * np.max(wnd)
+
+def blank_source_table(data, w, beam, table, indices=None, bulk=False, nthreads=1):
+    """
+        Blanks (in place) the (nchan, ny, nx) model data within resolution of 
+        the sources in a source table (see lsm_tools.source_table). beam is the 
+        fitted (BMIN, BMAJ, BPA) in degrees, or a list of such beams, one per 
+        channel. Only the given indices of the table are blanked if specified. 
+
+        A single 2D union mask of all source footprints is built per distinct 
+        beam and applied to all its channels at once. Returns the channel-summed 
+        integrated flux within each source's footprint (0 for sources outside 
+        the image)
+
+        In bulk mode all components are rendered into one image which is 
+        convolved with the beam in a single (nthreads multithreaded) FFT pass 
+        and thresholded at half the beam peak. Where footprints of neighbouring
+        components overlap their summed response is thresholded, so the mask 
+        may be slightly larger than the union of the individual footprints, 
+        and the fluxes of sources with overlapping footprints are counted 
+        within each of them
+    """
+    cdelt = float(np.max(np.abs(proj_plane_pixel_scales(w.celestial))))
+    beams = [tuple(b) for b in beam] if isinstance(beam, list) else [tuple(beam)] * data.shape[0]
+    if len(beams) != data.shape[0]:
+        raise ValueError("Expected a fitted beam for each of the {0:d} channels, got {1:d}".format(
+            data.shape[0], len(beams)))
+    indices = np.arange(len(table["ra"])) if indices is None else np.asarray(indices)
+    fluxes = np.zeros(len(indices))
+    pix_ra, pix_dec = world2pix(w, table["ra"][indices], table["dec"][indices], 1)
+    # discard sources outside the image in bulk
+    in_image = np.logical_and(np.isfinite(pix_ra), np.isfinite(pix_dec))
+    x = np.where(in_image, pix_dec, -1).astype(np.int64)
+    y = np.where(in_image, pix_ra, -1).astype(np.int64)
+    in_image = np.logical_and(in_image,
+                              np.logical_and(np.logical_and(x >= 0, x < data.shape[1]),
+                                             np.logical_and(y >= 0, y < data.shape[2])))
+    if np.sum(np.logical_not(in_image)) > 0:
+        print>>log, "Discarding {0:d} sources outside the image".format(np.sum(np.logical_not(in_image)))
+    ex = (table["ex"][indices] / np.rad2deg(cdelt)).astype(np.int64)
+    ey = (table["ey"][indices] / np.rad2deg(cdelt)).astype(np.int64)
+    epa = table["pa"][indices]
+    emaj = np.maximum(ex, ey)
+    emin = np.minimum(ex, ey)
+
+    def __blank(beam, chans):
+        BMIN, BMAJ, BPA = beam
+        BMAJ=int(BMAJ / cdelt) # in pixels
+        BMIN=int(BMIN / cdelt) # in pixels
+        chan_sum = np.sum(data, axis=0) if len(chans) == data.shape[0] else \
+                   np.sum(data[chans], axis=0)
+        # sources sharing a footprint are placed with one kernel call
+        groups = {}
+        for isrc in np.flatnonzero(in_image):
+            key = (emaj[isrc], emin[isrc], epa[isrc]) if emaj[isrc] != 0 and emin[isrc] != 0 else (0, 0, 0)
+            groups.setdefault(key, []).append(isrc)
+        footprints = {}
+        for key in groups.keys():
+            footprints[key] = source_footprint(BMAJ, BMIN, BPA, *key) if not bulk else \
+                              footprint_kernels(BMAJ, BMIN, BPA, *key)[1]
+            groups[key] = np.array(groups[key], dtype=np.int64)
+            for _ in groups[key]:
+                counters.observe("blank_window_size", footprints[key].shape[0])
+        if bulk:
+            sky = np.zeros(data.shape[1:], dtype=np.float64)
+            for key, isrcs in groups.items():
+                kernels.add_windows(sky, footprints[key], x[isrcs], y[isrcs])
+            wnd, _ = footprint_kernels(BMAJ, BMIN, BPA)
+            union_mask = fft_convolve(sky, wnd, nthreads=nthreads) >= 0.5 * np.max(wnd)
+            # the union mask is only used for blanking: fluxes are summed within
+            # every source's own footprint, as without bulk mode
+            for key, isrcs in groups.items():
+                fluxes[isrcs] += kernels.window_sums(chan_sum, source_footprint(BMAJ, BMIN, BPA, *key),
+                                                     x[isrcs], y[isrcs])
         else:
-            wnd_size = (2 * 10 * BMAJ + 1)
-        x, y = np.meshgrid(np.arange(-wnd_size//2, wnd_size//2),
-                           np.arange(-wnd_size//2, wnd_size//2))
-        wnd = twodgaussian([1.0, 0, 0, BMAJ, BMIN, BPA],
-                           circle=0, rotate=1, vheight=0)(x, y)
-        if emaj != 0 and emin != 0:
-            src = twodgaussian([1.0, 0, 0, emaj, emin, np.rad2deg(epa)],
-                               circle=0, rotate=1, vheight=0)(x, y)
+            union_mask = np.zeros(data.shape[1:], dtype=np.bool)
+            for key, isrcs in groups.items():
+                kernels.or_windows(union_mask, footprints[key], x[isrcs], y[isrcs])
+                fluxes[isrcs] += kernels.window_sums(chan_sum, footprints[key], x[isrcs], y[isrcs])
+        # place the mask over the image and set everything in it to 0
+        if len(chans) == data.shape[0]:
+            data[:, union_mask] = 0.0
         else:
-            src = np.zeros_like(wnd)
-            src[wnd_size//2, wnd_size//2] = 1
-        conv_wnd = ssig.convolve(src, wnd, mode="same")
-        # place the mask over the image portion and set everything in it to 0
-        wnd_mask = np.zeros_like(wnd, dtype=np.bool)
-        wnd_mask[conv_wnd >= 0.5 * np.max(wnd)] = True
-        wnd_mask_cube = np.empty((data.shape[0], wnd.shape[0], wnd.shape[1]), dtype=np.bool)
-        wnd_mask_cube[:, :, :] = wnd_mask[None, :, :]
-
-        y, x, _, _ = w.all_world2pix([[np.rad2deg(ra), np.rad2deg(dec), 0, 0]], 1)[0]
-        x = int(x)
-        y = int(y)
-        if np.isnan(x) or np.isnan(y): continue
-        in_image = x >= 0 and x < data.shape[1] and \
-                   y >= 0 and y < data.shape[2]
-        wnd_size_half = wnd_size // 2
-        xmin = np.clip(x - wnd_size_half - 1, 0, data.shape[1] - 1)
-        xmax = np.clip(x + wnd_size_half, 0, data.shape[1] - 1)
-        ymin = np.clip(y - wnd_size_half - 1, 0, data.shape[2] - 1)
-        ymax = np.clip(y + wnd_size_half, 0, data.shape[2] - 1)
-        wnd_cut_min_x = np.clip(0 - (x - wnd_size_half - 1), 0, x + wnd_size_half)
-        wnd_cut_max_x = wnd_size - np.clip(x + wnd_size_half - (data.shape[1] - 1), 0, x + wnd_size_half)
-        wnd_cut_min_y = np.clip(0 - (y - wnd_size_half - 1), 0, y + wnd_size_half)
-        wnd_cut_max_y = wnd_size - np.clip(y + wnd_size_half - (data.shape[1] - 1), 0, y + wnd_size_half)
-        assert xmax - xmin == wnd_cut_max_x - wnd_cut_min_x
-        assert ymax - ymin == wnd_cut_max_y - wnd_cut_min_y
-        if in_image:
-            mod_flux = np.sum(data[:, xmin:xmax, ymin:ymax][wnd_mask_cube[:,
-                                                                          wnd_cut_min_x:wnd_cut_max_x, 
-                                                                          wnd_cut_min_y:wnd_cut_max_y]])
-
-            print>>log, "\t - {0:d}, {1:d} with {2:0.2f} integrated flux (mJy) within resolution".format(
-                x, y, mod_flux * 1.0e3 / data.shape[0])
-            data[:, xmin:xmax, ymin:ymax][wnd_mask_cube[:,
-                                                        wnd_cut_min_x:wnd_cut_max_x, 
-                                                        wnd_cut_min_y:wnd_cut_max_y]] = 0.0
-    save_stokes_slice(fn, data, hdu_id, use_stokes)
+            for ch in chans:
+                data[ch, union_mask] = 0.0
+
+    # channels sharing a beam share a footprint mask
+    channel_groups = {}
+    for ch, b in enumerate(beams):
+        channel_groups.setdefault(b, []).append(ch)
+    if len(channel_groups) > 1:
+        print>>log, "Building blanking footprints for {0:d} distinct channel beams".format(len(channel_groups))
+    for b in sorted(channel_groups.keys(), key=lambda b: channel_groups[b][0]):
+        __blank(b, channel_groups[b])
+    print>>log, "Blanking the following positions with fitted resolution:"
+    for isrc in np.flatnonzero(in_image):
+        print>>log, "\t - {0:d}, {1:d} with {2:0.2f} integrated flux (mJy) within resolution".format(
+            x[isrc], y[isrc], fluxes[isrc] * 1.0e3 / data.shape[0])
+    return fluxes
+
+def blank_components(fn, rmsmap, psf_image, list_src, hdu_id = 0, use_stokes="I", bulk=False, nthreads=1,
+                     single_precision=False, compression_type=None, per_channel_beams=False, nprocs=1,
+                     backup="full"):
+    from catdagger.lsm_tools import source_table
+    w, hdr, data = read_stokes_slice(fn, hdu_id, average_channels=False, single_precision=single_precision)
+    beam = get_fitted_beam(psf_image, hdu_id, per_channel=per_channel_beams, nprocs=nprocs)
+    blank_source_table(data, w, beam, source_table(list_src),
+                       bulk=bulk, nthreads=nthreads)
+    save_stokes_slice(fn, data, hdu_id, use_stokes, backup=backup, compression_type=compression_type)
@@ -124,6 +124,47 @@ def twodgaussian(inpars, circle, rotate, vheight):
         return g
     return rotgauss
 
+def twodgaussian_jacobian(inpars, circle, rotate, vheight):
+    """Returns a function of x, y evaluating the analytic partial derivatives
+        of twodgaussian(inpars, circle, rotate, vheight)(x, y) with respect to
+        each of the input parameters (rota in degrees), stacked along the last
+        axis in the order of inpars
+        """
+    inpars = list(inpars)
+    height = float(inpars.pop(0)) if vheight == 1 else 0.0
+    amplitude, center_x, center_y = float(inpars.pop(0)), float(inpars.pop(0)), float(inpars.pop(0))
+    if circle == 1:
+        width_x = width_y = float(inpars.pop(0))
+    else:
+        width_x, width_y = float(inpars.pop(0)), float(inpars.pop(0))
+    rota = pi/180. * float(inpars.pop(0)) if rotate == 1 else 0.0
+    if len(inpars) > 0:
+        raise ValueError("There are still input parameters:" + str(inpars))
+
+    def jacobian(x,y):
+        dx = center_x - x
+        dy = center_y - y
+        # offsets from the centre in the frame of the ellipse axes
+        u = dx * cos(rota) - dy * sin(rota)
+        v = dx * sin(rota) + dy * cos(rota)
+        e = exp(-((u/width_x)**2 + (v/width_y)**2)/2.)
+        ae = amplitude * e
+        derivs = []
+        if vheight == 1:
+            derivs.append(ones_like(e))
+        derivs.append(e)
+        derivs.append(-ae * (u * cos(rota)/width_x**2 + v * sin(rota)/width_y**2))
+        derivs.append(-ae * (-u * sin(rota)/width_x**2 + v * cos(rota)/width_y**2))
+        if circle == 1:
+            derivs.append(ae * (u**2 + v**2)/width_x**3)
+        else:
+            derivs.append(ae * u**2/width_x**3)
+            derivs.append(ae * v**2/width_y**3)
+        if rotate == 1:
+            derivs.append(pi/180. * ae * u * v * (1./width_x**2 - 1./width_y**2))
+        return stack(derivs, axis=-1)
+    return jacobian
+
 def gaussfit(data,err=None,params=[],autoderiv=1,return_all=0,circle=0,rotate=1,vheight=1):
     """
     Gaussian fitter with the ability to fit a variety of different forms of 2-dimensional gaussian.
@@ -136,7 +177,7 @@ def gaussfit(data,err=None,params=[],autoderiv=1,return_all=0,circle=0,rotate=1,
             if not input, these will be determined from the moments of the system, 
             assuming no rotation
         autoderiv=1 - use the autoderiv provided in the lmder.f function (the alternative
-            is to us an analytic derivative with lmdif.f: this method is less robust)
+            autoderiv=0 uses the analytic derivatives of twodgaussian_jacobian)
         return_all=0 - Default is to return only the Gaussian parameters.  See below for
             detail on output
         circle=0 - default is an elliptical gaussian (different x, y widths), but can reduce
@@ -154,15 +195,18 @@ def gaussfit(data,err=None,params=[],autoderiv=1,return_all=0,circle=0,rotate=1,
     """
     if params == []:
         params = (moments(data,circle,rotate,vheight))
-    if err == None:
+    if err is None:
         errorfunction = lambda p: ravel((twodgaussian(p,circle,rotate,vheight)(*indices(data.shape)) - data))
     else:
         errorfunction = lambda p: ravel((twodgaussian(p,circle,rotate,vheight)(*indices(data.shape)) - data)/err)
     if autoderiv == 0:
-        # the analytic derivative, while not terribly difficult, is less efficient and useful.  I only bothered
-        # putting it here because I was instructed to do so for a class project - please ask if you would like 
-        # this feature implemented
-        raise ValueError("I'm sorry, I haven't implemented this feature yet.")
+        # analytic Jacobian of the residuals (one row per pixel)
+        if err is None:
+            jacobianfunction = lambda p: twodgaussian_jacobian(p,circle,rotate,vheight)(*indices(data.shape)).reshape(data.size, -1)
+        else:
+            jacobianfunction = lambda p: (twodgaussian_jacobian(p,circle,rotate,vheight)(*indices(data.shape)) / 
+                                          asarray(err)[..., newaxis]).reshape(data.size, -1)
+        p, cov, infodict, errmsg, success = optimize.leastsq(errorfunction, params, Dfun=jacobianfunction, full_output=1)
     else:
         p, cov, infodict, errmsg, success = optimize.leastsq(errorfunction, params, full_output=1)
     if  return_all == 0:
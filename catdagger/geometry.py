@@ -27,24 +27,35 @@ import scipy.spatial as spat
 import Tigger
 from astropy import wcs
 from catdagger import logger
-from catdagger.filters import arealess, notin, within_radius_from
+from catdagger import counters
+from catdagger import kernels
+from catdagger.coordinates import world2pix
 log = logger.getLogger("geometry")
 
 DEBUG = False
 
-class BoundingConvexHull():
+class BoundingConvexHull(object):
+    # geometry is computed once on construction and cached
+    __slots__ = ["_wcs", "_data", "_name", "_sigma", "_corners", "_lnormals", "_area", "_centre"]
+
     def __init__(self, list_hulls, sigma, name, wcs, imdata):
         self._wcs = wcs
         self._data = imdata
         self._name = name
-        self._vertices = points = np.vstack([b.corners
+        points = np.vstack([b.corners
             if hasattr(b, "corners") else [b[0], b[1]] for b in list_hulls])
-        self._hull = spat.ConvexHull(points)
+        self._corners = points[spat.ConvexHull(points).vertices]
+        edges = np.roll(self._corners, -1, axis=0) - self._corners
+        self._lnormals = np.column_stack([-edges[:, 1], edges[:, 0]]).astype(np.double)
+        self._area = 0.5 * np.abs(np.sum(self._corners[:, 0] * np.roll(self._corners[:, 1], -1) - 
+                                         np.roll(self._corners[:, 0], -1) * self._corners[:, 1]))
+        # Barycentre of polygon
+        self._centre = np.mean(points, axis=0)
         self._sigma = sigma
 
     def __str__(self):
         return "{0:.2f}x within region ".format(self._sigma) + \
-               ",".join(["({0:d},{1:d})".format(x,y) for (x,y) in self.corners])
+               ",".join(["({0:d},{1:d})".format(int(np.round(x)), int(np.round(y))) for (x,y) in self.corners])
 
     @property
     def regional_data(self):
@@ -63,21 +74,24 @@ class BoundingConvexHull():
                                       np.logical_and(bounding_mesh[1]>=min(y1, y2),
                                                      bounding_mesh[1]<=max(y1, y2))) 
             region_selected[sel_indx] = True
-        self._data[miny:maxy, minx:maxx][region_selected] = np.nan
+        # fetch the window once: a view for in-memory images, a fresh read
+        # for images streamed from disk. The image is shared between regions
+        # (and Stokes passes), so it is never modified
+        wnd = self._data[miny:maxy, minx:maxx]
+        counters.count("regional_data_pixels", wnd.size)
         if DEBUG:
             from matplotlib import pyplot as plt
             plt.figure
-            plt.imshow(self._data[miny:maxy, minx:maxx])
+            plt.imshow(np.where(region_selected, np.nan, wnd))
             plt.show()
-        selected_data = self._data[miny:maxy, minx:maxx][np.logical_not(np.isnan(
-            self._data[miny:maxy, minx:maxx]))]
+        selected_data = wnd[np.logical_and(np.logical_not(region_selected),
+                                           np.logical_not(np.isnan(wnd)))]
         return selected_data
         
 
     @property
     def area(self):
-        lines = np.hstack([self.corners, np.roll(self.corners, -1, axis=0)])
-        return 0.5 * np.abs(np.sum([x1*y2-x2*y1 for x1,y1,x2,y2 in lines]))
+        return self._area
 
     @property
     def name(self):
@@ -93,25 +107,30 @@ class BoundingConvexHull():
 
     @property
     def global_data(self):
-        return self._data.view()
+        return self._data.view() if isinstance(self._data, np.ndarray) else self._data
+
+    def attach(self, imdata):
+        """ Attaches the (band averaged) image the region selects data from """
+        self._data = imdata
+
+    def __getstate__(self):
+        # regions are shipped to worker processes without the image: workers
+        # attach to a shared copy instead
+        return tuple([getattr(self, k) if k != "_data" else None
+                      for k in BoundingConvexHull.__slots__])
+
+    def __setstate__(self, state):
+        for k, v in zip(BoundingConvexHull.__slots__, state):
+            setattr(self, k, v)
 
     @property
     def corners(self):
         """ Returns vertices and guarentees clockwise winding """
-        return self._vertices[self._hull.vertices]
+        return self._corners
 
     def normals(self, left = True):
         """ return a list of left normals to the hull """
-        normals = []
-        for i in xrange(self.corners.shape[0]):
-            # assuming clockwise winding
-            j = (i + 1) % self.corners.shape[0]
-            edge = self.corners[j, :] - self.corners[i, :]
-            if left:
-                normals.append((-edge[1], edge[0]))
-            else:
-                normals.append((edge[1], -edge[0]))
-        return np.asarray(normals, dtype=np.double)
+        return self._lnormals if left else -self._lnormals
 
     @property
     def lnormals(self):
@@ -127,6 +146,7 @@ class BoundingConvexHull():
         """
         if not isinstance(other, BoundingConvexHull):
             raise TypeError("rhs must be a BoundingConvexHull")
+        counters.count("sat_tests")
 
         # get the projection axes
         normals = np.vstack([self.lnormals, other.lnormals])
@@ -151,16 +171,18 @@ class BoundingConvexHull():
 
     @property
     def centre(self):
-        # Barycentre of polygon
-        return np.mean(self._vertices, axis=0)
+        return self._centre
 
     def __contains__(self, s):
         if not isinstance(s, Tigger.Models.SkyModel.Source):
             raise TypeError("Source must be a Tigger lsm source")
         ra = np.rad2deg(s.pos.ra)
         dec = np.rad2deg(s.pos.dec)
-        x, y, _, _ = self._wcs.all_world2pix([[ra, dec, 0, 0]], 1)[0]
+        x, y = world2pix(self._wcs, ra, dec, 1)
+        return self.contains_pixel(x[0], y[0])
 
+    def contains_pixel(self, x, y):
+        """ Tests whether pixel (x, y) lies within the hull """
         dot = 0
         for i in range(len(self.corners)):
             j = (i + 1) % len(self.corners)
@@ -169,7 +191,122 @@ class BoundingConvexHull():
             dot += np.arccos(np.clip(np.dot(v1,v2)/(np.linalg.norm(v1)*np.linalg.norm(v2)), -1, +1))
         return np.abs(360 - np.rad2deg(dot)) < 1.0e-6
 
+class RegionSet(object):
+    """
+        Structure-of-arrays store of a list of regions. Corners, left normals,
+        areas, centres and sigmas of all regions are held in contiguous arrays
+        (corners and normals of region i at offsets[i]:offsets[i+1]) so that
+        geometric queries over the whole set are vectorized
+    """
+    __slots__ = ["_regions", "_offsets", "_corners", "_lnormals", "_region_id",
+                 "_areas", "_centres", "_sigma", "_bbox", "_winding"]
+
+    def __init__(self, regions):
+        self._regions = list(regions)
+        ncorners = np.array([reg.corners.shape[0] for reg in self._regions], dtype=np.int64)
+        self._offsets = np.concatenate([[0], np.cumsum(ncorners)]).astype(np.int64)
+        self._corners = np.vstack([reg.corners for reg in self._regions]).astype(np.float64) \
+            if len(self._regions) > 0 else np.zeros((0, 2))
+        self._lnormals = np.vstack([reg.lnormals for reg in self._regions]) \
+            if len(self._regions) > 0 else np.zeros((0, 2))
+        self._region_id = np.repeat(np.arange(len(self._regions)), ncorners)
+        self._areas = np.array([reg.area for reg in self._regions], dtype=np.float64)
+        self._centres = np.array([reg.centre for reg in self._regions], dtype=np.float64).reshape(-1, 2)
+        self._sigma = np.array([reg.area_sigma for reg in self._regions], dtype=np.float64)
+        self._bbox = np.array([[np.min(reg.corners[:, 0]), np.min(reg.corners[:, 1]),
+                                np.max(reg.corners[:, 0]), np.max(reg.corners[:, 1])]
+                               for reg in self._regions], dtype=np.float64).reshape(-1, 4)
+        # sign of the polygon winding of each region's corners
+        nxt = np.arange(self._corners.shape[0]) + 1
+        nxt[self._offsets[1:] - 1] = self._offsets[:-1]
+        cross = self._corners[:, 0] * self._corners[nxt, 1] - self._corners[nxt, 0] * self._corners[:, 1]
+        self._winding = np.sign(np.bincount(self._region_id, weights=cross, minlength=len(self._regions)))
+
+    def __len__(self):
+        return len(self._regions)
+
+    def __getitem__(self, i):
+        return self._regions[i]
+
+    def __iter__(self):
+        return iter(self._regions)
+
+    @property
+    def regions(self):
+        return self._regions
+
+    @property
+    def names(self):
+        return [reg.name for reg in self._regions]
+
+    @property
+    def areas(self):
+        return self._areas
+
+    @property
+    def centres(self):
+        return self._centres
+
+    @property
+    def sigma(self):
+        return self._sigma
+
+    @property
+    def bounding_boxes(self):
+        """ (minx, miny, maxx, maxy) of every region """
+        return self._bbox
+
+    def corners(self, i):
+        return self._corners[self._offsets[i]:self._offsets[i + 1]]
+
+    def area_less(self, min_area):
+        return self._areas < min_area
+
+    def centres_within(self, cx, cy, radius):
+        return np.sum((self._centres - np.array([cx, cy])[None, :])**2, axis=1) < radius**2
+
+    def _edges(self):
+        """ Hull edges of all regions, oriented with the interior to their left """
+        nxt = np.arange(self._corners.shape[0]) + 1
+        nxt[self._offsets[1:] - 1] = self._offsets[:-1]
+        return (self._corners[nxt] - self._corners) * self._winding[self._region_id][:, None]
+
+    def contains_pixels(self, x, y, chunk_size=4096):
+        """
+            Membership matrix of shape (npoints, nregions) of pixel positions
+            x, y, evaluated as half-plane tests against every hull edge
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        inside = np.zeros((x.shape[0], len(self._regions)), dtype=np.bool)
+        if len(self._regions) == 0 or x.shape[0] == 0:
+            return inside
+        return kernels.points_in_polygons(x, y, self._corners, self._edges(), self._offsets, chunk_size)
+
+    def label_image(self, shape):
+        """
+            Integer image of (rows, cols) shape labelling each pixel with 1 + the
+            index of the first region containing its centre and 0 elsewhere.
+            Every region is rasterised within its own bounding box only
+        """
+        labels = np.zeros(shape, dtype=np.int32)
+        edges = self._edges()
+        # paint in reverse so that the first region containing a pixel wins
+        for i in range(len(self._regions) - 1, -1, -1):
+            minx, miny, maxx, maxy = self._bbox[i]
+            cols = slice(max(int(np.floor(minx)), 0), min(int(np.ceil(maxx)), shape[1]))
+            rows = slice(max(int(np.floor(miny)), 0), min(int(np.ceil(maxy)), shape[0]))
+            if cols.start >= cols.stop or rows.start >= rows.stop:
+                continue
+            kernels.paint_polygon(labels, 
+                                  self._corners[self._offsets[i]:self._offsets[i + 1]],
+                                  edges[self._offsets[i]:self._offsets[i + 1]],
+                                  i + 1, rows.start, rows.stop, cols.start, cols.stop)
+        return labels
+
 class BoundingBox(BoundingConvexHull):
+    __slots__ = []
+
     def __init__(self, xl, xu, yl, yu, sigma, name, wcs, imdata):
         BoundingConvexHull.__init__(self,
                                     [[xl,yl],[xl,yu],[xu,yu],[xu,yl]],
@@ -193,6 +330,7 @@ def merge_regions(regions, min_sep_distance=1.0e-4, exclusion_zones=[]):
     orig_regs = len(regions)
     while merged:
         merged = False
+        counters.count("merge_iterations")
         new_regions = []
         # exclude areas previously merged within cycle or tiles in exclusion zones 
         exclude_list = []
@@ -0,0 +1,262 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Hot loop kernels of the geometry, tiling and blanking code. Every kernel
+# has a pure NumPy implementation and, if Numba is installed, a JIT compiled
+# loop implementation (compiled on first use and cached on disk). The Numba
+# backend is selected automatically unless CATDAGGER_KERNELS=numpy is set.
+# Both backends make identical decisions (containment, rasterisation and
+# window placement) and accumulate sums in float64; floating point sums may
+# differ in rounding
+
+import os
+import numpy as np
+
+try:
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+_backend = "numba" if HAVE_NUMBA and os.environ.get("CATDAGGER_KERNELS", "numba") != "numpy" else "numpy"
+
+def backend():
+    """ Name of the kernel backend in use """
+    return _backend
+
+def use_backend(name):
+    """ Selects the 'numpy' or (if installed) 'numba' kernel backend """
+    global _backend
+    if name not in ["numpy", "numba"]:
+        raise ValueError("Unknown kernel backend {0:s}".format(name))
+    if name == "numba" and not HAVE_NUMBA:
+        raise ImportError("Numba is not installed")
+    _backend = name
+
+def _compiled(arrays):
+    # Numba only handles plain, native byte order arrays
+    return _backend == "numba" and all([isinstance(a, np.ndarray) and a.dtype.isnative for a in arrays])
+
+def window_bounds(shape, x, y, wnd_size):
+    """
+        Bounds (image row, col and window row, col lower bounds and extents)
+        of a square window of wnd_size centred (at index wnd_size // 2) on 
+        pixel x (row), y (column), clipped to an image of given shape
+    """
+    lx = x - wnd_size // 2
+    ly = y - wnd_size // 2
+    ix0 = max(lx, 0); ix1 = min(lx + wnd_size, shape[0])
+    iy0 = max(ly, 0); iy1 = min(ly + wnd_size, shape[1])
+    return ix0, ix1, iy0, iy1, ix0 - lx, iy0 - ly
+
+# NumPy implementations
+
+def _points_in_polygons_numpy(x, y, corners, edges, offsets, chunk_size=4096):
+    inside = np.zeros((x.shape[0], offsets.shape[0] - 1), dtype=bool)
+    for lo in range(0, x.shape[0], chunk_size):
+        hi = min(lo + chunk_size, x.shape[0])
+        px = x[lo:hi, None] - corners[None, :, 0]
+        py = y[lo:hi, None] - corners[None, :, 1]
+        left_of_edge = edges[None, :, 0] * py - edges[None, :, 1] * px >= -1.0e-9
+        inside[lo:hi, :] = np.logical_and.reduceat(left_of_edge, offsets[:-1], axis=1)
+    return inside
+
+def _paint_polygon_numpy(labels, corners, edges, value, r0, r1, c0, c1):
+    px, py = np.meshgrid(np.arange(c0, c1) + 0.5, np.arange(r0, r1) + 0.5)
+    inside = np.ones(px.shape, dtype=bool)
+    for (cx, cy), (ex, ey) in zip(corners, edges):
+        inside &= ex * (py - cy) - ey * (px - cx) >= -1.0e-9
+    labels[r0:r1, c0:c1][inside] = value
+
+def _tile_std_numpy(image, row_lower, row_upper, col_lower, col_upper):
+    stats = np.zeros((row_lower.shape[0], col_lower.shape[0]))
+    for y, (ly, uy) in enumerate(zip(row_lower, row_upper)):
+        for x, (lx, ux) in enumerate(zip(col_lower, col_upper)):
+            wnd = image[ly:uy, lx:ux].flatten()
+            stats[y, x] = np.std(wnd, dtype=np.float64)
+    return stats
+
+def _add_windows_numpy(image, wnd, xs, ys):
+    for x, y in zip(xs, ys):
+        ix0, ix1, iy0, iy1, wx0, wy0 = window_bounds(image.shape, x, y, wnd.shape[0])
+        image[ix0:ix1, iy0:iy1] += wnd[wx0:wx0 + ix1 - ix0, wy0:wy0 + iy1 - iy0]
+
+def _or_windows_numpy(mask, wnd, xs, ys):
+    for x, y in zip(xs, ys):
+        ix0, ix1, iy0, iy1, wx0, wy0 = window_bounds(mask.shape, x, y, wnd.shape[0])
+        mask[ix0:ix1, iy0:iy1] |= wnd[wx0:wx0 + ix1 - ix0, wy0:wy0 + iy1 - iy0]
+
+def _window_sums_numpy(image, wnd, xs, ys):
+    sums = np.zeros(len(xs))
+    for i, (x, y) in enumerate(zip(xs, ys)):
+        ix0, ix1, iy0, iy1, wx0, wy0 = window_bounds(image.shape, x, y, wnd.shape[0])
+        sums[i] = np.sum(image[ix0:ix1, iy0:iy1][wnd[wx0:wx0 + ix1 - ix0, wy0:wy0 + iy1 - iy0]],
+                         dtype=np.float64)
+    return sums
+
+# Numba implementations
+
+if HAVE_NUMBA:
+    _jit = numba.njit(cache=True, nogil=True)
+
+    @_jit
+    def _points_in_polygons_numba(x, y, corners, edges, offsets):
+        inside = np.zeros((x.shape[0], offsets.shape[0] - 1), dtype=np.bool_)
+        for p in range(x.shape[0]):
+            for r in range(offsets.shape[0] - 1):
+                left = True
+                for k in range(offsets[r], offsets[r + 1]):
+                    if edges[k, 0] * (y[p] - corners[k, 1]) - edges[k, 1] * (x[p] - corners[k, 0]) < -1.0e-9:
+                        left = False
+                        break
+                inside[p, r] = left
+        return inside
+
+    @_jit
+    def _paint_polygon_numba(labels, corners, edges, value, r0, r1, c0, c1):
+        for r in range(r0, r1):
+            py = r + 0.5
+            for c in range(c0, c1):
+                px = c + 0.5
+                left = True
+                for k in range(corners.shape[0]):
+                    if edges[k, 0] * (py - corners[k, 1]) - edges[k, 1] * (px - corners[k, 0]) < -1.0e-9:
+                        left = False
+                        break
+                if left:
+                    labels[r, c] = value
+
+    @_jit
+    def _tile_std_numba(image, row_lower, row_upper, col_lower, col_upper):
+        stats = np.zeros((row_lower.shape[0], col_lower.shape[0]))
+        for y in range(row_lower.shape[0]):
+            for x in range(col_lower.shape[0]):
+                n = (row_upper[y] - row_lower[y]) * (col_upper[x] - col_lower[x])
+                if n <= 0:
+                    stats[y, x] = np.nan
+                    continue
+                acc = 0.0
+                for i in range(row_lower[y], row_upper[y]):
+                    for j in range(col_lower[x], col_upper[x]):
+                        acc += np.float64(image[i, j])
+                mean = acc / n
+                acc = 0.0
+                for i in range(row_lower[y], row_upper[y]):
+                    for j in range(col_lower[x], col_upper[x]):
+                        d = np.float64(image[i, j]) - mean
+                        acc += d * d
+                stats[y, x] = np.sqrt(acc / n)
+        return stats
+
+    @_jit
+    def _window_bounds_numba(nrows, ncols, x, y, wnd_size):
+        lx = x - wnd_size // 2
+        ly = y - wnd_size // 2
+        ix0 = max(lx, 0); ix1 = min(lx + wnd_size, nrows)
+        iy0 = max(ly, 0); iy1 = min(ly + wnd_size, ncols)
+        return ix0, ix1, iy0, iy1, ix0 - lx, iy0 - ly
+
+    @_jit
+    def _add_windows_numba(image, wnd, xs, ys):
+        for s in range(xs.shape[0]):
+            ix0, ix1, iy0, iy1, wx0, wy0 = _window_bounds_numba(image.shape[0], image.shape[1],
+                                                                xs[s], ys[s], wnd.shape[0])
+            for i in range(ix0, ix1):
+                for j in range(iy0, iy1):
+                    image[i, j] += wnd[wx0 + i - ix0, wy0 + j - iy0]
+
+    @_jit
+    def _or_windows_numba(mask, wnd, xs, ys):
+        for s in range(xs.shape[0]):
+            ix0, ix1, iy0, iy1, wx0, wy0 = _window_bounds_numba(mask.shape[0], mask.shape[1],
+                                                                xs[s], ys[s], wnd.shape[0])
+            for i in range(ix0, ix1):
+                for j in range(iy0, iy1):
+                    if wnd[wx0 + i - ix0, wy0 + j - iy0]:
+                        mask[i, j] = True
+
+    @_jit
+    def _window_sums_numba(image, wnd, xs, ys):
+        sums = np.zeros(xs.shape[0])
+        for s in range(xs.shape[0]):
+            ix0, ix1, iy0, iy1, wx0, wy0 = _window_bounds_numba(image.shape[0], image.shape[1],
+                                                                xs[s], ys[s], wnd.shape[0])
+            for i in range(ix0, ix1):
+                for j in range(iy0, iy1):
+                    if wnd[wx0 + i - ix0, wy0 + j - iy0]:
+                        sums[s] += image[i, j]
+        return sums
+
+# Kernels
+
+def points_in_polygons(x, y, corners, edges, offsets, chunk_size=4096):
+    """
+        Membership matrix (npoints, npolygons) of points x, y in convex 
+        polygons with corners (and edges oriented with the interior to their
+        left) of polygon i at offsets[i]:offsets[i+1]
+    """
+    if _compiled([x, y, corners, edges, offsets]):
+        return _points_in_polygons_numba(x, y, corners, edges, offsets)
+    return _points_in_polygons_numpy(x, y, corners, edges, offsets, chunk_size)
+
+def paint_polygon(labels, corners, edges, value, r0, r1, c0, c1):
+    """
+        Sets pixels labels[r0:r1, c0:c1] with centres inside a convex polygon
+        to value, in place
+    """
+    if _compiled([labels, corners, edges]):
+        _paint_polygon_numba(labels, corners, edges, value, r0, r1, c0, c1)
+    else:
+        _paint_polygon_numpy(labels, corners, edges, value, r0, r1, c0, c1)
+
+def tile_std(image, row_lower, row_upper, col_lower, col_upper):
+    """
+        float64 standard deviation of every tile of image, which may be any 
+        object supporting 2D slicing 
+    """
+    if _compiled([image, row_lower, row_upper, col_lower, col_upper]):
+        return _tile_std_numba(image, row_lower, row_upper, col_lower, col_upper)
+    return _tile_std_numpy(image, row_lower, row_upper, col_lower, col_upper)
+
+def add_windows(image, wnd, xs, ys):
+    """ Adds a square window centred on every pixel xs (rows), ys (cols) to image, in place """
+    if _compiled([image, wnd, xs, ys]):
+        _add_windows_numba(image, wnd, xs, ys)
+    else:
+        _add_windows_numpy(image, wnd, xs, ys)
+
+def or_windows(mask, wnd, xs, ys):
+    """ ORs a square boolean window centred on every pixel xs (rows), ys (cols) into mask, in place """
+    if _compiled([mask, wnd, xs, ys]):
+        _or_windows_numba(mask, wnd, xs, ys)
+    else:
+        _or_windows_numpy(mask, wnd, xs, ys)
+
+def window_sums(image, wnd, xs, ys):
+    """
+        float64 sums of image under a square boolean window centred on every 
+        pixel xs (rows), ys (cols)
+    """
+    if _compiled([image, wnd, xs, ys]):
+        return _window_sums_numba(image, wnd, xs, ys)
+    return _window_sums_numpy(image, wnd, xs, ys)
@@ -26,9 +26,103 @@ from astropy.io import fits
 from astropy import wcs
 import Tigger
 from catdagger import logger
-from catdagger.geometry import BoundingBox, BoundingConvexHull
+from catdagger import counters
+from catdagger import state
+from catdagger.geometry import BoundingBox, BoundingConvexHull, RegionSet
+from catdagger.fits_tools import read_header
+from catdagger.coordinates import world2pix
 log = logger.getLogger("lsm_tools")
 
+def source_table(sources):
+    """ 
+        Tigger sources as a table of arrays: ra, dec (degrees), flux (Jy) and
+        gaussian shape ex, ey, pa (radians, zero for point sources)
+    """
+    def __shape(s, attr):
+        return getattr(s.shape, attr) if s.shape is not None and \
+                                         hasattr(s.shape, "typecode") and \
+                                         s.shape.typecode == "Gau" \
+            else 0
+    return {"ra": np.array([np.rad2deg(s.pos.ra) for s in sources], dtype=np.float64),
+            "dec": np.array([np.rad2deg(s.pos.dec) for s in sources], dtype=np.float64),
+            "flux": np.array([s.flux.I for s in sources], dtype=np.float64),
+            "ex": np.array([__shape(s, "ex") for s in sources], dtype=np.float64),
+            "ey": np.array([__shape(s, "ey") for s in sources], dtype=np.float64),
+            "pa": np.array([__shape(s, "pa") for s in sources], dtype=np.float64)}
+
+def tag_source_table(table, w, tagged_regions, known_members={}):
+    """
+        Finds the sources of a source table within each of the tagged regions
+        Members of regions given in known_members (region index to member 
+        indices) are not searched for again.
+        Returns per region arrays of member indices, the index of the 
+        brightest member (or None) and pixel positions of all sources
+    """
+    counters.count("catalog_sources", len(table["ra"]))
+    x, y = world2pix(w, table["ra"], table["dec"], 1)
+    search = [ireg for ireg in range(len(tagged_regions)) if ireg not in known_members]
+    inside = RegionSet([tagged_regions[ireg] for ireg in search]).contains_pixels(x, y)
+    members = [np.asarray(known_members[ireg], dtype=np.int64) if ireg in known_members else
+               np.flatnonzero(inside[:, search.index(ireg)]) for ireg in range(len(tagged_regions))]
+    leads = [m[np.argmax(table["flux"][m])] if len(m) > 0 else None for m in members]
+    return members, leads, x, y
+
+def tag_sources(sources, 
+                w, 
+                tagged_regions, 
+                regionsfn=None, 
+                de_tag="dE",
+                sky_regions=False,
+                statefn=None):
+    """
+        Tags and reclusters Tigger sources within the tagged regions
+        Cluster leads are only written to a DS9 regions file if regionsfn is given,
+        in fk5 sky coordinates if sky_regions is set. Members of regions carried
+        over unchanged in the tagging state statefn (see tiled_tesselator.tag_tiles)
+        are reused if the state was matched to the same catalog, and the members
+        of all regions are recorded in it
+        Returns per region arrays of member indices and the index of the cluster lead
+    """
+    table = source_table(sources)
+    catalog = state.catalog_fingerprint(table)
+    known = state.known_members(state.load_state(statefn), tagged_regions, catalog) \
+        if statefn is not None else {}
+    if statefn is not None:
+        print>>log, "Reusing catalog members of {0:d} of {1:d} regions carried over in state {2:s}".format(
+            len(known), len(tagged_regions), statefn)
+    members, leads, x, y = tag_source_table(table, w, tagged_regions, 
+                                            known_members=dict([(k, v[0]) for k, v in known.items()]))
+    f = open(regionsfn, "w+") if regionsfn is not None else None
+    try:
+        if f is not None:
+            f.write("# Region file format: DS9 version 4.0\n")
+            f.write("global color=green font=\"helvetica 6 normal roman\" edit=1 move=1 delete=1 highlite=1 include=1 wcs=wcs\n")
+        for ireg, reg in enumerate(tagged_regions):
+            print>>log, "Tagged sources in Region {0:d}:".format(ireg), str(reg)
+            for i in members[ireg]:
+                sources[i].setTag(de_tag, True)
+                sources[i].setTag("cluster", reg.name) #recluster sources
+            if leads[ireg] is not None:
+                s = sources[leads[ireg]]
+                s.setTag("cluster_lead", True)
+                if f is not None and sky_regions:
+                    f.write("fk5;circle({0:.6f}, {1:.6f}, 20\") # select=1 text={2:s}\n".format(
+                            table["ra"][leads[ireg]], table["dec"][leads[ireg]],
+                            "{%.2f mJy}" % (s.flux.I * 1.0e3)))
+                elif f is not None:
+                    f.write("physical;circle({0:d}, {1:d}, 20) # select=1 text={2:s}\n".format(
+                            int(x[leads[ireg]]), int(y[leads[ireg]]),
+                            "{%.2f mJy}" % (s.flux.I * 1.0e3)))
+                print>>log, "\t - {0:s} tagged as '{1:s}' cluster lead".format(s.name, de_tag)
+        if f is not None:
+            print>>log, "Writing tagged leads to DS9 regions file {0:s}".format(regionsfn)
+    finally:
+        if f is not None:
+            f.close()
+    if statefn is not None:
+        state.update_members(statefn, tagged_regions, members, leads, catalog)
+    return members, leads
+
 def tag_lsm(lsm,
             stokes_cube,
             tagged_regions,
@@ -36,37 +130,21 @@ def tag_lsm(lsm,
             regionsfn = "dE.srcs.reg",
             taggedlsm_fn="tagged.catalog.lsm.html",
             de_tag="dE",
-            store_only_dEs=False):
-    with fits.open(stokes_cube) as img:
-        cube = img[hdu_id].data
-        hdr = img[hdu_id].header
-        w = wcs.WCS(hdr)
-
-    with open(regionsfn, "w+") as f:
-        f.write("# Region file format: DS9 version 4.0\n")
-        f.write("global color=green font=\"helvetica 6 normal roman\" edit=1 move=1 delete=1 highlite=1 include=1 wcs=wcs\n")
-
-        mod = Tigger.load(lsm)
-        for ireg, reg in enumerate(tagged_regions):
-            print>>log, "Tagged sources in Region {0:d}:".format(ireg), str(reg)
-            encircled_sources = filter(lambda s: s in reg, mod.sources)
-            encircled_fluxes = [s.flux.I for s in encircled_sources]
-            for s in encircled_sources:
-                s.setTag(de_tag, True)
-                s.setTag("cluster", reg.name) #recluster sources
-            if len(encircled_fluxes) > 0:
-                argmax = np.argmax(encircled_fluxes)
-                s = encircled_sources[argmax]
-                s.setTag("cluster_lead", True)
-                ra = np.rad2deg(s.pos.ra)
-                dec = np.rad2deg(s.pos.dec)
-                x, y, _, _ = w.all_world2pix([[ra, dec, 0, 0]], 1)[0]
-                x = int(x)
-                y = int(y)
-                f.write("physical;circle({0:d}, {1:d}, 20) # select=1 text={2:s}\n".format(x, y,
-                        "{%.2f mJy}" % (s.flux.I * 1.0e3)))
-                print>>log, "\t - {0:s} tagged as '{1:s}' cluster lead".format(s.name, de_tag)
-        print>>log, "Writing tagged leads to DS9 regions file {0:s}".format(regionsfn)
+            store_only_dEs=False,
+            w=None,
+            statefn=None):
+    """
+        Tags the sources of a Tigger LSM within the tagged regions. Sources are
+        matched on the grid of the stokes_cube unless a (mosaic) WCS w is given,
+        in which case cluster leads are written in sky coordinates. Catalog 
+        members are carried over incrementally with the state in statefn
+    """
+    sky_regions = w is not None
+    if w is None:
+        hdr, w = read_header(stokes_cube, hdu_id)
+    mod = Tigger.load(lsm)
+    tag_sources(mod.sources, w, tagged_regions, regionsfn=regionsfn, de_tag=de_tag,
+                sky_regions=sky_regions, statefn=statefn)
     if store_only_dEs:
         print>>log, "Removing direction independent components from catalog before writing LSM"
         ncomp_di_dies = len(mod.sources)
@@ -0,0 +1,290 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import copy
+import numpy as np
+from astropy import wcs
+from astropy.wcs.utils import proj_plane_pixel_scales
+import scipy.spatial as spat
+from catdagger import logger
+from catdagger import counters
+from catdagger.geometry import BoundingConvexHull, merge_regions
+from catdagger.parallel import process_map
+from catdagger.fits_tools import read_header, StokesSliceReader
+from catdagger.tiled_tesselator import image_tile_statistics, flag_tiles, tile_boxes, region_filters, \
+    cull_regions
+log = logger.getLogger("mosaic")
+
+def mosaic_wcs(pointing_wcss):
+    """
+        Common celestial frame of a mosaic: a SIN projection tangent at the
+        mean pointing centre with the finest pixel scale of the pointings
+    """
+    ra = np.deg2rad([w.celestial.wcs.crval[0] for w in pointing_wcss])
+    dec = np.deg2rad([w.celestial.wcs.crval[1] for w in pointing_wcss])
+    vec = np.mean(np.column_stack([np.cos(dec) * np.cos(ra),
+                                   np.cos(dec) * np.sin(ra),
+                                   np.sin(dec)]), axis=0)
+    scale = min([np.min(proj_plane_pixel_scales(w.celestial)) for w in pointing_wcss])
+    mw = wcs.WCS(naxis=2)
+    mw.wcs.ctype = ["RA---SIN", "DEC--SIN"]
+    mw.wcs.crval = [np.rad2deg(np.arctan2(vec[1], vec[0])) % 360.0,
+                    np.rad2deg(np.arctan2(vec[2], np.hypot(vec[0], vec[1])))]
+    mw.wcs.crpix = [1.0, 1.0]
+    mw.wcs.cdelt = [-scale, scale]
+    ref = pointing_wcss[0].celestial.wcs
+    if ref.radesys:
+        mw.wcs.radesys = ref.radesys
+    if np.isfinite(ref.equinox):
+        mw.wcs.equinox = ref.equinox
+    return mw
+
+def sky_corners(region):
+    """ Corners (ra, dec in degrees) of a region on the grid of its own WCS """
+    # regions and catalog positions are matched with origin 1 throughout
+    return region.wcs.celestial.wcs_pix2world(np.asarray(region.corners, dtype=np.float64), 1)
+
+def project_regions(pointing_regions, mw):
+    """
+        Reprojects the (name, sigma, sky corners) of regions of every pointing
+        onto the pixel grid of the mosaic frame mw. Names are prefixed with
+        the pointing number. Returns the regions and their pointing numbers
+    """
+    projected = []
+    pointings = []
+    for ipt, regions in enumerate(pointing_regions):
+        for name, sigma, corners in regions:
+            pix = mw.wcs_world2pix(corners, 1)
+            projected.append(BoundingConvexHull(list(pix),
+                                                sigma=sigma,
+                                                name="p{0:d}:{1:s}".format(ipt, name),
+                                                wcs=mw,
+                                                imdata=None))
+            pointings.append(ipt)
+    return projected, pointings
+
+def _unit_vectors(ra, dec):
+    ra = np.deg2rad(ra); dec = np.deg2rad(dec)
+    return np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+class MosaicImage():
+    """
+        Band averaged images of the pointings of a mosaic, resampled (nearest
+        neighbour) onto the pixel grid of the mosaic frame mw on demand. Every
+        mosaic pixel takes the value of the pointing with the nearest centre
+        among those covering it, NaN outside all pointings (see select to
+        resample a subset of the pointings only). Only the pointing
+        pixels under a requested window are read, through section access.
+        Slices are in mosaic pixel coordinates, which may be negative. Stands
+        in for the band averaged image held by mosaic regions
+    """
+    def __init__(self, stokes_cubes, mw, hdu_id=0, use_stokes="I", single_precision=False):
+        self._readers = [StokesSliceReader(sc, hdu_id, use_stokes, single_precision=single_precision)
+                         for sc in stokes_cubes]
+        self._mw = mw
+
+    def select(self, pointings):
+        """ The mosaic of the given pointings (indices into stokes_cubes) only """
+        view = copy.copy(self)
+        view._readers = [self._readers[i] for i in pointings]
+        return view
+
+    def __getitem__(self, key):
+        rows, cols = key
+        cc, rr = np.meshgrid(np.arange(cols.start, cols.stop), np.arange(rows.start, rows.stop))
+        ra, dec = self._mw.wcs_pix2world(cc.ravel(), rr.ravel(), 1)
+        pos = _unit_vectors(ra, dec)
+        wnd = np.full(cc.size, np.nan)
+        nearest = np.full(cc.size, -np.inf)
+        for reader in self._readers:
+            pw = reader.wcs.celestial
+            px, py = pw.wcs_world2pix(ra, dec, 1)
+            inside = np.logical_and(np.isfinite(px), np.isfinite(py))
+            ix = np.where(inside, np.round(py), -1).astype(np.int64)
+            iy = np.where(inside, np.round(px), -1).astype(np.int64)
+            inside = np.logical_and(inside, np.logical_and(np.logical_and(ix >= 0, ix < reader.shape[0]),
+                                                           np.logical_and(iy >= 0, iy < reader.shape[1])))
+            # cosine of the separation from the pointing centre
+            closeness = np.dot(pos, _unit_vectors(*pw.wcs.crval).ravel())
+            take = np.logical_and(inside, closeness > nearest)
+            if not np.any(take):
+                continue
+            lx, ux = np.min(ix[take]), np.max(ix[take]) + 1
+            ly, uy = np.min(iy[take]), np.max(iy[take]) + 1
+            box = reader.read(slice(lx, ux), slice(ly, uy))
+            wnd[take] = box[ix[take] - lx, iy[take] - ly]
+            nearest[take] = closeness[take]
+        return wnd.reshape(cc.shape)
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def _size_classes(radii):
+    """ Indices of regions bucketed by circumradius, within a factor of 2 of each other """
+    classes = {}
+    for i, r in enumerate(radii):
+        classes.setdefault(int(np.floor(np.log2(max(r, 1.0)))), []).append(i)
+    return [np.array(idx) for _, idx in sorted(classes.items())]
+
+def merge_mosaic_regions(regions, min_sep_distance=1.0e-4):
+    """
+        Merges overlapping regions of all pointings (on one mosaic frame) into
+        convex hulls. Candidate neighbours are found on KD trees of the centres
+        of regions of similar size, within the sum of circumradii, and 
+        confirmed with the separating axis test, and connected regions are 
+        unioned. This is repeated until merged hulls no longer touch.
+        Returns the merged regions and the indices of the regions merged
+        into each
+    """
+    groups = [[i] for i in range(len(regions))]
+    merged = True
+    while merged and len(regions) > 1:
+        merged = False
+        counters.count("merge_iterations")
+        centres = np.array([reg.centre for reg in regions])
+        radii = np.array([np.max(np.linalg.norm(reg.corners - reg.centre, axis=1)) for reg in regions])
+        # a tree per size class keeps the search radius close to the pair 
+        # bound, so one large region does not make every query return all regions
+        trees = [(spat.cKDTree(centres[idx]), idx, np.max(radii[idx])) for idx in _size_classes(radii)]
+        parent = range(len(regions))
+        for i, reg in enumerate(regions):
+            for tree, idx, max_radius in trees:
+                for k in tree.query_ball_point(centres[i], radii[i] + max_radius + min_sep_distance):
+                    j = idx[k]
+                    if j <= i or _find(parent, i) == _find(parent, j):
+                        continue
+                    if np.linalg.norm(centres[i] - centres[j]) > radii[i] + radii[j] + min_sep_distance:
+                        continue
+                    if reg.is_neighbour(regions[j], min_sep_distance):
+                        print>>log, "\t - Merged regions {0:s} and {1:s}".format(reg.name, regions[j].name)
+                        parent[_find(parent, j)] = _find(parent, i)
+                        merged = True
+        components = {}
+        for i in range(len(regions)):
+            components.setdefault(_find(parent, i), []).append(i)
+        components = [members for _, members in sorted(components.items())]
+        regions = [BoundingConvexHull([regions[i] for i in members],
+                                      sigma=np.mean([regions[i].area_sigma for i in members]),
+                                      name="&".join([regions[i].name for i in members]),
+                                      wcs=regions[members[0]].wcs,
+                                      imdata=None) if len(members) > 1 else regions[members[0]]
+                   for members in components]
+        groups = [sorted(sum([groups[i] for i in members], [])) for members in components]
+    return regions, groups
+
+def write_sky_regions_file(regionsfn, tagged_regions):
+    """ Writes tagged regions as SAODS9 polygons in fk5 sky coordinates """
+    with open(regionsfn, "w+") as f:
+        f.write("# Region file format: DS9 version 4.0\n")
+        f.write("global color=red font=\"helvetica 6 normal roman\" edit=1 move=1 delete=1 highlite=1 include=1 wcs=wcs\n")
+        for reg in tagged_regions:
+            f.write("fk5; polygon({0:s}) #select=1 text={1:s}\n".format(
+                ",".join(["{0:.6f}".format(c) for c in sky_corners(reg).flatten()]),
+                "{mean area deviation %.2fx}" % reg.area_sigma))
+        print>>log, "Writing mosaic dE regions to DS9 regions file {0:s}".format(regionsfn)
+
+def _flag_pointing(job):
+    # module level so that pointings can be dispatched to worker processes.
+    # Tiles are flagged and merged, but not culled: regions straddling the
+    # edge of a pointing are only complete once merged across pointings.
+    # Only region outlines on the sky are returned to the parent
+    stokes_cube, kw = job
+    print>>log, "Flagging tiles of pointing {0:s}".format(stokes_cube)
+    band_avg, w, bin_lower, bin_upper, binned_stats, reference_stats = \
+        image_tile_statistics(stokes_cube, kw["block_size"], kw["hdu_id"], kw["use_stokes"],
+                              max_memory=kw["max_memory"], nthreads=kw["nthreads"],
+                              single_precision=kw["single_precision"], roi=kw["roi"])
+    flagged_tiles, percentile_stat, exclusion_zones = \
+        flag_tiles(binned_stats, bin_lower, bin_upper, w,
+                   sigma=kw["sigma"],
+                   global_stat_percentile=kw["global_stat_percentile"],
+                   min_distance_from_centre=kw["min_distance_from_centre"],
+                   exclusion_zones=kw["exclusion_zones"],
+                   reference_stats=reference_stats)
+    regions = tile_boxes(flagged_tiles, binned_stats / float(percentile_stat), bin_lower, bin_upper, w, band_avg)
+    print>>log, "Merging regions:"
+    regions = merge_regions(regions, exclusion_zones=exclusion_zones)
+    return [(reg.name, reg.area_sigma, sky_corners(reg)) for reg in regions]
+
+def tag_mosaic(stokes_cubes,
+               regionsfn = "dE.reg",
+               nprocs=1,
+               sigma = 2.3,
+               block_size=80,
+               hdu_id = 0,
+               use_stokes="I",
+               global_stat_percentile=30.0,
+               min_blocks_in_region = 3,
+               min_distance_from_centre = 0,
+               exclusion_zones=[],
+               max_right_skewness=np.inf,
+               max_abs_skewness=np.inf,
+               max_positive_to_negative_flux=np.inf,
+               max_memory=None,
+               nthreads=1,
+               single_precision=False,
+               roi=None):
+    """
+        Tags regions in a mosaic. Tiles of every pointing (one pointing per
+        worker process if nprocs > 1) are flagged against the noise of that 
+        pointing and merged (see tag_regions for the parameters). The regions
+        are projected onto a common mosaic frame, merged across pointings and
+        only then culled, once. Every region is culled on the images of the
+        pointings it was merged from, resampled onto the mosaic frame (see 
+        MosaicImage), as pixels of other pointings covering it need not
+        show the same errors. The minimum region area is counted in tiles of
+        the finest pointing.
+        Returns the tagged regions and the mosaic frame WCS
+    """
+    kw = dict(sigma=sigma, block_size=block_size, hdu_id=hdu_id, use_stokes=use_stokes,
+              global_stat_percentile=global_stat_percentile, min_distance_from_centre=min_distance_from_centre,
+              exclusion_zones=exclusion_zones, max_memory=max_memory, nthreads=nthreads,
+              single_precision=single_precision, roi=roi)
+    results = process_map(_flag_pointing, [(sc, kw) for sc in stokes_cubes], nprocs=nprocs)
+    mw = mosaic_wcs([read_header(sc, hdu_id)[1] for sc in stokes_cubes])
+    print>>log, "Mosaic frame centred at RA {0:.4f}, Dec {1:.4f} degrees".format(*mw.wcs.crval)
+    regions, pointings = project_regions(results, mw)
+    print>>log, "Merging {0:d} regions of {1:d} pointings:".format(len(regions), len(stokes_cubes))
+    merged_regions, groups = merge_mosaic_regions(regions)
+    image = MosaicImage(stokes_cubes, mw, hdu_id, use_stokes, single_precision=single_precision)
+    images = [image.select(sorted(set([pointings[i] for i in group]))) for group in groups]
+    for reg, reg_image in zip(merged_regions, images):
+        reg.attach(reg_image)
+    print>>log, "Culling mosaic regions based on filtering criteria:"
+    filters = region_filters(min_blocks_in_region * block_size**2, 
+                             max_right_skewness, max_abs_skewness, max_positive_to_negative_flux)
+    tagged_regions = cull_regions(merged_regions, filters, images, nprocs=nprocs)
+    if len(tagged_regions) == len(merged_regions):
+        print>>log, "\t - No cullings"
+    if regionsfn is not None:
+        write_sky_regions_file(regionsfn, tagged_regions)
+    print>>log, "The following mosaic regions are tagged:"
+    if len(tagged_regions) > 0:
+        for r in tagged_regions:
+            print>>log, "\t - {0:s}".format(str(r))
+    else:
+        print>>log, "\t - No regions met cutoff criteria. No dE tags shall be raised."
+    return tagged_regions, mw
@@ -0,0 +1,67 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+def row_chunks(nrows, nchunks, multiple_of=1):
+    """
+        Splits [0, nrows) into at most nchunks contiguous (lower, upper) ranges
+        with boundaries on multiples of multiple_of
+    """
+    nblocks = (nrows + multiple_of - 1) // multiple_of
+    nchunks = max(1, min(nchunks, nblocks))
+    bounds = [(nblocks * i // nchunks) * multiple_of for i in range(nchunks + 1)]
+    return [(lo, min(hi, nrows)) for lo, hi in zip(bounds[:-1], bounds[1:]) if lo < hi]
+
+def thread_map(func, args, nthreads=1):
+    """
+        Ordered map over a pool of threads. Only useful for functions that
+        spend their time in numpy routines or I/O which release the GIL
+    """
+    args = list(args)
+    if nthreads <= 1 or len(args) <= 1:
+        return map(func, args)
+    pool = ThreadPool(min(nthreads, len(args)))
+    try:
+        return pool.map(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+def process_map(func, args, nprocs=1, initializer=None, initargs=()):
+    """
+        Ordered map over a pool of worker processes. func must be a module
+        level function and its arguments picklable. initializer(*initargs)
+        is run once in every worker (and once in process if nprocs <= 1)
+    """
+    args = list(args)
+    if nprocs <= 1 or len(args) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return map(func, args)
+    pool = Pool(min(nprocs, len(args)), initializer=initializer, initargs=initargs)
+    try:
+        return pool.map(func, args)
+    finally:
+        pool.close()
+        pool.join()
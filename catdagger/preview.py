@@ -0,0 +1,153 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import numpy as np
+import scipy.stats as sstats
+from catdagger import logger
+from catdagger import state
+from catdagger.fits_tools import StokesSliceReader
+from catdagger.tiled_tesselator import tile_grid, tile_statistics, tag_tiles, flag_tiles
+log = logger.getLogger("preview")
+
+class DecimatedImage():
+    """
+        Nearest neighbour view of an image of the given full shape of which
+        only every factor'th row and column was read. Slices in full image 
+        pixel coordinates return full resolution windows, so it stands in for
+        the band averaged image held by regions
+    """
+    def __init__(self, decimated, factor, shape):
+        self._decimated = decimated
+        self._factor = factor
+        self._shape = tuple(shape)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def decimated(self):
+        return self._decimated
+
+    @property
+    def factor(self):
+        return self._factor
+
+    def __getitem__(self, key):
+        rows, cols = key
+        rows = np.arange(*rows.indices(self._shape[0])) // self._factor
+        cols = np.arange(*cols.indices(self._shape[1])) // self._factor
+        return self._decimated[np.ix_(rows, cols)]
+
+def decimated_tile_statistics(decimated, factor, bin_lower, bin_upper, nthreads=1):
+    """
+        Statistics of the full resolution tiles from the decimated samples 
+        falling within them. Returns the statistics and number of samples 
+        of every tile
+    """
+    dlower = (bin_lower + factor - 1) // factor
+    dupper = (bin_upper + factor - 1) // factor
+    binned_stats = tile_statistics(decimated, dlower, dupper, dlower, dupper, nthreads=nthreads)
+    nsamples = np.outer(dupper - dlower, dupper - dlower)
+    return binned_stats, nsamples
+
+def flag_probability(binned_stats, nsamples, percentile_stat, sigma):
+    """
+        Probability that the std of every tile exceeds the cutoff of 
+        sigma * percentile_stat, given that the std of n gaussian samples has
+        a relative standard error of 1 / sqrt(2 (n - 1)). The error of the
+        global percentile (taken over many tiles) is neglected
+    """
+    rel_err = 1.0 / np.sqrt(2.0 * np.maximum(nsamples - 1, 1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (binned_stats - sigma * percentile_stat) / (binned_stats * rel_err)
+    return sstats.norm.cdf(z)
+
+def region_confidence(tagged_regions, prob, flagged_tiles, bin_lower, bin_upper):
+    """ Mean flag probability of the flagged tiles within every region """
+    labels = state.region_tiles(tagged_regions, flagged_tiles, bin_lower, bin_upper)
+    return [float(np.mean(prob[labels == i + 1])) if np.any(labels == i + 1) else np.nan
+            for i in range(len(tagged_regions))]
+
+def tag_preview(stokes_cube,
+                decimation=4,
+                regionsfn="dE.reg",
+                sigma=2.3,
+                block_size=80,
+                hdu_id=0,
+                use_stokes="I",
+                global_stat_percentile=30.0,
+                nthreads=1,
+                single_precision=False,
+                confidence_level=0.95,
+                **kwargs):
+    """
+        Quick look tagging from every decimation'th row and column of the
+        band averaged image (1 / decimation**2 of the pixels). The tile 
+        grid, merging, culling and outputs are those of a full run, with 
+        the culling filters evaluated on the decimated samples. kwargs are
+        passed on to tag_tiles.
+
+        Returns the tagged regions and a confidence summary: the probability
+        that the flagged tiles of every region truly exceed the cutoff and 
+        the fraction of tiles flagged (or not) with at least confidence_level
+    """
+    if block_size % decimation != 0 or block_size // decimation < 2:
+        raise ValueError("Preview decimation factor must divide the tile size and leave at least 2 "
+                         "samples per tile axis")
+    reader = StokesSliceReader(stokes_cube, hdu_id, use_stokes, single_precision=single_precision)
+    w = reader.wcs
+    print>>log, "Previewing every {0:d}th row and column of the image ({1:.1f}% of the pixels)".format(
+        decimation, 100.0 / decimation**2)
+    band_avg = DecimatedImage(reader.read_decimated(decimation, nthreads=nthreads), decimation, reader.shape)
+    bin_lower, bin_upper = tile_grid(reader.shape, block_size)
+    binned_stats, nsamples = decimated_tile_statistics(band_avg.decimated, decimation, bin_lower, bin_upper,
+                                                       nthreads=nthreads)
+    # the confidence of a region is taken over the tiles tag_tiles flagged
+    flags = flag_tiles(binned_stats, bin_lower, bin_upper, w,
+                       sigma=sigma,
+                       global_stat_percentile=global_stat_percentile,
+                       min_distance_from_centre=kwargs.pop("min_distance_from_centre", 0),
+                       exclusion_zones=kwargs.pop("exclusion_zones", []),
+                       reference_stats=kwargs.pop("reference_stats", None))
+    tagged_regions = tag_tiles(band_avg, w, binned_stats, bin_lower, bin_upper,
+                               regionsfn=regionsfn,
+                               sigma=sigma,
+                               block_size=block_size,
+                               global_stat_percentile=global_stat_percentile,
+                               flags=flags,
+                               **kwargs)
+    flagged_tiles, percentile_stat, _ = flags
+    prob = flag_probability(binned_stats, nsamples, percentile_stat, sigma)
+    confidence = region_confidence(tagged_regions, prob, flagged_tiles, bin_lower, bin_upper)
+    valid = np.isfinite(prob)
+    decided = np.logical_or(prob >= confidence_level, prob <= 1.0 - confidence_level)[valid]
+    print>>log, "Preview confidence: {0:d} of {1:d} tiles flagged or passed with at least {2:.0f}% " \
+                "confidence ({3:d} samples per tile)".format(int(np.sum(decided)), decided.size,
+                                                            confidence_level * 100.0,
+                                                            int(np.max(nsamples)))
+    for reg, conf in zip(tagged_regions, confidence):
+        print>>log, "\t - {0:s}: {1:.1f}% confidence".format(reg.name, conf * 100.0)
+    return tagged_regions, {"regions": confidence,
+                            "decided_tiles": float(np.mean(decided)) if decided.size > 0 else np.nan,
+                            "samples_per_tile": int(np.max(nsamples))}
@@ -0,0 +1,114 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from multiprocessing import Pool
+from astropy.wcs.utils import proj_plane_pixel_scales
+from catdagger.gauss2 import gaussfit, moments
+from catdagger import logger
+log = logger.getLogger("psf_fitting")
+
+FWHM_PER_SIGMA = 2.0 * np.sqrt(2.0 * np.log(2.0))
+
+def crop_main_lobe(psf, min_half_width=3):
+    """
+        Window of a 2D PSF around its peak spanning roughly three times the
+        half power width of the main lobe (found along the rows and columns
+        through the peak). Returns the window and the (row, col) offset of
+        its corner in the image
+    """
+    px, py = np.unravel_index(np.nanargmax(psf), psf.shape)
+    peak = psf[px, py]
+    def __half_width(profile, centre):
+        below = np.flatnonzero(profile < 0.5 * peak)
+        lower = below[below < centre]
+        upper = below[below > centre]
+        left = centre - lower[-1] if lower.size > 0 else centre
+        right = upper[0] - centre if upper.size > 0 else profile.size - 1 - centre
+        return max(left, right)
+    hw = max(3 * max(__half_width(psf[:, py], px), __half_width(psf[px, :], py)), min_half_width)
+    lx = max(px - hw, 0); ux = min(px + hw + 1, psf.shape[0])
+    ly = max(py - hw, 0); uy = min(py + hw + 1, psf.shape[1])
+    return np.array(psf[lx:ux, ly:uy], dtype=np.float64), (lx, ly)
+
+def fit_main_lobe(crop):
+    """
+        Fits an elliptical gaussian (zero pedestal) to a cropped, peak
+        normalised main lobe with the analytic Jacobian.
+        Returns the fitted (amplitude, row, col, sigma_row, sigma_col, rotation)
+    """
+    crop = crop / np.nanmax(crop)
+    crop[np.logical_not(np.isfinite(crop))] = 0.0
+    p0 = moments(crop, circle=0, rotate=1, vheight=0)
+    # seed the axes and rotation from the second moments of the lobe: the row and
+    # column widths alone leave a lobe at 45 degrees on a circular saddle point
+    weights = np.clip(crop, 0.0, None)
+    rows, cols = np.indices(crop.shape)
+    dr, dc = rows - p0[1], cols - p0[2]
+    cov = np.array([[np.sum(weights * dr * dr), np.sum(weights * dr * dc)],
+                    [np.sum(weights * dr * dc), np.sum(weights * dc * dc)]]) / np.sum(weights)
+    evals, evecs = np.linalg.eigh(cov)
+    # twodgaussian measures sigma_row along (row, col) = (cos rota, -sin rota)
+    rota = np.rad2deg(np.arctan2(-evecs[1, 1], evecs[0, 1]))
+    p0 = list(p0[:3]) + [np.sqrt(evals[1]), np.sqrt(max(evals[0], 0.0)), rota]
+    return gaussfit(crop, params=p0, autoderiv=0, circle=0, rotate=1, vheight=0)
+
+def _fit_main_lobe(crop):
+    # module level so that it can be dispatched to worker processes
+    return fit_main_lobe(crop)
+
+def beam_from_fit(params, w):
+    """
+        Converts fitted pixel gaussian parameters to the (BMIN, BMAJ, BPA) in
+        degrees used in FITS headers (FWHM, position angle north through east)
+    """
+    _, _, _, sigma_row, sigma_col, rota = params
+    cdelt = proj_plane_pixel_scales(w.celestial)
+    fwhm_row = FWHM_PER_SIGMA * np.abs(sigma_row) * cdelt[1]
+    fwhm_col = FWHM_PER_SIGMA * np.abs(sigma_col) * cdelt[0]
+    # the ellipse axis of sigma_row points (north, east) = (cos rota, sin rota) if
+    # RA increases to the left of the image (negative CDELT), which is the norm
+    east = 1.0 if w.celestial.wcs.cdelt[0] < 0 else -1.0
+    if fwhm_row >= fwhm_col:
+        bmaj, bmin, bpa = fwhm_row, fwhm_col, east * rota
+    else:
+        bmaj, bmin, bpa = fwhm_col, fwhm_row, east * rota - 90.0
+    bpa = (bpa + 90.0) % 180.0 - 90.0
+    return bmin, bmaj, bpa
+
+def fit_beams(psf_planes, w, nprocs=1):
+    """
+        Fits the clean beam (BMIN, BMAJ, BPA in degrees) of every (ny, nx) plane
+        of psf_planes. Only the cropped main lobes are shipped to a pool of
+        nprocs worker processes
+    """
+    crops = [crop_main_lobe(plane)[0] for plane in psf_planes]
+    if nprocs > 1 and len(crops) > 1:
+        pool = Pool(min(nprocs, len(crops)))
+        try:
+            fits = pool.map(_fit_main_lobe, crops)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        fits = map(_fit_main_lobe, crops)
+    return [beam_from_fit(p, w) for p in fits]
@@ -0,0 +1,42 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+from catdagger import logger
+from catdagger.fits_tools import restore_delta_backup
+log = logger.getLogger("restore")
+
+def main():
+    parser = argparse.ArgumentParser("CATDagger model image restore (C) SARAO, Benjamin Hugo 2019")
+    parser.add_argument("model_images",
+                        nargs="+",
+                        help="Blanked model FITS images to restore from their <model>.delta.npz backups")
+    parser.add_argument("--keep-backup",
+                        action="store_true",
+                        help="Keep the delta backups after restoring")
+    args = parser.parse_args()
+    for fn in args.model_images:
+        restore_delta_backup(fn, remove=not args.keep_backup)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import numpy as np
+from astropy.wcs.utils import proj_plane_pixel_scales
+from catdagger import logger
+from catdagger.coordinates import world2pix
+log = logger.getLogger("roi")
+
+class PixelBoxROI():
+    """ Pixel box [xmin, xmax) x [ymin, ymax), x along columns, y along rows """
+    def __init__(self, xmin, ymin, xmax, ymax):
+        if xmax <= xmin or ymax <= ymin:
+            raise ValueError("Region of interest box must have xmax > xmin and ymax > ymin")
+        self._box = (int(xmin), int(ymin), int(xmax), int(ymax))
+
+    def __str__(self):
+        return "box ({0:d}, {1:d}) to ({2:d}, {3:d}) px".format(*self._box)
+
+    def to_pixel_box(self, w, shape):
+        """ (row lower, row upper, col lower, col upper) clipped to an image of shape """
+        xmin, ymin, xmax, ymax = self._box
+        return clip_box((ymin, ymax, xmin, xmax), shape)
+
+class SkyCircleROI():
+    """ Circle of radius (deg) around sky position (ra, dec) in degrees """
+    def __init__(self, ra, dec, radius):
+        self._ra = float(ra)
+        self._dec = float(dec)
+        self._radius = float(radius)
+
+    def __str__(self):
+        return "sky circle ({0:.4f}, {1:.4f}, {2:.4f} deg)".format(self._ra, self._dec, self._radius)
+
+    def to_pixel_box(self, w, shape):
+        """ (row lower, row upper, col lower, col upper) bounding the circle, clipped to shape """
+        x, y = world2pix(w, self._ra, self._dec, 0)
+        r = self._radius / np.max(np.abs(proj_plane_pixel_scales(w.celestial)))
+        return clip_box((int(np.floor(y[0] - r)), int(np.ceil(y[0] + r)) + 1,
+                         int(np.floor(x[0] - r)), int(np.ceil(x[0] + r)) + 1), shape)
+
+def clip_box(box, shape):
+    r0, r1, c0, c1 = box
+    r0 = max(r0, 0); r1 = min(r1, shape[0])
+    c0 = max(c0, 0); c1 = min(c1, shape[1])
+    if r1 <= r0 or c1 <= c0:
+        raise ValueError("Region of interest does not overlap the image")
+    return r0, r1, c0, c1
+
+def tile_aligned_box(box, block_size, shape):
+    """ Grows a (row lower, row upper, col lower, col upper) box to whole tiles of the image grid """
+    r0, r1, c0, c1 = box
+    return (r0 // block_size * block_size, min((r1 + block_size - 1) // block_size * block_size, shape[0]),
+            c0 // block_size * block_size, min((c1 + block_size - 1) // block_size * block_size, shape[1]))
+
+class WindowedImage():
+    """
+        Window [r0:r0 + window rows, c0:c0 + window cols] of an image of the
+        given full shape, sliced in full image pixel coordinates. Stands in 
+        for the band averaged image held by regions within the window
+    """
+    def __init__(self, window, r0, c0, shape):
+        self._window = window
+        self._r0 = r0
+        self._c0 = c0
+        self._shape = tuple(shape)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def window(self):
+        return self._window
+
+    def __getitem__(self, key):
+        rows, cols = key
+        rows = slice(*rows.indices(self._shape[0]))
+        cols = slice(*cols.indices(self._shape[1]))
+        if rows.start < self._r0 or rows.stop > self._r0 + self._window.shape[0] or \
+           cols.start < self._c0 or cols.stop > self._c0 + self._window.shape[1]:
+            raise IndexError("Slice lies outside the region of interest")
+        return self._window[rows.start - self._r0:rows.stop - self._r0, 
+                            cols.start - self._c0:cols.stop - self._c0]
@@ -0,0 +1,163 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    Resident tagging service
+
+    Keeps the heavy modules imported and parsed FITS headers / WCS cached
+    between tagging jobs. A job is a JSON object {"args": [...]} holding the
+    same arguments accepted by the dagger command line, e.g.
+    {"args": ["residual.fits", "--input-lsm", "sky.lsm.html", "-s", "2.5"]}.
+    Jobs are accepted over a local UNIX socket (one JSON line per connection,
+    answered with one JSON line) or from a spool directory (<name>.job.json
+    files, answered with <name>.result.json files)
+"""
+
+import argparse
+import glob
+import json
+import os
+import socket
+import time
+import traceback
+from catdagger import logger
+from catdagger import __main__ as driver
+from catdagger.fits_tools import peak_rss
+log = logger.getLogger("server")
+
+def run_job(job):
+    """ Runs a single job dictionary, returning a JSON serializable response """
+    tic = time.time()
+    try:
+        if not isinstance(job, dict) or not isinstance(job.get("args", None), list):
+            raise ValueError("Job must be an object with an 'args' list")
+        # argparse type checkers expect native strings
+        args = driver.build_parser().parse_args([str(a) for a in job["args"]])
+        result = driver.run(args)
+        response = {"status": "ok", "result": result}
+    except SystemExit:
+        response = {"status": "error", "error": "Invalid job arguments {0:s}".format(str(job.get("args", None)))}
+    except Exception as e:
+        print>>log, "Job failed: {0:s}".format(traceback.format_exc())
+        response = {"status": "error", "error": str(e)}
+    response["stats"] = {"wallclock": time.time() - tic,
+                         "peak_rss": peak_rss()}
+    print>>log, "Job finished with status '{0:s}' in {1:.2f} s".format(response["status"],
+                                                                      response["stats"]["wallclock"])
+    return response
+
+def serve_socket(socket_path):
+    """ Serves jobs sequentially over a UNIX stream socket """
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_path)
+    # jobs write and overwrite files as the server user: owner only access,
+    # set before listening so no connection is accepted with wider access
+    os.chmod(socket_path, 0o600)
+    sock.listen(1)
+    print>>log, "Waiting for tagging jobs on UNIX socket {0:s}".format(socket_path)
+    try:
+        while True:
+            conn, _ = sock.accept()
+            try:
+                f = conn.makefile("rw")
+                line = f.readline()
+                if line.strip() == "":
+                    continue
+                try:
+                    job = json.loads(line)
+                except ValueError:
+                    response = {"status": "error", "error": "Job is not valid JSON"}
+                else:
+                    response = run_job(job)
+                f.write(json.dumps(response) + "\n")
+                f.flush()
+            finally:
+                conn.close()
+    finally:
+        sock.close()
+        os.unlink(socket_path)
+
+def serve_spool(spool_dir, poll_interval=0.5):
+    """ Serves <name>.job.json files dropped into spool_dir in order of arrival """
+    print>>log, "Waiting for tagging jobs in spool directory {0:s}".format(spool_dir)
+    while True:
+        jobs = sorted(glob.glob(os.path.join(spool_dir, "*.job.json")), key=os.path.getmtime)
+        if len(jobs) == 0:
+            time.sleep(poll_interval)
+            continue
+        jobfn = jobs[0]
+        name = jobfn[:-len(".job.json")]
+        # claim the job so that concurrent servers don't pick it up
+        try:
+            os.rename(jobfn, name + ".running")
+        except OSError:
+            continue
+        try:
+            with open(name + ".running") as f:
+                job = json.load(f)
+        except ValueError:
+            response = {"status": "error", "error": "Job is not valid JSON"}
+        else:
+            response = run_job(job)
+        with open(name + ".result.json.tmp", "w") as f:
+            json.dump(response, f)
+        os.rename(name + ".result.json.tmp", name + ".result.json")
+        os.unlink(name + ".running")
+
+def submit_job(socket_path, args):
+    """ Client helper: submits a list of dagger arguments and waits for the response """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        f = sock.makefile("rw")
+        f.write(json.dumps({"args": list(args)}) + "\n")
+        f.flush()
+        return json.loads(f.readline())
+    finally:
+        sock.close()
+
+def main():
+    parser = argparse.ArgumentParser("CATDagger resident tagging service (C) SARAO, Benjamin Hugo 2019")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--socket",
+                       type=str,
+                       help="UNIX socket path to accept tagging jobs on")
+    group.add_argument("--spool-dir",
+                       type=str,
+                       help="Directory to poll for <name>.job.json tagging jobs. "
+                            "Results are written to <name>.result.json")
+    parser.add_argument("--poll-interval",
+                        type=float,
+                        default=0.5,
+                        help="Spool directory polling interval in seconds")
+    args = parser.parse_args()
+    if args.socket is not None:
+        serve_socket(args.socket)
+    else:
+        if not os.path.isdir(args.spool_dir):
+            raise IOError("Spool directory {0:s} does not exist".format(args.spool_dir))
+        serve_spool(args.spool_dir, args.poll_interval)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import hashlib
+import numpy as np
+import scipy.ndimage as ndi
+from catdagger import logger
+from catdagger.geometry import BoundingConvexHull, RegionSet
+log = logger.getLogger("state")
+
+# lead of regions not (yet) matched to a catalog
+UNKNOWN_LEAD = -2
+
+def fingerprint(*items):
+    """ Digest of the string representations of items """
+    return hashlib.sha1("|".join([repr(i) if not isinstance(i, np.ndarray) else 
+                                  repr(i.tolist()) for i in items]).encode("utf-8")).hexdigest()
+
+def grid_fingerprint(w, bin_lower, bin_upper, *settings):
+    """ Digest of the tile grid on the celestial axes of w and the culling settings """
+    return fingerprint(w.celestial.to_header_string(), bin_lower, bin_upper, *settings)
+
+def catalog_fingerprint(table):
+    """ Digest of the positions and fluxes of a source table """
+    return fingerprint(table["ra"], table["dec"], table["flux"])
+
+def region_tiles(regions, flagged_tiles, bin_lower, bin_upper):
+    """
+        Label (1 + region index, 0 for none) of every flagged tile whose centre 
+        lies within one of the regions
+    """
+    labels = np.zeros(flagged_tiles.shape, dtype=np.int32)
+    ty, tx = np.nonzero(flagged_tiles)
+    if len(regions) == 0 or ty.size == 0:
+        return labels
+    cx = 0.5 * (bin_lower[tx] + bin_upper[tx])
+    cy = 0.5 * (bin_lower[ty] + bin_upper[ty])
+    inside = RegionSet(regions).contains_pixels(cx, cy)
+    found = np.any(inside, axis=1)
+    labels[ty[found], tx[found]] = np.argmax(inside[found], axis=1) + 1
+    return labels
+
+def save_state(statefn, grid, deviation, flagged_tiles, regions, rejected_by, tile_labels,
+               catalog="", members=None, leads=None):
+    """
+        Writes the tile flags and normalised tile deviations, the merged
+        regions (kept and culled, with the filter rejecting them) and the
+        catalog members and lead of every region to statefn. A lead of -1
+        marks regions without members, -2 regions not matched to the catalog
+    """
+    members = members if members is not None else [[] for _ in regions]
+    leads = leads if leads is not None else [UNKNOWN_LEAD for _ in regions]
+    corners = [np.asarray(reg.corners) for reg in regions]
+    with open(statefn, "wb") as f:
+        np.savez_compressed(f,
+                            grid=np.array(grid),
+                            deviation=deviation,
+                            flagged_tiles=flagged_tiles,
+                            tile_labels=tile_labels,
+                            names=np.array([reg.name for reg in regions] + [""]),
+                            sigma=np.array([reg.area_sigma for reg in regions], dtype=np.float64),
+                            corner_offsets=np.cumsum([0] + [c.shape[0] for c in corners]),
+                            corners=np.vstack(corners + [np.zeros((0, 2), dtype=corners[0].dtype 
+                                                                  if len(corners) > 0 else np.float64)]),
+                            rejected_by=np.array([rejected_by.get(reg.name, "") for reg in regions] + [""]),
+                            catalog=np.array(catalog),
+                            member_offsets=np.cumsum([0] + [len(m) for m in members]),
+                            members=np.concatenate([np.asarray(m, dtype=np.int64) for m in members] + 
+                                                   [np.zeros(0, dtype=np.int64)]),
+                            leads=np.array(leads, dtype=np.int64))
+    print>>log, "Writing tagging state to {0:s}".format(statefn)
+
+def load_state(statefn, grid=None):
+    """
+        Reads a tagging state written by save_state. Returns None if there is 
+        none or if it was made on another grid or with other settings
+    """
+    if statefn is None or not os.path.exists(statefn):
+        return None
+    with np.load(statefn) as f:
+        state = {k: f[k] for k in f.files}
+    if grid is not None and str(state["grid"]) != grid:
+        print>>log, "Ignoring tagging state {0:s} made on another tile grid or with other culling " \
+                    "settings".format(statefn)
+        return None
+    nreg = state["sigma"].shape[0]
+    state["names"] = [str(n) for n in state["names"][:nreg]]
+    state["rejected_by"] = [str(n) for n in state["rejected_by"][:nreg]]
+    state["catalog"] = str(state["catalog"])
+    return state
+
+def state_corners(state, i):
+    return state["corners"][state["corner_offsets"][i]:state["corner_offsets"][i + 1]]
+
+def state_members(state, i):
+    return state["members"][state["member_offsets"][i]:state["member_offsets"][i + 1]]
+
+def changed_tiles(state, flagged_tiles, deviation, tolerance):
+    """
+        Tiles flagged in only one of the runs and flagged tiles whose deviation
+        from the global noise changed by more than the relative tolerance
+    """
+    prev_dev = state["deviation"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        drift = np.abs(deviation - prev_dev) > tolerance * np.abs(prev_dev)
+    return np.logical_or(flagged_tiles != state["flagged_tiles"],
+                         np.logical_and(flagged_tiles, drift))
+
+def reusable_regions(state, changed, w, imdata):
+    """
+        Regions of a previous run none of whose tiles (or tiles neighbouring
+        its tile bounding box) changed. Returns the regions (attached to 
+        imdata), the filters that rejected them ("" if kept), their indices 
+        in the state and a mask of the tiles they cover
+    """
+    near_change = ndi.binary_dilation(changed, structure=np.ones((3, 3), dtype=np.bool))
+    labels = state["tile_labels"]
+    regions, rejected_by, indices = [], [], []
+    covered = np.zeros(changed.shape, dtype=np.bool)
+    for i in range(len(state["names"])):
+        ty, tx = np.nonzero(labels == i + 1)
+        if ty.size == 0 or np.any(near_change[ty.min():ty.max() + 1, tx.min():tx.max() + 1]):
+            continue
+        regions.append(BoundingConvexHull(list(state_corners(state, i)), 
+                                          state["sigma"][i], state["names"][i], w, imdata))
+        rejected_by.append(state["rejected_by"][i])
+        indices.append(i)
+        covered[labels == i + 1] = True
+    return regions, rejected_by, indices, covered
+
+def known_members(state, tagged_regions, catalog):
+    """
+        Catalog members and leads of tagged regions carried over unchanged 
+        from the state, if it was matched to the same catalog.
+        Returns a dictionary of region index to (members, lead)
+    """
+    known = {}
+    if state is None or state["catalog"] != catalog:
+        return known
+    index = dict([(n, i) for i, n in enumerate(state["names"]) if state["rejected_by"][i] == ""])
+    for ireg, reg in enumerate(tagged_regions):
+        i = index.get(reg.name)
+        if i is None or state["leads"][i] == UNKNOWN_LEAD:
+            continue
+        if not np.array_equal(np.sort(state_corners(state, i), axis=0), np.sort(reg.corners, axis=0)):
+            continue
+        known[ireg] = (state_members(state, i), state["leads"][i])
+    return known
+
+def update_members(statefn, tagged_regions, members, leads, catalog):
+    """ Records the catalog members and leads of the tagged regions in the state """
+    state = load_state(statefn)
+    if state is None:
+        return
+    index = dict([(n, i) for i, n in enumerate(state["names"])])
+    nreg = len(state["names"])
+    new_members = [state_members(state, i) for i in range(nreg)]
+    new_leads = [l if state["catalog"] == catalog else UNKNOWN_LEAD for l in state["leads"]]
+    for reg, m, l in zip(tagged_regions, members, leads):
+        if reg.name in index:
+            new_members[index[reg.name]] = m
+            new_leads[index[reg.name]] = -1 if l is None else l
+    regions = [BoundingConvexHull(list(state_corners(state, i)), state["sigma"][i], 
+                                  state["names"][i], None, None) for i in range(nreg)]
+    save_state(statefn, str(state["grid"]), state["deviation"], state["flagged_tiles"],
+               regions, dict(zip(state["names"], state["rejected_by"])), state["tile_labels"],
+               catalog=catalog, members=new_members, leads=new_leads)
@@ -1,4 +1,5 @@
-import copy
+import os
+import tempfile
 import numpy as np
 from astropy.io import fits
 from astropy import wcs
@@ -8,12 +9,479 @@ import scipy.signal as ssig
 import scipy.spatial as spat
 import Tigger
 from catdagger import logger
-from catdagger.filters import within_radius_from, \
-    notin, arealess, skewness_more, pos2neg_more
-from catdagger.geometry import BoundingBox, BoundingConvexHull, merge_regions
-from catdagger.fits_tools import FitsStokesTypes, read_stokes_slice, getcrpix
+from catdagger import counters
+from catdagger import kernels
+from catdagger.filters import arealess, skewness_more, pos2neg_more, filter_chain, registered_filters, \
+    filter_name
+from catdagger import state
+from catdagger.geometry import BoundingBox, BoundingConvexHull, RegionSet, merge_regions
+from catdagger.fits_tools import FitsStokesTypes, read_stokes_slice, \
+    read_stokes_planes, StokesSliceReader, peak_rss
+from catdagger.exclusion_zones import rasterise_exclusion_zones
+from catdagger.parallel import thread_map, row_chunks, process_map
+from catdagger.coordinates import same_grid
+from catdagger.roi import WindowedImage, tile_aligned_box
+from catdagger.convolution import beam_filter
 log = logger.getLogger("tiled_tesselator")
 
+def tile_statistics(band_avg, row_lower, row_upper, col_lower, col_upper, nthreads=1):
+    """ 
+        Standard deviation of every tile in a (band of) the band averaged image,
+        accumulated in float64 irrespective of the image precision. Rows of tiles are distributed over nthreads threads
+    """
+    def __tile_rows(chunk):
+        lo, hi = chunk
+        return kernels.tile_std(band_avg, row_lower[lo:hi], row_upper[lo:hi], col_lower, col_upper)
+    return np.vstack(thread_map(__tile_rows, 
+                                row_chunks(row_lower.shape[0], nthreads), 
+                                nthreads))
+
+# image the regions of a worker process select their data from
+_worker_image = None
+
+def _attach_worker_image(image, dtype=None, shape=None):
+    global _worker_image
+    _worker_image = np.memmap(image, dtype=dtype, mode="r", shape=shape) \
+        if isinstance(image, str) else image
+
+def _evaluate_filter_chain(job):
+    reg, chain, image = job
+    reg.attach(_worker_image if image is None else image)
+    return chain.evaluate(reg)
+
+def _cull_in_pool(tagged_regions, chain, band_avg, nprocs):
+    if isinstance(band_avg, list):
+        return process_map(_evaluate_filter_chain, 
+                           [(reg, chain, image) for reg, image in zip(tagged_regions, band_avg)],
+                           nprocs)
+    tmpfn = None
+    try:
+        if isinstance(band_avg, np.ndarray):
+            fd, tmpfn = tempfile.mkstemp(suffix=".band_avg.dat")
+            os.close(fd)
+            shared = np.memmap(tmpfn, dtype=band_avg.dtype, mode="w+", shape=band_avg.shape)
+            shared[...] = band_avg
+            shared.flush()
+            del shared
+            initargs = (tmpfn, band_avg.dtype, band_avg.shape)
+        else:
+            initargs = (band_avg,)
+        return process_map(_evaluate_filter_chain, 
+                           [(reg, chain, None) for reg in tagged_regions],
+                           nprocs,
+                           initializer=_attach_worker_image,
+                           initargs=initargs)
+    finally:
+        if tmpfn is not None:
+            os.unlink(tmpfn)
+
+def cull_regions(tagged_regions, filters, band_avg, nprocs=1):
+    """
+        Discards the regions for which any of the filters (a list or a
+        filter_chain) fire. Every region is evaluated once through the
+        filters in order of cost, up to the first rejection, in a pool of 
+        nprocs processes if nprocs > 1. Workers attach to a memory mapped 
+        copy of the band averaged image (out-of-core readers are shipped as 
+        is) rather than receiving pickled image data. band_avg may also be
+        a list of out-of-core readers, one per region. Regions are returned 
+        in their original order
+    """
+    chain = filters if isinstance(filters, filter_chain) else filter_chain(filters)
+    if nprocs <= 1 or len(tagged_regions) <= 1:
+        results = map(chain.evaluate, tagged_regions)
+    else:
+        results = _cull_in_pool(tagged_regions, chain, band_avg, nprocs)
+    for reg, (ifilt, elapsed) in zip(tagged_regions, results):
+        chain.record(reg, ifilt, elapsed)
+    chain.report()
+    return [reg for reg, (ifilt, _) in zip(tagged_regions, results) if ifilt < 0]
+
+def write_regions_file(regionsfn, tagged_regions):
+    """ Writes tagged regions as SAODS9 polygons """
+    with open(regionsfn, "w+") as f:
+        f.write("# Region file format: DS9 version 4.0\n")
+        f.write("global color=red font=\"helvetica 6 normal roman\" edit=1 move=1 delete=1 highlite=1 include=1 wcs=wcs\n")
+        for reg in tagged_regions:
+            f.write("physical; polygon({0:s}) #select=1 text={1:s}\n".format(",".join(map(str, reg.corners.flatten())),
+                                                                             "{mean area deviation %.2fx}" % reg._sigma))
+        print>>log, "Writing dE regions to DS9 regions file {0:s}".format(regionsfn)
+
+def write_label_image(labelfn, tagged_regions, shape, w):
+    """
+        Writes an integer label image of the tagged regions (0 outside any 
+        region, 1 + region index inside) on the celestial grid of w, with a 
+        binary table extension (REGIONS) describing every label
+    """
+    regions = RegionSet(tagged_regions)
+    labels = regions.label_image(shape)
+    hdr = w.celestial.to_header()
+    hdr["BUNIT"] = "LABEL"
+    corners = [",".join(map(str, regions.corners(i).flatten())) for i in range(len(regions))]
+    cols = fits.ColDefs([fits.Column(name="LABEL", format="J", array=np.arange(1, len(regions) + 1)),
+                         fits.Column(name="NAME", format="{0:d}A".format(max([len(n) for n in regions.names] + [1])),
+                                     array=np.array(regions.names, dtype=str)),
+                         fits.Column(name="SIGMA", format="D", array=regions.sigma),
+                         fits.Column(name="AREA", format="D", array=regions.areas),
+                         fits.Column(name="CENTRE_X", format="D", array=regions.centres[:, 0]),
+                         fits.Column(name="CENTRE_Y", format="D", array=regions.centres[:, 1]),
+                         fits.Column(name="NPIX", format="K", array=np.bincount(labels.ravel(), 
+                                                                                minlength=len(regions) + 1)[1:]),
+                         fits.Column(name="CORNERS", format="{0:d}A".format(max([len(c) for c in corners] + [1])), 
+                                     array=np.array(corners, dtype=str))])
+    tab = fits.BinTableHDU.from_columns(cols)
+    tab.name = "REGIONS"
+    fits.HDUList([fits.PrimaryHDU(labels, header=hdr), tab]).writeto(labelfn, overwrite=True)
+    print>>log, "Writing dE region label image to {0:s}".format(labelfn)
+
+def flag_tiles(binned_stats,
+               bin_lower,
+               bin_upper,
+               w,
+               sigma=2.3,
+               global_stat_percentile=30.0,
+               min_distance_from_centre=0,
+               exclusion_zones=[],
+               reference_stats=None):
+    """
+        Flags the tiles with statistics above sigma times the global noise, 
+        the percentile of reference_stats if given (otherwise of binned_stats),
+        outside the exclusion zones (extended with a radial zone around the
+        phase tracking centre if min_distance_from_centre > 0).
+        Returns the flagged tiles, the global noise and the exclusion zones
+    """
+    percentile_stat = np.nanpercentile(binned_stats if reference_stats is None else reference_stats, 
+                                       global_stat_percentile)
+    segment_cutoff = percentile_stat * sigma
+    print>>log, "Computed regional statistics (global std of {0:.2f} mJy)".format(percentile_stat * 1.0e3)
+    if min_distance_from_centre > 0:
+        print>>log, "Enforsing radial exclusion zone of {0:.2f} px form " \
+                    "phase tracking centre".format(min_distance_from_centre)
+        crra, crdec = w.celestial.wcs.crpix
+        exclusion_zones = exclusion_zones + [(crra,
+                                              crdec,
+                                              float(min_distance_from_centre))]
+
+    # enforce all exclusion zones on the tile grid before regions are formed
+    print>>log, "Enforsing exclusion zones:"
+    excluded_tiles = rasterise_exclusion_zones(exclusion_zones, bin_lower, bin_upper, w)
+    flagged_tiles = binned_stats > segment_cutoff
+    if len(exclusion_zones) == 0: 
+        print>>log, "\t - No exclusion zones"
+    else:
+        print>>log, "\t - {0:d} exclusion zones cover {1:d} of {2:d} tiles, discarding {3:d} " \
+                    "flagged tiles".format(len(exclusion_zones),
+                                           np.sum(excluded_tiles),
+                                           excluded_tiles.size,
+                                           np.sum(np.logical_and(flagged_tiles, excluded_tiles)))
+    flagged_tiles = np.logical_and(flagged_tiles, np.logical_not(excluded_tiles))
+    counters.count("tiles", flagged_tiles.size)
+    counters.count("flagged_tiles", int(np.sum(flagged_tiles)))
+    return flagged_tiles, percentile_stat, exclusion_zones
+
+def tile_boxes(tiles, deviation, bin_lower, bin_upper, w, band_avg):
+    """ Regions of the selected tiles, with their deviation from the global noise """
+    return [BoundingBox(bin_lower[x], bin_upper[x], 
+                        bin_lower[y], bin_upper[y], 
+                        deviation[y, x], "reg[{0:d},{1:d}]".format(x, y), w, band_avg)
+            for (y, x) in np.argwhere(tiles)]
+
+def tile_order(reg):
+    """ Row major position of the first tile of a region, where merge_regions leaves it """
+    return min([(y, x) for x, y in reg.corners])
+
+def region_filters(min_area,
+                   max_right_skewness=np.inf,
+                   max_abs_skewness=np.inf,
+                   max_positive_to_negative_flux=np.inf):
+    """ Culling filters of tagged regions, followed by any registered filters """
+    return [arealess(min_area=min_area),
+            skewness_more(max_skewness=max_right_skewness,
+                          absskew=False),
+            skewness_more(max_skewness=max_abs_skewness,
+                          absskew=True),
+            pos2neg_more(max_positive_to_negative_flux)] + \
+           registered_filters()
+
+def tag_tiles(band_avg,
+              w,
+              binned_stats,
+              bin_lower,
+              bin_upper,
+              regionsfn = "dE.reg",
+              sigma = 2.3,
+              block_size=80,
+              global_stat_percentile=30.0,
+              min_blocks_in_region = 3,
+              min_distance_from_centre = 0,
+              exclusion_zones=[],
+              max_right_skewness=np.inf,
+              max_abs_skewness=np.inf,
+              max_positive_to_negative_flux=np.inf,
+              labelfn=None,
+              nprocs=1,
+              statefn=None,
+              state_tolerance=0.05,
+              reference_stats=None,
+              flags=None):
+    """
+        Flags, merges and culls regions from precomputed tile statistics.
+        band_avg may be an array or any object supporting 2D slicing
+        Regions are only written out if regionsfn is not None, and
+        rasterised to a label image if labelfn is not None. Regions are
+        culled in a pool of nprocs processes if nprocs > 1
+
+        If statefn is given the tile flags and regions are saved to it. If
+        it holds the state of a previous run on the same grid, regions 
+        of that run are carried over with their culling decisions as long
+        as none of their tiles (or neighbouring tiles) changed flag or
+        deviation by more than the relative state_tolerance. Only the 
+        remaining tiles are merged and culled, unless a region merged from
+        them reaches a carried over region, in which case all tiles are 
+        merged again
+
+        The global noise is the percentile of reference_stats if given, 
+        otherwise of binned_stats. Tiles are flagged with flag_tiles, unless
+        its result (flagged tiles, global noise and exclusion zones) is
+        given as flags
+    """
+    flagged_tiles, percentile_stat, exclusion_zones = flags if flags is not None else \
+        flag_tiles(binned_stats, bin_lower, bin_upper, w,
+                   sigma=sigma,
+                   global_stat_percentile=global_stat_percentile,
+                   min_distance_from_centre=min_distance_from_centre,
+                   exclusion_zones=exclusion_zones,
+                   reference_stats=reference_stats)
+    min_area=min_blocks_in_region * block_size**2
+    filters = region_filters(min_area, max_right_skewness, max_abs_skewness, max_positive_to_negative_flux)
+    deviation = binned_stats / float(percentile_stat)
+    grid = state.grid_fingerprint(w, bin_lower, bin_upper, min_area, max_right_skewness, max_abs_skewness,
+                                  max_positive_to_negative_flux, [filter_name(f) for f in filters])
+    prev_state = state.load_state(statefn, grid)
+    carried_over = {}
+    reused = []
+    covered_tiles = np.zeros(flagged_tiles.shape, dtype=np.bool)
+    if prev_state is not None:
+        changed_tiles = state.changed_tiles(prev_state, flagged_tiles, deviation, state_tolerance)
+        reused, reused_rejected_by, reused_indices, covered_tiles = \
+            state.reusable_regions(prev_state, changed_tiles, w, band_avg)
+        carried_over = dict([(reg.name, (reg, rej, i)) for reg, rej, i in 
+                             zip(reused, reused_rejected_by, reused_indices)])
+        print>>log, "Incremental tagging against state {0:s}: {1:d} tiles changed, carrying over {2:d} of " \
+                    "{3:d} regions covering {4:d} of {5:d} flagged tiles".format(
+                        statefn, np.sum(changed_tiles), len(reused), len(prev_state["names"]),
+                        np.sum(np.logical_and(covered_tiles, flagged_tiles)), np.sum(flagged_tiles))
+
+    tagged_regions = tile_boxes(np.logical_and(flagged_tiles, np.logical_not(covered_tiles)),
+                                deviation, bin_lower, bin_upper, w, band_avg)
+
+    print>>log, "Merging regions:" 
+    prev_tagged_regions = [reg.name for reg in tagged_regions]
+    # only fresh tiles are merged: carried over regions cannot touch them, as 
+    # none of the tiles around them changed, but the hull of a fresh cluster
+    # wrapping around one would have merged with it in a full run
+    fresh = [i for i in merge_regions(tagged_regions, exclusion_zones=exclusion_zones)]
+    wrapped = [(f.name, r.name) for f in fresh for r in reused if f.is_neighbour(r)]
+    if len(wrapped) > 0:
+        print>>log, "\t - Region {0:s} reaches carried over region {1:s}, merging all tiles".format(*wrapped[0])
+        carried_over = {}
+        reused = []
+        covered_tiles = np.zeros(flagged_tiles.shape, dtype=np.bool)
+        tagged_regions = tile_boxes(flagged_tiles, deviation, bin_lower, bin_upper, w, band_avg)
+        prev_tagged_regions = [reg.name for reg in tagged_regions]
+        fresh = [i for i in merge_regions(tagged_regions, exclusion_zones=exclusion_zones)]
+    if prev_tagged_regions == [reg.name for reg in fresh]: 
+        print>>log, "\t - No mergers" 
+    merged_regions = tagged_regions = sorted(fresh + reused, key=tile_order)
+    # apply regional filters
+    print>>log, "Culling regions based on filtering criteria:"
+    prev_tagged_regions = [reg.name for reg in tagged_regions]
+    chain = filter_chain(filters)
+    kept = set([reg.name for reg in cull_regions(fresh, chain, band_avg, nprocs=nprocs)])
+    rejected_by = dict(chain.rejected_by)
+    for name, (_, rej, _) in carried_over.items():
+        if rej != "":
+            rejected_by[name] = rej
+    tagged_regions = [reg for reg in tagged_regions if reg.name in kept or 
+                      (reg.name in carried_over and carried_over[reg.name][1] == "")]
+    if prev_state is not None:
+        nskipped = len([reg for reg in merged_regions if reg.name in carried_over])
+        print>>log, "\t - Skipped merging {0:d} tiles and culling {1:d} regions carried over from " \
+                    "state".format(np.sum(np.logical_and(covered_tiles, flagged_tiles)), nskipped)
+    if prev_tagged_regions == [reg.name for reg in tagged_regions]: 
+        print>>log, "\t - No cullings"
+    if statefn is not None:
+        names = [reg.name for reg in merged_regions]
+        members = [state.state_members(prev_state, carried_over[n][2]) if n in carried_over else [] for n in names]
+        leads = [prev_state["leads"][carried_over[n][2]] if n in carried_over else state.UNKNOWN_LEAD for n in names]
+        state.save_state(statefn, grid, deviation, flagged_tiles, merged_regions, rejected_by,
+                         state.region_tiles(merged_regions, flagged_tiles, bin_lower, bin_upper),
+                         catalog=prev_state["catalog"] if prev_state is not None else "",
+                         members=members, leads=leads)
+    # finally we're done
+    if regionsfn is not None:
+        write_regions_file(regionsfn, tagged_regions)
+    if labelfn is not None:
+        write_label_image(labelfn, tagged_regions, band_avg.shape, w)
+    print>>log, "The following regions must be tagged for dEs ({0:.2f}x{1:.2f} mJy)".format(sigma, percentile_stat * 1.0e3)
+    if len(tagged_regions) > 0:
+        for r in tagged_regions:
+            print>>log, "\t - {0:s}".format(str(r))
+    else:
+        print>>log, "\t - No regions met cutoff criteria. No dE tags shall be raised."
+    return tagged_regions
+
+def tile_grid(shape, block_size):
+    """ Lower and upper pixel bounds of tiles along an image axis """
+    bin_lower = np.arange(0, shape[0], block_size)
+    bin_upper = np.clip(bin_lower + block_size, 0, shape[0])
+    assert bin_lower.shape == bin_upper.shape
+    if shape[0] != shape[1]:
+        raise TypeError("Image must be square!")
+    print>>log, "Creating regions of {0:d} px".format(block_size)
+    return bin_lower, bin_upper
+
+def tag_image_regions(band_avg,
+                      w,
+                      regionsfn = None, 
+                      sigma = 2.3, 
+                      block_size=80, 
+                      global_stat_percentile=30.0,
+                      min_blocks_in_region = 3,
+                      min_distance_from_centre = 0,
+                      exclusion_zones=[],
+                      max_right_skewness=np.inf,
+                      max_abs_skewness=np.inf,
+                      max_positive_to_negative_flux=np.inf,
+                      nthreads=1,
+                      labelfn=None,
+                      nprocs=1):
+    """
+        Tiled tesselator for a band averaged image already in memory
+
+        band_avg is a 2D (dec, ra) array and w its WCS. Nothing is written
+        to disk unless regionsfn is given
+    """
+    bin_lower, bin_upper = tile_grid(band_avg.shape, block_size)
+    binned_stats = tile_statistics(band_avg, bin_lower, bin_upper, bin_lower, bin_upper,
+                                   nthreads=nthreads)
+    return tag_tiles(band_avg, w, binned_stats, bin_lower, bin_upper,
+                     regionsfn=regionsfn,
+                     sigma=sigma,
+                     block_size=block_size,
+                     global_stat_percentile=global_stat_percentile,
+                     min_blocks_in_region=min_blocks_in_region,
+                     min_distance_from_centre=min_distance_from_centre,
+                     exclusion_zones=exclusion_zones,
+                     max_right_skewness=max_right_skewness,
+                     max_abs_skewness=max_abs_skewness,
+                     max_positive_to_negative_flux=max_positive_to_negative_flux,
+                     labelfn=labelfn,
+                     nprocs=nprocs)
+
+def image_tile_statistics(stokes_cube,
+                          block_size=80,
+                          hdu_id=0,
+                          use_stokes="I",
+                          max_memory=None,
+                          nthreads=1,
+                          single_precision=False,
+                          roi=None,
+                          reference_tiles=1024,
+                          matched_beam=None):
+    """
+        Band averages a residual cube and computes the statistics of its tiles,
+        in memory or out-of-core in row bands of whole tiles within max_memory
+        bytes. Returns the band averaged image (or an out-of-core reader for
+        it), its WCS, the tile grid bounds, the tile statistics and the tile
+        statistics to take the global noise percentile from.
+
+        If a region of interest (see roi.PixelBoxROI and roi.SkyCircleROI) is
+        given only the whole tiles covering it are read through section access 
+        and the statistics of all other tiles are NaN. The noise percentile
+        is then taken from at most reference_tiles tiles sampled on a regular
+        lattice over the full image (all tiles if there are fewer)
+
+        If matched_beam (BMIN, BMAJ, BPA in degrees) is given the band 
+        averaged image is convolved with it before the tile statistics are
+        computed (see convolution.beam_filter). The image must then be held
+        in memory
+    """
+    if matched_beam is not None and (roi is not None or max_memory is not None):
+        raise ValueError("Beam matched filtering requires the band averaged image in memory: it cannot be "
+                         "combined with a region of interest or a memory budget")
+    if roi is not None:
+        return roi_tile_statistics(stokes_cube, roi, block_size, hdu_id, use_stokes,
+                                   nthreads=nthreads, single_precision=single_precision,
+                                   reference_tiles=reference_tiles)
+    if max_memory is None:
+        w, hdr, band_avg = read_stokes_slice(stokes_cube, hdu_id, use_stokes, average_channels=True, 
+                                           nthreads=nthreads, single_precision=single_precision)
+        if matched_beam is not None:
+            band_avg = beam_filter(band_avg, w, matched_beam, nthreads=nthreads)
+    else:
+        print>>log, "Processing image out-of-core within a memory budget of {0:.1f} MiB".format(
+            max_memory / 1024.0**2)
+        band_avg = StokesSliceReader(stokes_cube, hdu_id, use_stokes, single_precision=single_precision)
+        w = band_avg.wcs
+    bin_lower, bin_upper = tile_grid(band_avg.shape, block_size)
+    if max_memory is None:
+        binned_stats = tile_statistics(band_avg, bin_lower, bin_upper, bin_lower, bin_upper,
+                                       nthreads=nthreads)
+    else:
+        band_rows = band_avg.rows_within_budget(max_memory, block_size)
+        binned_stats = np.zeros((bin_lower.shape[0],
+                                 bin_lower.shape[0]))
+        for ly in range(0, band_avg.shape[0], band_rows):
+            uy = min(ly + band_rows, band_avg.shape[0])
+            print>>log, "\t - Collapsing channels of rows {0:d} to {1:d}".format(ly, uy)
+            band = band_avg.read(slice(ly, uy), nthreads=nthreads)
+            ty = slice(ly // block_size, (uy + block_size - 1) // block_size)
+            binned_stats[ty, :] = tile_statistics(band, 
+                                                  bin_lower[ty] - ly, bin_upper[ty] - ly, 
+                                                  bin_lower, bin_upper,
+                                                  nthreads=nthreads)
+            del band
+    return band_avg, w, bin_lower, bin_upper, binned_stats, binned_stats
+
+def sampled_tile_statistics(reader, bin_lower, bin_upper, max_tiles=1024, nthreads=1):
+    """
+        Statistics of at most max_tiles tiles on a regular lattice over the 
+        full image, read tile by tile through section access
+    """
+    stride = max(1, int(np.ceil(bin_lower.shape[0] / np.floor(np.sqrt(max_tiles)))))
+    sample = np.arange(stride // 2, bin_lower.shape[0], stride)
+    windows = [(slice(bin_lower[ty], bin_upper[ty]), slice(bin_lower[tx], bin_upper[tx]))
+               for ty in sample for tx in sample]
+    print>>log, "Sampling the global noise from {0:d} of {1:d} tiles".format(len(windows), bin_lower.shape[0]**2)
+    return np.array([np.std(t, dtype=np.float64) for t in reader.read_windows(windows, nthreads=nthreads)])
+
+def roi_tile_statistics(stokes_cube,
+                        roi,
+                        block_size=80,
+                        hdu_id=0,
+                        use_stokes="I",
+                        nthreads=1,
+                        single_precision=False,
+                        reference_tiles=1024):
+    """ Tile statistics within a region of interest (see image_tile_statistics) """
+    reader = StokesSliceReader(stokes_cube, hdu_id, use_stokes, single_precision=single_precision)
+    w = reader.wcs
+    bin_lower, bin_upper = tile_grid(reader.shape, block_size)
+    r0, r1, c0, c1 = tile_aligned_box(roi.to_pixel_box(w, reader.shape), block_size, reader.shape)
+    print>>log, "Reading region of interest {0:s}: rows {1:d} to {2:d}, columns {3:d} to {4:d}".format(
+        str(roi), r0, r1, c0, c1)
+    window = reader.read(slice(r0, r1), slice(c0, c1), nthreads=nthreads)
+    ty = slice(r0 // block_size, (r1 + block_size - 1) // block_size)
+    tx = slice(c0 // block_size, (c1 + block_size - 1) // block_size)
+    binned_stats = np.full((bin_lower.shape[0], bin_lower.shape[0]), np.nan)
+    binned_stats[ty, tx] = tile_statistics(window, 
+                                           bin_lower[ty] - r0, bin_upper[ty] - r0,
+                                           bin_lower[tx] - c0, bin_upper[tx] - c0,
+                                           nthreads=nthreads)
+    reference_stats = sampled_tile_statistics(reader, bin_lower, bin_upper, 
+                                              max_tiles=reference_tiles, nthreads=nthreads)
+    return WindowedImage(window, r0, c0, reader.shape), w, bin_lower, bin_upper, binned_stats, reference_stats
+
 def tag_regions(stokes_cube,  
                 regionsfn = "dE.reg", 
                 sigma = 2.3, 
@@ -26,91 +494,223 @@ def tag_regions(stokes_cube,
                 exclusion_zones=[],
                 max_right_skewness=np.inf,
                 max_abs_skewness=np.inf,
-                max_positive_to_negative_flux=np.inf):
+                max_positive_to_negative_flux=np.inf,
+                max_memory=None,
+                nthreads=1,
+                single_precision=False,
+                labelfn=None,
+                nprocs=1,
+                statefn=None,
+                state_tolerance=0.05,
+                roi=None,
+                matched_beam=None):
     """
         Tiled tesselator
 
         Method to tag regions with higher than sigma * percentile noise
+
+        If max_memory (bytes) is given the image is processed out-of-core in
+        row bands of whole tiles and regions read back only the pixels the
+        culling filters need. Channel averaging and tile statistics are 
+        distributed over nthreads threads, with bit-identical results. 
+        In single_precision mode the band averaged image is held in float32.
+        Regions are retagged incrementally against the state in statefn 
+        if given (see tag_tiles). If a region of interest roi is given only 
+        the tiles covering it are read and tagged (see image_tile_statistics).
+        The image is convolved with matched_beam (BMIN, BMAJ, BPA in degrees)
+        before tagging if given
     """
-    fn = stokes_cube
-    w, hdr, band_avg = read_stokes_slice(stokes_cube, hdu_id, use_stokes, average_channels=True)
-    bin_lower = np.arange(0, band_avg.shape[0], block_size)
-    bin_upper = np.clip(bin_lower + block_size, 0, band_avg.shape[0])
-    assert bin_lower.shape == bin_upper.shape
-    if band_avg.shape[0] != band_avg.shape[1]:
-        raise TypeError("Image must be square!")
-    print>>log, "Creating regions of {0:d} px".format(block_size)
-    binned_stats = np.zeros((bin_lower.shape[0],
-                             bin_lower.shape[0]))
-    for y, (ly, uy) in enumerate(zip(bin_lower, bin_upper)):
-        for x, (lx, ux) in enumerate(zip(bin_lower, bin_upper)):
-            wnd = band_avg[ly:uy, lx:ux].flatten()
-            binned_stats[y, x] = np.std(wnd)
-    percentile_stat = np.nanpercentile(binned_stats, global_stat_percentile)
-    segment_cutoff = percentile_stat * sigma
-    print>>log, "Computed regional statistics (global std of {0:.2f} mJy)".format(percentile_stat * 1.0e3)
+    band_avg, w, bin_lower, bin_upper, binned_stats, reference_stats = \
+        image_tile_statistics(stokes_cube, block_size, hdu_id, use_stokes, 
+                              max_memory=max_memory, nthreads=nthreads, 
+                              single_precision=single_precision, roi=roi,
+                              matched_beam=matched_beam)
+    tagged_regions = tag_tiles(band_avg, w, binned_stats, bin_lower, bin_upper,
+                               regionsfn=regionsfn,
+                               sigma=sigma,
+                               block_size=block_size,
+                               global_stat_percentile=global_stat_percentile,
+                               min_blocks_in_region=min_blocks_in_region,
+                               min_distance_from_centre=min_distance_from_centre,
+                               exclusion_zones=exclusion_zones,
+                               max_right_skewness=max_right_skewness,
+                               max_abs_skewness=max_abs_skewness,
+                               max_positive_to_negative_flux=max_positive_to_negative_flux,
+                               labelfn=labelfn,
+                               nprocs=nprocs,
+                               statefn=statefn,
+                               state_tolerance=state_tolerance,
+                               reference_stats=reference_stats)
+    if max_memory is not None:
+        print>>log, "Peak resident memory {0:.1f} MiB of {1:.1f} MiB budget".format(
+            peak_rss() / 1024.0**2, max_memory / 1024.0**2)
+        if peak_rss() > max_memory:
+            print>>log, "WARNING: Peak resident memory exceeded the memory budget"
+    return tagged_regions
+
+def stokes_regions_filename(regionsfn, stokes):
+    """ dE.reg -> dE.V.reg """
+    base, ext = os.path.splitext(regionsfn)
+    return "{0:s}.{1:s}{2:s}".format(base, stokes, ext)
+
+def tag_stokes_regions(stokes_cube,
+                       regionsfn = "dE.reg",
+                       sigma = 2.3,
+                       block_size=80,
+                       hdu_id = 0,
+                       use_stokes=["I", "Q", "U", "V"],
+                       noise_stokes="V",
+                       culling_stokes="I",
+                       global_stat_percentile=30.0,
+                       min_blocks_in_region = 3,
+                       min_distance_from_centre = 0,
+                       exclusion_zones=[],
+                       max_right_skewness=np.inf,
+                       max_abs_skewness=np.inf,
+                       max_positive_to_negative_flux=np.inf,
+                       nthreads=1,
+                       single_precision=False,
+                       labelfn=None,
+                       nprocs=1):
+    """
+        Tiled tesselator over several Stokes parameters from a single read
+
+        Regions are tagged on every Stokes parameter in use_stokes separately
+        (written to regionsfn with a Stokes suffix, e.g. dE.V.reg) and on a 
+        combined criterion: tiles are flagged against the noise of 
+        noise_stokes and regions culled on the skewness and flux ratio of 
+        culling_stokes (written to regionsfn and labelfn).
+        Returns a dictionary of regions per Stokes and the combined regions
+    """
+    use_stokes = list(use_stokes) + [s for s in [noise_stokes, culling_stokes] if s not in use_stokes]
+    w, hdr, planes = read_stokes_planes(stokes_cube, hdu_id, use_stokes, 
+                                        nthreads=nthreads, single_precision=single_precision)
+    bin_lower, bin_upper = tile_grid(planes[use_stokes[0]].shape, block_size)
+    binned_stats = {}
+    for st in use_stokes:
+        binned_stats[st] = tile_statistics(planes[st], bin_lower, bin_upper, bin_lower, bin_upper,
+                                           nthreads=nthreads)
+    def __tag(band_avg, stats, fn, labelfn=None):
+        return tag_tiles(band_avg, w, stats, bin_lower, bin_upper,
+                         regionsfn=fn,
+                         sigma=sigma,
+                         block_size=block_size,
+                         global_stat_percentile=global_stat_percentile,
+                         min_blocks_in_region=min_blocks_in_region,
+                         min_distance_from_centre=min_distance_from_centre,
+                         exclusion_zones=exclusion_zones,
+                         max_right_skewness=max_right_skewness,
+                         max_abs_skewness=max_abs_skewness,
+                         max_positive_to_negative_flux=max_positive_to_negative_flux,
+                         labelfn=labelfn,
+                         nprocs=nprocs)
+    stokes_regions = {}
+    for st in use_stokes:
+        print>>log, "Tagging regions on Stokes {0:s}".format(st)
+        stokes_regions[st] = __tag(planes[st], binned_stats[st],
+                                   stokes_regions_filename(regionsfn, st) if regionsfn is not None else None)
+    print>>log, "Tagging regions on Stokes {0:s} noise culled on Stokes {1:s}".format(noise_stokes, culling_stokes)
+    combined_regions = __tag(planes[culling_stokes], binned_stats[noise_stokes], regionsfn, labelfn)
+    return stokes_regions, combined_regions
+
+def write_heat_map(heatmapfn, counts, mean_deviation, nslots, w, block_size):
+    """
+        Writes the fraction of time slots in which every tile exceeded the 
+        cutoff on a tile resolution celestial grid, with the mean deviation of 
+        every tile from its slot's global noise in the DEVIATION extension
+    """
+    tile_wcs = w.celestial.slice((slice(None, None, block_size), slice(None, None, block_size)))
+    hdr = tile_wcs.to_header()
+    hdr["NSLOTS"] = (nslots, "Number of time slots stacked")
+    frac = fits.PrimaryHDU((counts / float(nslots)).astype(np.float32), header=hdr)
+    dev = fits.ImageHDU(mean_deviation.astype(np.float32), header=hdr, name="DEVIATION")
+    fits.HDUList([frac, dev]).writeto(heatmapfn, overwrite=True)
+    print>>log, "Writing time slot tagging frequency map to {0:s}".format(heatmapfn)
+
+def tag_time_slices(stokes_cubes,
+                    regionsfn = "dE.reg",
+                    heatmapfn = None,
+                    sigma = 2.3,
+                    block_size=80,
+                    hdu_id = 0,
+                    use_stokes="I",
+                    global_stat_percentile=30.0,
+                    min_blocks_in_region = 3,
+                    min_distance_from_centre = 0,
+                    exclusion_zones=[],
+                    min_slots=None,
+                    max_memory=None,
+                    nthreads=1,
+                    single_precision=False,
+                    labelfn=None):
+    """
+        Tiled tesselator over a sequence of time slot residuals on one grid
+
+        The residuals are streamed through one at a time (in memory or within
+        max_memory bytes). Every tile exceeding sigma times the percentile 
+        noise of its own slot is counted, and its deviation from that noise 
+        accumulated. Regions are formed from tiles exceeding in at least 
+        min_slots (default: half) of the slots, merged and culled on size.
+        The per tile exceedance fraction and mean deviation are written to 
+        heatmapfn if given.
+        Returns the tagged regions
+    """
+    nslots = len(stokes_cubes)
+    min_slots = (nslots + 1) // 2 if min_slots is None else min_slots
+    counts = None
+    for islot, stokes_cube in enumerate(stokes_cubes):
+        print>>log, "Processing time slot {0:d} of {1:d}: {2:s}".format(islot + 1, nslots, stokes_cube)
+        band_avg, w, bin_lower, bin_upper, binned_stats, _ = \
+            image_tile_statistics(stokes_cube, block_size, hdu_id, use_stokes, 
+                                  max_memory=max_memory, nthreads=nthreads, 
+                                  single_precision=single_precision)
+        shape = band_avg.shape
+        del band_avg
+        if counts is None:
+            ref_wcs = w
+            ref_shape = shape
+            counts = np.zeros(binned_stats.shape, dtype=np.int64)
+            deviation_sum = np.zeros(binned_stats.shape, dtype=np.float64)
+            zones = list(exclusion_zones)
+            if min_distance_from_centre > 0:
+                crra, crdec = w.celestial.wcs.crpix
+                zones.append((crra, crdec, float(min_distance_from_centre)))
+            excluded_tiles = rasterise_exclusion_zones(zones, bin_lower, bin_upper, w)
+        elif shape != ref_shape or not same_grid(w, ref_wcs):
+            raise ValueError("Time slot {0:s} is not on the grid of {1:s}".format(stokes_cube, stokes_cubes[0]))
+        percentile_stat = np.nanpercentile(binned_stats, global_stat_percentile)
+        deviation = binned_stats / float(percentile_stat)
+        flagged_tiles = np.logical_and(deviation > sigma, np.logical_not(excluded_tiles))
+        counts += flagged_tiles
+        deviation_sum += np.nan_to_num(deviation)
+        print>>log, "\t - {0:d} tiles exceed {1:.2f}x the global std of {2:.2f} mJy".format(
+            np.sum(flagged_tiles), sigma, percentile_stat * 1.0e3)
+    mean_deviation = deviation_sum / nslots
+    if heatmapfn is not None:
+        write_heat_map(heatmapfn, counts, mean_deviation, nslots, ref_wcs, block_size)
+
+    print>>log, "Forming regions from tiles exceeding in at least {0:d} of {1:d} time slots".format(
+        min_slots, nslots)
     tagged_regions = []
-    for (y, x) in np.argwhere(binned_stats > segment_cutoff):
-        det = binned_stats[y, x] / float(percentile_stat)
+    for (y, x) in np.argwhere(counts >= min_slots):
         reg_name = "reg[{0:d},{1:d}]".format(x, y)
         tagged_regions.append(BoundingBox(bin_lower[x], bin_upper[x], 
                                           bin_lower[y], bin_upper[y], 
-                                          det, reg_name, w, band_avg))
-    
-    if min_distance_from_centre > 0:
-        print>>log, "Enforsing radial exclusion zone of {0:.2f} px form " \
-                    "phase tracking centre".format(min_distance_from_centre)
-        crra, crdec = getcrpix(fn, hdu_id, use_stokes)
-        exclusion_zones.append((crra,
-                                crdec,
-                                float(min_distance_from_centre)))
-
-    # enforce all exclusion zones
-    print>>log, "Enforsing exclusion zones:"
-    for (cx, cy, exclrad) in exclusion_zones:
-        tagged_regions = filter(notin(filter(within_radius_from(exclrad, cx, cy), 
-                                             tagged_regions)), 
-                                tagged_regions)
-    if len(exclusion_zones) == 0: 
-        print>>log, "\t - No exclusion zones"
+                                          mean_deviation[y, x], reg_name, ref_wcs, None))
     print>>log, "Merging regions:" 
-    prev_tagged_regions = copy.deepcopy(tagged_regions)
-    tagged_regions = [i for i in merge_regions(tagged_regions,  
-                                               exclusion_zones=exclusion_zones)]
-    if prev_tagged_regions == tagged_regions: 
-        print>>log, "\t - No mergers" 
-    # apply regional filters
+    tagged_regions = [i for i in merge_regions(tagged_regions, exclusion_zones=exclusion_zones)]
     print>>log, "Culling regions based on filtering criteria:"
-    prev_tagged_regions = copy.deepcopy(tagged_regions)
-    min_area=min_blocks_in_region * block_size**2
-    tagged_regions = filter(notin(filter(arealess(min_area=min_area), 
-                                         tagged_regions)), 
-                            tagged_regions)
-    tagged_regions = filter(notin(filter(skewness_more(max_skewness=max_right_skewness,
-                                                      absskew=False), 
-                                         tagged_regions)),
-                            tagged_regions)
-    tagged_regions = filter(notin(filter(skewness_more(max_skewness=max_abs_skewness,
-                                                       absskew=True), 
-                                         tagged_regions)),
-                            tagged_regions)
-    tagged_regions = filter(notin(filter(pos2neg_more(max_positive_to_negative_flux), 
-                                         tagged_regions)),
-                            tagged_regions)
-    if prev_tagged_regions == tagged_regions: 
-        print>>log, "\t - No cullings"
-    # finally we're done
-    with open(regionsfn, "w+") as f:
-        f.write("# Region file format: DS9 version 4.0\n")
-        f.write("global color=red font=\"helvetica 6 normal roman\" edit=1 move=1 delete=1 highlite=1 include=1 wcs=wcs\n")
-        for reg in tagged_regions:
-            f.write("physical; polygon({0:s}) #select=1 text={1:s}\n".format(",".join(map(str, reg.corners.flatten())),
-                                                                             "{mean area deviation %.2fx}" % reg._sigma))
-        print>>log, "Writing dE regions to DS9 regions file {0:s}".format(regionsfn)
-    print>>log, "The following regions must be tagged for dEs ({0:.2f}x{1:.2f} mJy)".format(sigma, percentile_stat * 1.0e3)
+    tagged_regions = cull_regions(tagged_regions,
+                                  [arealess(min_area=min_blocks_in_region * block_size**2)],
+                                  None)
+    if regionsfn is not None:
+        write_regions_file(regionsfn, tagged_regions)
+    if labelfn is not None:
+        write_label_image(labelfn, tagged_regions, ref_shape, ref_wcs)
+    print>>log, "The following regions exceed in at least {0:d} of {1:d} time slots:".format(min_slots, nslots)
     if len(tagged_regions) > 0:
         for r in tagged_regions:
             print>>log, "\t - {0:s}".format(str(r))
     else:
         print>>log, "\t - No regions met cutoff criteria. No dE tags shall be raised."
-    return tagged_regions
\ No newline at end of file
+    return tagged_regions
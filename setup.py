@@ -50,8 +50,9 @@ setup(name='catdagger',
       author_email='bhugo@ska.ac.za',
       license='GNU GPL v3',
       packages=['catdagger'],
-      scripts=['bin/dagger'],
+      scripts=['bin/dagger', 'bin/dagger-server', 'bin/dagger-restore'],
       install_requires=requirements,
+      extras_require={'numba': ['numba']},
       include_package_data=True,
       zip_safe=False,
 )
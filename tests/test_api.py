@@ -0,0 +1,67 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.wcs import WCS
+from catdagger import api
+from catdagger.__main__ import build_parser, run
+from test_tiled_tesselator import write_residual, BLOCK
+from test_fits_tools import sin_wcs
+
+def test_tag_image_matches_cli(tmpdir):
+    fn = write_residual(str(tmpdir.join("res.fits")))
+    cube = fits.getdata(fn)[0]
+    w = WCS(fits.getheader(fn))
+    args = ["--tile-size", str(BLOCK), "--min-tiles-region", "2"]
+    cli = run(build_parser().parse_args([fn, "--ds9-reg-file", str(tmpdir.join("cli.reg"))] + args))["regions"]
+    assert len(cli) == 2
+    res = api.tag_image(cube, w, block_size=BLOCK, min_blocks_in_region=2,
+                        regionsfn=str(tmpdir.join("api.reg")))
+    assert [(reg.name, reg.area_sigma, reg.corners.tolist()) for reg in res["regions"]] == \
+        [(reg["name"], reg["sigma"], reg["corners"]) for reg in cli]
+    assert tmpdir.join("api.reg").read() == tmpdir.join("cli.reg").read()
+
+def test_model_written_with_matching_axes(tmpdir):
+    fn = write_residual(str(tmpdir.join("res.fits")))
+    cube = fits.getdata(fn)[0]
+    w = WCS(fits.getheader(fn))
+    reg = api.tag_image(cube, w, block_size=BLOCK, min_blocks_in_region=2)["regions"][0]
+    ra, dec = w.celestial.wcs_pix2world([reg.centre], 0)[0]
+    model = np.zeros_like(cube)
+    model[:, int(reg.centre[1]), int(reg.centre[0])] = 1.0
+    modelfn = str(tmpdir.join("model.fits"))
+    res = api.tag_image(cube, w, sources={"ra": [ra], "dec": [dec], "flux": [1.0]},
+                        model_images=[model], beam=(1.0e-3, 1.0e-3, 0.0),
+                        model_fns=[modelfn], block_size=BLOCK, min_blocks_in_region=2)
+    assert list(res["tagged"]) == [0]
+    hdr = fits.getheader(modelfn)
+    assert hdr["NAXIS"] == 3 and WCS(hdr).naxis == 3
+    assert [WCS(hdr).wcs.ctype[i][:4] for i in range(3)] == ["RA--", "DEC-", "FREQ"]
+    assert np.all(fits.getdata(modelfn) == 0.0)
+    # a model cube cannot be described by the celestial axes alone
+    with pytest.raises(ValueError):
+        api.tag_image(cube, w.celestial, model_images=[model], beam=(1.0e-3, 1.0e-3, 0.0),
+                      model_fns=[modelfn], block_size=BLOCK)
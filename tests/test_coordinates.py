@@ -0,0 +1,64 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import numpy as np
+from catdagger import counters
+from catdagger import coordinates
+from catdagger.coordinates import world2pix
+from test_fits_tools import sin_wcs
+
+def catalog(seed, n=100):
+    rs = np.random.RandomState(seed)
+    return 30.0 + rs.uniform(-0.02, 0.02, n), -30.0 + rs.uniform(-0.02, 0.02, n)
+
+def test_world2pix_matches_wcs():
+    w = sin_wcs()
+    ra, dec = catalog(0)
+    for origin in [0, 1]:
+        x, y = world2pix(w, ra, dec, origin)
+        ex, ey = w.wcs_world2pix(ra, dec, origin)
+        assert np.array_equal(x, ex) and np.array_equal(y, ey)
+    x, y = world2pix(w, 30.0, -30.0, 0)
+    assert x.shape == (1,) and np.allclose([x[0], y[0]], w.wcs.crpix - 1)
+
+def test_world2pix_cache_is_bounded():
+    w = sin_wcs()
+    ra, dec = catalog(1)
+    counters.enable()
+    try:
+        x, y = world2pix(w, ra, dec)
+        # callers may modify the returned arrays
+        x[:] = np.nan
+        assert np.all(np.isfinite(world2pix(w, ra, dec)[0]))
+        assert counters.snapshot()["world2pix_positions"]["total"] == ra.size
+        for seed in range(2, 2 + 2 * coordinates.PIXEL_CACHE_SIZE):
+            world2pix(w, *catalog(seed))
+        assert len(coordinates._pixel_cache) == coordinates.PIXEL_CACHE_SIZE
+        # the first catalog was evicted, the last ones are still cached
+        world2pix(w, ra, dec)
+        world2pix(w, *catalog(1 + 2 * coordinates.PIXEL_CACHE_SIZE))
+        assert counters.snapshot()["world2pix_positions"]["total"] == \
+            (2 + 2 * coordinates.PIXEL_CACHE_SIZE) * ra.size
+    finally:
+        counters.disable()
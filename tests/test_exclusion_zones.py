@@ -0,0 +1,104 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from catdagger.exclusion_zones import read_ds9_exclusion_zones, PolygonExclusionZone, \
+    CircularExclusionZone, SkyCircularExclusionZone, SkyPolygonExclusionZone
+from test_fits_tools import sin_wcs
+
+def read_zones(tmpdir, text):
+    fn = str(tmpdir.join("zones.reg"))
+    with open(fn, "w") as f:
+        f.write("# Region file format: DS9 version 4.1\n"
+                "global color=green width=1\n" + text)
+    return read_ds9_exclusion_zones(fn)
+
+def assert_circle_at(zone, cx, cy, radius):
+    """ zone (in pixels) holds points just within radius of (cx, cy), not those just outside """
+    ang = np.linspace(0, 2 * np.pi, 16, endpoint=False)
+    assert np.all(zone.contains(cx + 0.95 * radius * np.cos(ang), cy + 0.95 * radius * np.sin(ang)))
+    assert not np.any(zone.contains(cx + 1.05 * radius * np.cos(ang), cy + 1.05 * radius * np.sin(ang)))
+
+@pytest.mark.parametrize("frame", ["image", "physical"])
+def test_pixel_frames(tmpdir, frame):
+    zones = read_zones(tmpdir, "{0:s}\ncircle(11,21,5) # text={{a}}\n"
+                               "polygon(1,1,11,1,11,11,1,11)\nbox(5,5,2,2,0)\n".format(frame))
+    assert [z.__class__ for z in zones] == [CircularExclusionZone, PolygonExclusionZone]
+    # DS9 pixels are 1-based
+    assert_circle_at(zones[0], 10.0, 20.0, 5.0)
+    assert np.array_equal(zones[1].contains([0.0, 5.0, 9.9, 10.0], [5.0, 0.0, 5.0, 5.0]),
+                          [True, True, True, False])
+
+def sky_zones(tmpdir, frame, lon, lat):
+    return read_zones(tmpdir, "{0:s}; circle({1:.10f},{2:.10f},10\") ; "
+                              "polygon({3:.10f},{4:.10f},{5:.10f},{6:.10f},{7:.10f},{8:.10f})\n".format(
+                                  frame, lon[0], lat[0], lon[1], lat[1], lon[2], lat[2], lon[3], lat[3]))
+
+@pytest.mark.parametrize("coordsys,frame", [("fk5", "fk5"), ("j2000", "fk5"), ("icrs", "icrs"),
+                                             ("fk4", "fk4"), ("b1950", "fk4"), ("galactic", "galactic")])
+def test_sky_frames(tmpdir, coordsys, frame):
+    w = sin_wcs()
+    # circle on the reference pixel and a triangle around it, in pixels 0-based
+    x = np.array([100.0, 90.0, 110.0, 100.0])
+    y = np.array([100.0, 90.0, 90.0, 110.0])
+    ra, dec = w.wcs_pix2world(x, y, 0)
+    c = SkyCoord(ra, dec, unit="deg", frame="fk5").transform_to(frame)
+    lon, lat = (c.l.deg, c.b.deg) if frame == "galactic" else (c.ra.deg, c.dec.deg)
+    zones = sky_zones(tmpdir, coordsys, lon, lat)
+    assert [z.__class__ for z in zones] == [SkyCircularExclusionZone, SkyPolygonExclusionZone]
+    assert_circle_at(zones[0].to_pixel(w), 100.0, 100.0, 10.0)
+    assert np.allclose(zones[1].to_pixel(w)._vertices, np.column_stack([x[1:], y[1:]]), atol=1.0e-3)
+
+def test_sexagesimal_and_units(tmpdir):
+    w = sin_wcs()
+    zones = read_zones(tmpdir, "fk5\ncircle(2:00:00.000,-30:00:00.00,0.5')\n"
+                               "circle(2h00m00s,-30d00m00s,0.0025d)\n")
+    assert_circle_at(zones[0].to_pixel(w), 100.0, 100.0, 30.0)
+    assert_circle_at(zones[1].to_pixel(w), 100.0, 100.0, 9.0)
+
+def test_concave_polygon():
+    # L shaped polygon: the notch at the top right is outside
+    zone = PolygonExclusionZone([[0, 0], [10, 0], [10, 2], [2, 2], [2, 10], [0, 10]])
+    x = np.array([1.0, 5.0, 1.0, 5.0, 9.0, 11.0, -1.0])
+    y = np.array([1.0, 1.0, 9.0, 5.0, 9.0, 1.0, 5.0])
+    assert np.array_equal(zone.contains(x, y), [True, True, True, False, False, False, False])
+    # vectorised over any broadcastable shape
+    assert zone.contains(x[:, None], y[None, :]).shape == (7, 7)
+
+def test_points_on_edges():
+    # points on the left and bottom edges are inside, on the right and top edges outside
+    square = PolygonExclusionZone([[0, 0], [10, 0], [10, 10], [0, 10]])
+    assert np.array_equal(square.contains([0.0, 5.0, 10.0, 5.0], [5.0, 0.0, 5.0, 10.0]),
+                          [True, True, False, False])
+    # so points on an edge shared by two polygons lie in exactly one of them
+    lower = PolygonExclusionZone([[0, 0], [10, 0], [10, 10]])
+    upper = PolygonExclusionZone([[0, 0], [10, 10], [0, 10]])
+    t = np.linspace(0.5, 9.5, 19)
+    assert np.all(lower.contains(t, t) != upper.contains(t, t))
+
+def test_degenerate_polygon():
+    with pytest.raises(ValueError):
+        PolygonExclusionZone([[0, 0], [1, 1]])
@@ -0,0 +1,102 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import numpy as np
+import pytest
+from catdagger.filters import filter_chain, register_filter, unregister_filter, registered_filters, \
+    filter_name, COST_GEOMETRIC
+from catdagger.geometry import BoundingBox
+from catdagger.tiled_tesselator import region_filters, cull_regions
+from test_fits_tools import sin_wcs
+
+def mixed_regions(n=40, size=20):
+    """ Regions over patches of gaussian, positive, outlier ridden and small patches """
+    rs = np.random.RandomState(11)
+    image = np.zeros((size, n * size))
+    regions = []
+    w = sin_wcs(n * size)
+    for i in range(n):
+        patch = rs.randn(size, size)
+        kind = i % 4
+        if kind == 1:
+            patch = np.abs(patch) + rs.uniform(-0.5, 0.5)
+        elif kind == 2:
+            patch.flat[rs.randint(0, size**2, rs.randint(1, 10))] += rs.uniform(5, 50)
+        image[:, i * size:(i + 1) * size] = patch
+        width = size if kind != 3 else rs.randint(size // 4, size)
+        regions.append(BoundingBox(i * size, i * size + width, 0, size, 1.0, "reg{0:d}".format(i), w, image))
+    return regions, image
+
+FILTER_SETTINGS = dict(max_right_skewness=0.3, max_abs_skewness=0.5, max_positive_to_negative_flux=1.5)
+
+def test_chain_matches_sequential_filters():
+    regions, image = mixed_regions()
+    filters = region_filters(15 * 20, **FILTER_SETTINGS)
+    # the filters applied one after the other over the survivors, in order
+    survivors = regions
+    for filt in filters:
+        survivors = [reg for reg in survivors if not filt(reg)]
+    assert 0 < len(survivors) < len(regions)
+    chain = filter_chain(filters)
+    kept = [reg for reg in regions if not chain(reg)]
+    assert [reg.name for reg in kept] == [reg.name for reg in survivors]
+    # every filter rejected some region, cheapest filters first
+    assert set(chain.rejected_by.values()) == set([filter_name(f) for f in filters])
+    assert [f.cost for f in chain.filters] == sorted([f.cost for f in filters])
+    for nprocs in [1, 2]:
+        assert [reg.name for reg in cull_regions(regions, filters, image, nprocs=nprocs)] == \
+            [reg.name for reg in survivors]
+
+class named_discard():
+    """ Picklable filter discarding the named regions """
+    cost = COST_GEOMETRIC
+
+    def __init__(self, names):
+        self._names = set(names)
+        self.name = "named_discard"
+
+    def __call__(self, reg):
+        return reg.name in self._names
+
+def test_registered_filters():
+    regions, image = mixed_regions(8)
+    filt = register_filter(named_discard(["reg0", "reg4"]))
+    try:
+        assert registered_filters() == [filt]
+        filters = region_filters(0)
+        assert filters[-1] is filt
+        chain = filter_chain(filters)
+        kept = cull_regions(regions, chain, image)
+        assert "reg0" not in [reg.name for reg in kept] and "reg4" not in [reg.name for reg in kept]
+        # geometric cost: evaluated before the pixel based filters
+        assert chain.filters[1] is filt
+        assert chain.rejected_by["reg0"] == "named_discard"
+    finally:
+        unregister_filter(filt)
+    assert registered_filters() == []
+    assert len(region_filters(0)) == len(filters) - 1
+    with pytest.raises(TypeError):
+        register_filter("not a filter")
+    with pytest.raises(ValueError):
+        unregister_filter(filt)
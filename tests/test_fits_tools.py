@@ -0,0 +1,136 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import numpy as np
+import pytest
+from astropy import wcs
+from astropy.io import fits
+from catdagger.fits_tools import blank_source_table, save_stokes_slice, read_stokes_slice, \
+    nd_compression_supported, write_delta_backup, restore_delta_backup, delta_backup_filename
+from catdagger import restore
+
+def sin_wcs(npix=200, cdelt=1.0 / 3600.0):
+    w = wcs.WCS(naxis=2)
+    w.wcs.ctype = ["RA---SIN", "DEC--SIN"]
+    w.wcs.crval = [30.0, -30.0]
+    w.wcs.crpix = [npix // 2 + 1, npix // 2 + 1]
+    w.wcs.cdelt = [-cdelt, cdelt]
+    return w
+
+def point_table(w, rows, cols):
+    ra, dec = w.wcs_pix2world(np.array(cols, dtype=np.float64), np.array(rows, dtype=np.float64), 1)
+    zeros = np.zeros(len(rows))
+    return {"ra": ra, "dec": dec, "flux": np.ones(len(rows)), "ex": zeros, "ey": zeros, "pa": zeros}
+
+def test_bulk_fluxes_of_close_sources():
+    # 5 px beam: footprints of sources 20 px apart are disjoint, but the
+    # blanking windows (101 px) around them overlap
+    w = sin_wcs()
+    beam = (5.0 / 3600.0, 5.0 / 3600.0, 0.0)
+    table = point_table(w, [80, 80, 120, 120], [80, 100, 80, 100])
+    data = np.random.RandomState(42).rand(2, 200, 200)
+    fluxes = blank_source_table(data.copy(), w, beam, table)
+    bulk_fluxes = blank_source_table(data.copy(), w, beam, table, bulk=True)
+    assert np.all(fluxes > 0)
+    assert np.allclose(fluxes, bulk_fluxes)
+
+def write_cube(fn, nchan=2, npix=32):
+    hdr = sin_wcs(npix).to_header()
+    hdr["CTYPE3"] = "FREQ"; hdr["CRVAL3"] = 1.4e9; hdr["CRPIX3"] = 1; hdr["CDELT3"] = 1.0e6
+    hdr["CTYPE4"] = "STOKES"; hdr["CRVAL4"] = 1; hdr["CRPIX4"] = 1; hdr["CDELT4"] = 1
+    cube = np.random.RandomState(1).rand(1, nchan, npix, npix).astype(np.float32)
+    fits.PrimaryHDU(cube, header=hdr).writeto(fn, overwrite=True)
+    return cube
+
+def test_compressed_model_cube(tmpdir):
+    fn = str(tmpdir.join("model.fits"))
+    cube = write_cube(fn)
+    blanked = cube[0].copy()
+    blanked[:, 10:20, 10:20] = 0.0
+    if not nd_compression_supported():
+        # rejected before the backup or the model is written
+        with pytest.raises(ValueError):
+            save_stokes_slice(fn, blanked, compression_type="GZIP_1")
+        assert not os.path.exists(fn + ".orig.fits")
+        assert np.array_equal(fits.getdata(fn), cube)
+    else:
+        save_stokes_slice(fn, blanked, compression_type="GZIP_1")
+        with fits.open(fn) as img:
+            assert isinstance(img[1], fits.CompImageHDU)
+        assert np.allclose(read_stokes_slice(fn, average_channels=False)[2], blanked)
+
+def test_delta_backup_restores_oldest_values(tmpdir, monkeypatch):
+    fn = str(tmpdir.join("model.fits"))
+    cube = write_cube(fn, nchan=3)
+    first = cube[0].copy()
+    first[:, 4:12, 4:12] = 0.0
+    save_stokes_slice(fn, first, backup="delta")
+    # the second blanking overlaps the first and overwrites blanked pixels
+    second = first.copy()
+    second[:, 8:16, 8:16] = -1.0
+    save_stokes_slice(fn, second, backup="delta")
+    assert not os.path.exists(fn + ".orig.fits")
+    assert np.array_equal(fits.getdata(fn)[0], second)
+    with np.load(delta_backup_filename(fn)) as backup:
+        assert backup["indices"].size == np.sum(second != cube[0])
+        assert np.array_equal(backup["values"], cube.ravel()[backup["indices"]])
+    monkeypatch.setattr("sys.argv", ["catdagger-restore", "--keep-backup", fn])
+    restore.main()
+    assert np.array_equal(fits.getdata(fn), cube)
+    assert os.path.exists(delta_backup_filename(fn))
+    restore_delta_backup(fn, remove=True)
+    assert np.array_equal(fits.getdata(fn), cube)
+    assert not os.path.exists(delta_backup_filename(fn))
+
+def test_delta_backup_of_other_shape(tmpdir):
+    fn = str(tmpdir.join("model.fits"))
+    cube = write_cube(fn)
+    blanked = cube[0].copy()
+    blanked[:, 4:12, 4:12] = 0.0
+    save_stokes_slice(fn, blanked, backup="delta")
+    write_cube(fn, nchan=3)
+    with pytest.raises(ValueError):
+        restore_delta_backup(fn)
+    with pytest.raises(ValueError):
+        save_stokes_slice(fn, blanked, backup="delta")
+
+def test_delta_backup_of_compressed_image(tmpdir):
+    fn = str(tmpdir.join("model.fits"))
+    # integer (Stokes, ny, nx) cube: compressed losslessly on all astropy versions
+    cube = np.random.RandomState(1).randint(1, 100, (2, 16, 16)).astype(np.int32)
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(cube, compression_type="GZIP_1")]).writeto(fn)
+    blanked = cube[1].copy()
+    blanked[4:8, 4:8] = 0
+    write_delta_backup(fn, cube, (1, slice(None), slice(None)), blanked)
+    with fits.open(fn) as img:
+        data = img[1].data
+        data[1] = blanked
+        img[1].data = data
+        img.writeto(fn, overwrite=True)
+    restore_delta_backup(fn)
+    with fits.open(fn) as img:
+        assert isinstance(img[1], fits.CompImageHDU)
+        assert np.array_equal(img[1].data, cube)
+    with fits.open(fn, disable_image_compression=True) as img:
+        assert img[1].header["ZCMPTYPE"] == "GZIP_1"
@@ -0,0 +1,103 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import numpy as np
+import pytest
+from catdagger import kernels
+
+# the NumPy and Numba backends must agree
+pytest.importorskip("numba")
+
+def both_backends(kernel, *args):
+    """ Results of kernel on copies of args with the NumPy and Numba backends """
+    prev = kernels.backend()
+    results = []
+    try:
+        for name in ["numpy", "numba"]:
+            kernels.use_backend(name)
+            cargs = [a.copy() if isinstance(a, np.ndarray) else a for a in args]
+            results.append((kernel(*cargs), cargs))
+    finally:
+        kernels.use_backend(prev)
+    return results
+
+def polygons():
+    # a square and a triangle, counter clockwise (interior to the left of the edges)
+    squares = [np.array([[10.0, 10.0], [40.0, 10.0], [40.0, 40.0], [10.0, 40.0]]),
+               np.array([[30.0, 20.0], [60.0, 35.0], [30.0, 50.0]])]
+    corners = np.vstack(squares)
+    edges = np.vstack([np.roll(c, -1, axis=0) - c for c in squares])
+    offsets = np.cumsum([0] + [c.shape[0] for c in squares]).astype(np.int64)
+    return corners, edges, offsets
+
+def windows(n=20, size=64, seed=3):
+    rs = np.random.RandomState(seed)
+    # centres include pixels whose windows are clipped by the image edges
+    return rs.randint(-5, size + 5, n).astype(np.int64), rs.randint(-5, size + 5, n).astype(np.int64)
+
+def test_points_in_polygons():
+    corners, edges, offsets = polygons()
+    rs = np.random.RandomState(1)
+    x = rs.uniform(0, 64, 5000)
+    y = rs.uniform(0, 64, 5000)
+    (np_inside, _), (nb_inside, _) = both_backends(kernels.points_in_polygons, x, y, corners, edges, offsets)
+    assert np.any(np_inside)
+    assert np.array_equal(np_inside, nb_inside)
+
+def test_paint_polygon():
+    corners, edges, offsets = polygons()
+    labels = np.zeros((64, 64), dtype=np.int32)
+    (_, (np_labels, _, _, _, _, _, _, _)), (_, (nb_labels, _, _, _, _, _, _, _)) = \
+        both_backends(kernels.paint_polygon, labels, corners[:4], edges[:4], 7, 0, 64, 0, 64)
+    assert np.sum(np_labels == 7) > 0
+    assert np.array_equal(np_labels, nb_labels)
+
+def test_tile_std():
+    image = np.random.RandomState(2).randn(100, 100).astype(np.float32)
+    lower = np.arange(0, 100, 32).astype(np.int64)
+    upper = np.minimum(lower + 32, 100)
+    (np_std, _), (nb_std, _) = both_backends(kernels.tile_std, image, lower, upper, lower, upper)
+    assert np.allclose(np_std, nb_std, rtol=1.0e-12, atol=0)
+
+def test_add_windows():
+    xs, ys = windows()
+    wnd = np.random.RandomState(4).rand(11, 11)
+    image = np.zeros((64, 64))
+    (_, (np_image, _, _, _)), (_, (nb_image, _, _, _)) = both_backends(kernels.add_windows, image, wnd, xs, ys)
+    assert np.allclose(np_image, nb_image, rtol=1.0e-12, atol=0)
+
+def test_or_windows():
+    xs, ys = windows()
+    wnd = np.random.RandomState(5).rand(11, 11) > 0.5
+    mask = np.zeros((64, 64), dtype=bool)
+    (_, (np_mask, _, _, _)), (_, (nb_mask, _, _, _)) = both_backends(kernels.or_windows, mask, wnd, xs, ys)
+    assert np.array_equal(np_mask, nb_mask)
+
+def test_window_sums():
+    # single precision images are summed in float64 by both backends
+    xs, ys = windows()
+    wnd = np.random.RandomState(6).rand(21, 21) > 0.3
+    image = (1.0e3 + np.random.RandomState(7).rand(64, 64)).astype(np.float32)
+    (np_sums, _), (nb_sums, _) = both_backends(kernels.window_sums, image, wnd, xs, ys)
+    assert np_sums.dtype == nb_sums.dtype == np.float64
+    assert np.allclose(np_sums, nb_sums, rtol=1.0e-12, atol=0)
@@ -0,0 +1,102 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import numpy as np
+from astropy.io import fits
+from catdagger.geometry import BoundingBox
+from catdagger.fits_tools import read_stokes_slice
+from catdagger.mosaic import MosaicImage, mosaic_wcs, merge_mosaic_regions, tag_mosaic
+from catdagger.tiled_tesselator import tag_regions
+from test_fits_tools import sin_wcs
+
+NPIX = 320
+BLOCK = 40
+CDELT = 1.0e-3
+
+def write_pointing(fn, ra, plane, nchan=2):
+    """ Writes a (Stokes, FREQ, DEC, RA) cube of copies of plane, tangent at (ra, -30) """
+    hdr = fits.Header()
+    for i, (ct, cr, cd, cv) in enumerate([("RA---SIN", NPIX // 2 + 1, -CDELT, ra), 
+                                          ("DEC--SIN", NPIX // 2 + 1, CDELT, -30.0),
+                                          ("FREQ", 1, 1.0e6, 1.4e9), 
+                                          ("STOKES", 1, 1, 1)]):
+        hdr["CTYPE{0:d}".format(i + 1)] = ct
+        hdr["CRPIX{0:d}".format(i + 1)] = cr
+        hdr["CDELT{0:d}".format(i + 1)] = cd
+        hdr["CRVAL{0:d}".format(i + 1)] = cv
+    cube = np.repeat(plane[None, None, :, :], nchan, axis=1).astype(np.float32)
+    fits.PrimaryHDU(cube, header=hdr).writeto(fn, overwrite=True)
+    return fn
+
+# RA offset moving the second pointing 200 px to the right of the first
+RA_OFFSET = 200 * CDELT / np.cos(np.deg2rad(30.0))
+
+def two_pointings(tmpdir):
+    """
+        Noisy tiles in the first pointing under the second pointing's centre
+        side of the overlap, where the second pointing holds only positive
+        (unflagged) noise
+    """
+    rs = np.random.RandomState(5)
+    p0 = rs.randn(NPIX, NPIX) * 1.0e-3
+    p0[120:200, 240:320] *= 5.0
+    p1 = rs.randn(NPIX, NPIX) * 1.0e-3
+    p1[120:200, 40:120] = np.abs(p1[120:200, 40:120])
+    return [write_pointing(str(tmpdir.join("p0.fits")), 30.0, p0),
+            write_pointing(str(tmpdir.join("p1.fits")), 30.0 - RA_OFFSET, p1)]
+
+def test_regions_culled_on_own_pointing(tmpdir):
+    pointings = two_pointings(tmpdir)
+    kw = dict(block_size=BLOCK, min_blocks_in_region=2, max_positive_to_negative_flux=1.5)
+    single = tag_regions(pointings[0], regionsfn=None, **kw)
+    assert [reg.name for reg in single] == ["reg[6,3]&reg[7,3]&reg[6,4]&reg[7,4]"]
+    for nprocs in [1, 2]:
+        regions, mw = tag_mosaic(pointings, regionsfn=None, nprocs=nprocs, **kw)
+        assert [reg.name for reg in regions] == ["p0:" + single[0].name]
+        # on the pixels of the first pointing only
+        data = regions[0].regional_data
+        assert np.sum(data > 0) / float(np.sum(data <= 0)) < 1.5
+
+def test_mosaic_image_of_single_pointing(tmpdir):
+    plane = np.random.RandomState(2).randn(NPIX, NPIX)
+    fn = write_pointing(str(tmpdir.join("p.fits")), 30.0, plane)
+    w = read_stokes_slice(fn)[0]
+    mw = mosaic_wcs([w])
+    image = MosaicImage([fn], mw)
+    # the mosaic frame shares the pointing's grid, with its origin on the reference pixel
+    off = NPIX // 2
+    assert np.allclose(image[-off:20 - off, -off:30 - off], plane[:20, :30])
+    window = image[NPIX - off - 5:NPIX - off + 5, 0:10]
+    assert np.all(np.isnan(window[5:]))
+    assert np.allclose(window[:5], plane[NPIX - 5:, off:off + 10])
+
+def test_merge_mosaic_regions_groups():
+    mw = mosaic_wcs([sin_wcs()])
+    regions = [BoundingBox(0, 10, 0, 10, 1.0, "a", mw, None),
+               BoundingBox(100, 110, 0, 10, 1.0, "b", mw, None),
+               BoundingBox(5, 15, 5, 15, 3.0, "c", mw, None),
+               BoundingBox(15, 25, 15, 25, 1.0, "d", mw, None)]
+    merged, groups = merge_mosaic_regions(regions)
+    assert sorted([(reg.name, group) for reg, group in zip(merged, groups)]) == \
+        [("a&c&d", [0, 2, 3]), ("b", [1])]
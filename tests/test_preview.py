@@ -0,0 +1,61 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import numpy as np
+from catdagger.preview import tag_preview, decimated_tile_statistics, flag_probability
+from catdagger.tiled_tesselator import tag_regions, tile_grid
+from test_mosaic import write_pointing, NPIX, BLOCK
+
+# L of noisy tiles (row, col) whose hull covers the centre of tile (3, 3)
+L_TILES = [(2, 2), (3, 2), (4, 2), (4, 3), (4, 4)]
+
+def write_residual(fn, marginal=2.5):
+    """ Noise with the L raised 6 fold and tile (3, 3) raised marginally above the cutoff """
+    data = np.random.RandomState(7).randn(NPIX, NPIX) * 1.0e-3
+    for ty, tx in L_TILES:
+        data[ty * BLOCK:(ty + 1) * BLOCK, tx * BLOCK:(tx + 1) * BLOCK] *= 6.0
+    data[3 * BLOCK:4 * BLOCK, 3 * BLOCK:4 * BLOCK] *= marginal
+    return write_pointing(fn, 30.0, data)
+
+def summary(regions):
+    return [(reg.name, sorted([tuple(c) for c in reg.corners])) for reg in regions]
+
+def test_undecimated_preview_matches_full_run(tmpdir):
+    fn = write_residual(str(tmpdir.join("res.fits")))
+    kw = dict(block_size=BLOCK, min_blocks_in_region=2)
+    regions, confidence = tag_preview(fn, decimation=1, regionsfn=None, **kw)
+    full = tag_regions(fn, regionsfn=None, **kw)
+    assert len(full) == 1
+    assert summary(regions) == summary(full)
+    assert confidence["samples_per_tile"] == BLOCK**2
+
+def test_confidence_of_flagged_tiles_only(tmpdir):
+    fn = write_residual(str(tmpdir.join("res.fits")))
+    # tile (3, 3) merges into the region unless excluded
+    kw = dict(block_size=BLOCK, min_blocks_in_region=2, exclusion_zones=[(3.5 * BLOCK, 3.5 * BLOCK, 5.0)])
+    regions, confidence = tag_preview(fn, decimation=2, regionsfn=None, **kw)
+    assert [reg.name for reg in regions] == [reg.name for reg in tag_regions(fn, regionsfn=None, **kw)]
+    assert "reg[3,3]" not in regions[0].name
+    # the excluded tile would lower the confidence of the region it lies in
+    assert np.all(np.array(confidence["regions"]) > 0.999)
@@ -0,0 +1,90 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from catdagger.gauss2 import twodgaussian, twodgaussian_jacobian
+from catdagger.fits_tools import get_fitted_beam
+from catdagger.psf_fitting import FWHM_PER_SIGMA
+from test_fits_tools import sin_wcs
+
+@pytest.mark.parametrize("circle,rotate,vheight", [(0, 1, 0), (0, 1, 1), (1, 0, 0), (0, 0, 1), (1, 1, 1)])
+def test_jacobian_matches_finite_differences(circle, rotate, vheight):
+    params = ([0.3] if vheight else []) + [1.2, 10.3, 12.1] + ([3.1] if circle else [3.1, 1.7]) + \
+             ([37.0] if rotate else [])
+    x, y = np.indices((25, 25)).astype(np.float64)
+    jac = twodgaussian_jacobian(params, circle, rotate, vheight)(x, y)
+    assert jac.shape == (25, 25, len(params))
+    h = 1.0e-6
+    for i in range(len(params)):
+        upper = list(params); upper[i] += h
+        lower = list(params); lower[i] -= h
+        fd = (twodgaussian(upper, circle, rotate, vheight)(x, y) -
+              twodgaussian(lower, circle, rotate, vheight)(x, y)) / (2 * h)
+        assert np.max(np.abs(fd - jac[..., i])) < 1.0e-8
+
+CDELT = 1.0 / 3600.0
+
+def psf_plane(bmaj, bmin, bpa, npix=128):
+    """ Peak normalised gaussian beam (FWHM in degrees, BPA north through east) with a faint sidelobe ring """
+    y, x = np.indices((npix, npix)) - npix // 2
+    # RA increases to the left: east is -x, north is +y
+    pa = np.deg2rad(bpa)
+    along = -x * np.sin(pa) + y * np.cos(pa)
+    across = x * np.cos(pa) + y * np.sin(pa)
+    smaj = bmaj / CDELT / FWHM_PER_SIGMA
+    smin = bmin / CDELT / FWHM_PER_SIGMA
+    r = np.hypot(x, y)
+    return np.exp(-0.5 * ((along / smaj)**2 + (across / smin)**2)) - \
+        0.05 * np.exp(-0.5 * ((r - 6 * smaj) / smaj)**2)
+
+def write_psf(fn, beams, npix=128):
+    hdr = sin_wcs(npix, CDELT).to_header()
+    hdr["CTYPE3"] = "FREQ"; hdr["CRVAL3"] = 1.4e9; hdr["CRPIX3"] = 1; hdr["CDELT3"] = 1.0e6
+    hdr["CTYPE4"] = "STOKES"; hdr["CRVAL4"] = 1; hdr["CRPIX4"] = 1; hdr["CDELT4"] = 1
+    cube = np.array([psf_plane(bmaj, bmin, bpa, npix) for bmaj, bmin, bpa in beams])[None]
+    fits.PrimaryHDU(cube.astype(np.float32), header=hdr).writeto(fn, overwrite=True)
+    return fn
+
+def assert_beam(fitted, bmaj, bmin, bpa):
+    fbmin, fbmaj, fbpa = fitted
+    assert np.isclose(fbmaj, bmaj, rtol=1.0e-3) and np.isclose(fbmin, bmin, rtol=1.0e-3)
+    assert np.abs((fbpa - bpa + 90.0) % 180.0 - 90.0) < 0.1
+
+@pytest.mark.parametrize("bpa", [-60.0, -45.0, 0.0, 25.0, 45.0, 89.0])
+def test_beam_without_keywords(tmpdir, bpa):
+    beam = (8.0 * CDELT, 5.0 * CDELT, bpa)
+    fn = write_psf(str(tmpdir.join("psf.fits")), [beam])
+    assert "BMAJ" not in fits.getheader(fn)
+    assert_beam(get_fitted_beam(fn, 0), *beam)
+
+def test_beams_per_channel(tmpdir):
+    beams = [(8.0 * CDELT, 5.0 * CDELT, 30.0), (6.0 * CDELT, 4.0 * CDELT, -45.0)]
+    fn = write_psf(str(tmpdir.join("psf.fits")), beams)
+    for nprocs in [1, 2]:
+        fitted = get_fitted_beam(fn, 0, per_channel=True, nprocs=nprocs)
+        assert len(fitted) == 2
+        for f, beam in zip(fitted, beams):
+            assert_beam(f, *beam)
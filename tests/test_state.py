@@ -0,0 +1,117 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import numpy as np
+from catdagger import state
+from catdagger.filters import filter_name
+from catdagger.tiled_tesselator import tile_grid, tile_statistics, tag_tiles, region_filters
+from test_fits_tools import sin_wcs
+
+BLOCK = 40
+NTILES = 12
+
+def noisy_image(patches, seed=3):
+    """ Gaussian noise with the noise of the given (row, col) tiles raised 5 fold """
+    data = np.random.RandomState(seed).randn(NTILES * BLOCK, NTILES * BLOCK) * 1.0e-3
+    for ty, tx in patches:
+        data[ty * BLOCK:(ty + 1) * BLOCK, tx * BLOCK:(tx + 1) * BLOCK] *= 5.0
+    return data
+
+def tag(data, statefn=None, block_size=BLOCK, **kwargs):
+    bin_lower, bin_upper = tile_grid(data.shape, block_size)
+    stats = tile_statistics(data, bin_lower, bin_upper, bin_lower, bin_upper)
+    return tag_tiles(data, sin_wcs(data.shape[0]), stats, bin_lower, bin_upper,
+                     regionsfn=None,
+                     block_size=block_size,
+                     min_blocks_in_region=2,
+                     statefn=statefn,
+                     **kwargs)
+
+def summary(regions):
+    return [(reg.name, sorted([tuple(c) for c in reg.corners])) for reg in regions]
+
+def decisions(statefn):
+    st = state.load_state(statefn)
+    return list(zip(st["names"], st["rejected_by"]))
+
+# two tile region at the top, single tile (culled) in the middle, L at the bottom
+PATCHES = [(1, 2), (1, 3), (5, 6), (9, 2), (10, 2), (10, 3)]
+
+def test_rerun_matches_full_run(tmpdir):
+    statefn = str(tmpdir.join("state.npz"))
+    data = noisy_image(PATCHES)
+    full = tag(data)
+    assert len(full) == 2
+    assert summary(tag(data, statefn=statefn)) == summary(full)
+    first = decisions(statefn)
+    assert ("reg[6,5]", "arealess") in first
+    assert summary(tag(data, statefn=statefn)) == summary(full)
+    assert decisions(statefn) == first
+
+def test_changed_tile_invalidates_nearby_regions_only(tmpdir):
+    statefn = str(tmpdir.join("state.npz"))
+    tag(noisy_image(PATCHES), statefn=statefn)
+    # grow the L at the bottom, leaving the regions above untouched
+    data = noisy_image(PATCHES + [(10, 4)])
+    bin_lower, bin_upper = tile_grid(data.shape, BLOCK)
+    stats = tile_statistics(data, bin_lower, bin_upper, bin_lower, bin_upper)
+    prev = state.load_state(statefn)
+    flagged = stats > 2.3 * np.percentile(stats, 30.0)
+    changed = state.changed_tiles(prev, flagged, stats / np.percentile(stats, 30.0), 0.05)
+    assert list(zip(*np.nonzero(changed))) == [(10, 4)]
+    reused = state.reusable_regions(prev, changed, sin_wcs(data.shape[0]), data)[0]
+    assert sorted([reg.name for reg in reused]) == ["reg[2,1]&reg[3,1]", "reg[6,5]"]
+    # carried over regions come out where a full run places them
+    assert summary(tag(data, statefn=statefn)) == summary(tag(data))
+
+def test_state_of_other_grid_or_settings_ignored(tmpdir):
+    statefn = str(tmpdir.join("state.npz"))
+    data = noisy_image(PATCHES)
+    tag(data, statefn=statefn)
+    w = sin_wcs(data.shape[0])
+    bin_lower, bin_upper = tile_grid(data.shape, BLOCK)
+    min_area = 2 * BLOCK**2
+    settings = [np.inf, np.inf, np.inf, [filter_name(f) for f in region_filters(min_area)]]
+    assert state.load_state(statefn, state.grid_fingerprint(w, bin_lower, bin_upper, min_area,
+                                                            *settings)) is not None
+    other_lower, other_upper = tile_grid(data.shape, BLOCK // 2)
+    assert state.load_state(statefn, state.grid_fingerprint(w, other_lower, other_upper, min_area,
+                                                            *settings)) is None
+    assert state.load_state(statefn, state.grid_fingerprint(w, bin_lower, bin_upper, min_area,
+                                                            1.0, *settings[1:])) is None
+    # a run with other settings tags from scratch
+    assert summary(tag(data, statefn=statefn, block_size=BLOCK // 2)) == \
+        summary(tag(data, block_size=BLOCK // 2))
+    assert summary(tag(data, statefn=statefn, max_abs_skewness=10.0)) == \
+        summary(tag(data, max_abs_skewness=10.0))
+
+def test_cluster_wrapping_carried_region(tmpdir):
+    statefn = str(tmpdir.join("state.npz"))
+    tag(noisy_image([(5, 5), (5, 6)]), statefn=statefn)
+    # a U two tiles away from the carried region: none of its tiles neighbour
+    # the region, but their hull covers it
+    u = [(r, 3) for r in range(3, 8)] + [(r, 8) for r in range(3, 8)] + [(7, c) for c in range(4, 8)]
+    data = noisy_image([(5, 5), (5, 6)] + u)
+    full = tag(data)
+    assert len(full) == 1
+    assert summary(tag(data, statefn=statefn)) == summary(full)
@@ -0,0 +1,88 @@
+# CATDagger: an automatic differential gain catalog tagger
+# (c) 2019 South African Radio Astronomy Observatory, B. Hugo
+# This code is distributed under the terms of GPLv2, see LICENSE.md for details
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 SARAO
+#
+# This file is part of CATDagger.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import numpy as np
+from astropy.io import fits
+from catdagger.fits_tools import read_stokes_slice, StokesSliceReader
+from catdagger.tiled_tesselator import tag_regions, tile_grid, tile_statistics
+from test_fits_tools import sin_wcs
+
+NPIX = 320
+BLOCK = 40
+
+def write_residual(fn, nchan=5, dtype=np.float32):
+    """ Residual cube of independent channels with two noisy patches """
+    hdr = sin_wcs(NPIX).to_header()
+    hdr["CTYPE3"] = "FREQ"; hdr["CRVAL3"] = 1.4e9; hdr["CRPIX3"] = 1; hdr["CDELT3"] = 1.0e6
+    hdr["CTYPE4"] = "STOKES"; hdr["CRVAL4"] = 1; hdr["CRPIX4"] = 1; hdr["CDELT4"] = 1
+    cube = np.random.RandomState(3).randn(1, nchan, NPIX, NPIX) * 1.0e-3
+    cube[:, :, 40:120, 40:120] *= 5.0
+    cube[:, :, 200:240, 120:280] *= 4.0
+    fits.PrimaryHDU(cube.astype(dtype), header=hdr).writeto(fn, overwrite=True)
+    return fn
+
+def summary(regions):
+    return [(reg.name, reg.area_sigma, sorted([tuple(c) for c in reg.corners])) for reg in regions]
+
+def test_threads_bit_identical(tmpdir):
+    fn = write_residual(str(tmpdir.join("res.fits")))
+    for single_precision in [False, True]:
+        band_avg = read_stokes_slice(fn, nthreads=1, single_precision=single_precision)[2]
+        assert np.array_equal(read_stokes_slice(fn, nthreads=4, single_precision=single_precision)[2], band_avg)
+        reader = StokesSliceReader(fn, single_precision=single_precision)
+        assert np.array_equal(reader.read(nthreads=4), reader.read(nthreads=1))
+        assert np.array_equal(reader.read_decimated(4, nthreads=4), reader.read_decimated(4, nthreads=1))
+    bin_lower, bin_upper = tile_grid(band_avg.shape, BLOCK)
+    stats = tile_statistics(band_avg, bin_lower, bin_upper, bin_lower, bin_upper, nthreads=1)
+    assert np.array_equal(tile_statistics(band_avg, bin_lower, bin_upper, bin_lower, bin_upper, nthreads=4), 
+                          stats)
+    kw = dict(regionsfn=None, block_size=BLOCK, min_blocks_in_region=2)
+    serial = tag_regions(fn, nthreads=1, **kw)
+    assert len(serial) == 2
+    assert summary(tag_regions(fn, nthreads=4, **kw)) == summary(serial)
+    # out-of-core, one row of tiles at a time
+    assert summary(tag_regions(fn, nthreads=4, max_memory=1, **kw)) == \
+        summary(tag_regions(fn, nthreads=1, max_memory=1, **kw))
+
+def test_single_precision_identical(tmpdir):
+    fn = write_residual(str(tmpdir.join("res.fits")))
+    band_avg = read_stokes_slice(fn)[2]
+    single = read_stokes_slice(fn, single_precision=True)[2]
+    assert band_avg.dtype == single.dtype == np.float32
+    assert np.array_equal(single, band_avg)
+    # out-of-core planes are those read in memory
+    assert np.array_equal(StokesSliceReader(fn).read(), band_avg)
+    assert np.array_equal(StokesSliceReader(fn, single_precision=True).read(), band_avg)
+    kw = dict(regionsfn=None, block_size=BLOCK, min_blocks_in_region=2)
+    regions = tag_regions(fn, **kw)
+    assert len(regions) == 2
+    for max_memory in [None, 1]:
+        assert summary(tag_regions(fn, single_precision=True, max_memory=max_memory, **kw)) == summary(regions)
+        assert summary(tag_regions(fn, max_memory=max_memory, **kw)) == summary(regions)
+    # double precision cubes are only rounded to float32 after averaging
+    fn64 = write_residual(str(tmpdir.join("res64.fits")), dtype=np.float64)
+    band_avg = read_stokes_slice(fn64)[2]
+    assert band_avg.dtype == np.float64
+    assert np.array_equal(read_stokes_slice(fn64, single_precision=True)[2], band_avg.astype(np.float32))
+    assert np.array_equal(StokesSliceReader(fn64, single_precision=True).read(), band_avg.astype(np.float32))